@@ -3,7 +3,9 @@ import os
 import tempfile
 from PIL import Image
 import io
-from pvd_lib import pvd_lib
+from pvd_lib import pvd_cancelled
+from pvd_executor import executor_full
+from app_common import run_job, output_path, read_and_remove, show_cancelled_notice, payload_size, show_capacity_check
 
 st.set_page_config(
     page_title="PVD Stegano",
@@ -13,13 +15,14 @@ st.set_page_config(
 # инициализация состояния сессии
 if 'extracted_content' not in st.session_state:
     st.session_state.extracted_content = None
-if 'extracted_file_path' not in st.session_state:
-    st.session_state.extracted_file_path = None
+if 'embedded_image' not in st.session_state:
+    st.session_state.embedded_image = None
 if 'download_triggered' not in st.session_state:
     st.session_state.download_triggered = False
 
 st.title("My site")
 st.markdown("---")
+show_cancelled_notice()
 
 col1, col2 = st.columns(2)
 
@@ -43,43 +46,54 @@ with col1:
         image = Image.open(original_image)
         st.image(image, caption="Исходное изображение", use_column_width=True)
 
-        if st.button("Встроить данные в изображение", type="primary"):
+        fits = show_capacity_check(original_image.getvalue(), payload_size(secret_file.getvalue()), key="cancel_capacity")
+
+        if st.button("Встроить данные в изображение", type="primary", disabled=fits is False):
             with st.spinner("Встраиваю данные..."):
+                tmp_paths = []
                 try:
                     # cохранение временных файлов
                     with tempfile.NamedTemporaryFile(delete=False, suffix='.png') as tmp_img:
                         image.save(tmp_img.name)
                         original_path = tmp_img.name
+                        tmp_paths.append(original_path)
 
                     with tempfile.NamedTemporaryFile(delete=False) as tmp_secret:
                         tmp_secret.write(secret_file.getvalue())
                         secret_path = tmp_secret.name
+                        tmp_paths.append(secret_path)
 
-                    result_path = "hidden_image.png"
+                    result_path = output_path(".png")
+                    tmp_paths.append(result_path)
 
-                    pvd = pvd_lib()
-                    result = pvd.pvd_embed(original_path, secret_path, result_path)
+                    result = run_job("embed", original_path, secret_path, result_path, key="cancel_embed")
 
                     if result:
                         st.success(f"Данные успешно встроены! Встроено бит: {result}")
+                        st.session_state.embedded_image = read_and_remove(result_path)
 
                         st.subheader("Результат")
-                        result_image = Image.open(result_path)
+                        result_image = Image.open(io.BytesIO(st.session_state.embedded_image))
                         st.image(result_image, caption="Изображение со скрытыми данными", use_column_width=True)
 
-                        with open(result_path, "rb") as file:
-                            btn = st.download_button(
-                                label="Скачать изображение со скрытыми данными",
-                                data=file,
-                                file_name="hidden_image.png",
-                                mime="image/png"
-                            )
-
-                    os.unlink(original_path)
-                    os.unlink(secret_path)
-
+                        btn = st.download_button(
+                            label="Скачать изображение со скрытыми данными",
+                            data=st.session_state.embedded_image,
+                            file_name="hidden_image.png",
+                            mime="image/png"
+                        )
+
+                except executor_full:
+                    st.warning("Сервер занят, попробуйте позже")
+                except pvd_cancelled:
+                    st.warning("Операция отменена")
                 except Exception as e:
                     st.error(f"Ошибка при встраивании: {str(e)}")
+                finally:
+                    # и при отмене кнопкой (перезапуск скрипта)
+                    for path in tmp_paths:
+                        if os.path.exists(path):
+                            os.unlink(path)
 
 with col2:
     st.header("Извлечение данных")
@@ -104,10 +118,12 @@ with col2:
         # Кнопка для извлечения
         if st.button("Извлечь скрытые данные", type="secondary"):
             with st.spinner("Извлекаю данные..."):
+                tmp_paths = []
                 try:
                     with tempfile.NamedTemporaryFile(delete=False, suffix='.png') as tmp_stego:
                         stego_img.save(tmp_stego.name)
                         stego_path = tmp_stego.name
+                        tmp_paths.append(stego_path)
 
                     ref_path = None
                     if ref_image_extract:
@@ -115,20 +131,20 @@ with col2:
                             ref_img = Image.open(ref_image_extract)
                             ref_img.save(tmp_ref.name)
                             ref_path = tmp_ref.name
+                            tmp_paths.append(ref_path)
                     else:
                         # если оригинал не загружен, используем стего-изображение как референс
                         ref_path = stego_path
 
-                    extracted_path = "extracted.bin"
+                    extracted_path = output_path(".bin")
+                    tmp_paths.append(extracted_path)
 
-                    pvd = pvd_lib()
-                    result = pvd.pvd_extract(ref_path, extracted_path, stego_path)
+                    result = run_job("extract", ref_path, extracted_path, stego_path, key="cancel_extract")
 
                     if result and os.path.exists(extracted_path):
                         st.success(f"Данные успешно извлечены! Извлечено бит: {result}")
 
-                        st.session_state.extracted_file_path = extracted_path
-                        st.session_state.extracted_content = open(extracted_path, "rb").read()
+                        st.session_state.extracted_content = read_and_remove(extracted_path)
 
                         # автоматический запуск обработки извлеченного контента
                         st.session_state.download_triggered = True
@@ -152,12 +168,16 @@ with col2:
                     else:
                         st.error("Не удалось извлечь данные или файл не найден")
 
-                    os.unlink(stego_path)
-                    if ref_path and ref_path != stego_path:
-                        os.unlink(ref_path)
-
+                except executor_full:
+                    st.warning("Сервер занят, попробуйте позже")
+                except pvd_cancelled:
+                    st.warning("Операция отменена")
                 except Exception as e:
                     st.error(f"Ошибка при извлечении: {str(e)}")
+                finally:
+                    for path in tmp_paths:
+                        if os.path.exists(path):
+                            os.unlink(path)
 
 # раздел для автоматического запуска извлеченного контента
 if st.session_state.download_triggered and st.session_state.extracted_content:
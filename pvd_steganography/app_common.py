@@ -0,0 +1,149 @@
+import concurrent.futures
+import hashlib
+import io
+import os
+import tempfile
+import time
+import uuid
+import streamlit as st
+from pvd_executor import fair_executor, executor_full
+from pvd_lib import pvd_lib, file_bits_reader, PVD_COMPRESSION_AUTO
+
+# общие части app.py и app_sub.py
+
+PROGRESS_MIN_INTERVAL = 0.2
+
+# один пул процессов на весь сервер: N ядер - N одновременных встраиваний
+APP_WORKERS = int(os.environ.get('PVD_APP_WORKERS', os.cpu_count() or 1))
+APP_MAX_PENDING = int(os.environ.get('PVD_APP_MAX_PENDING', APP_WORKERS * 4))
+APP_MAX_PENDING_PER_USER = int(os.environ.get('PVD_APP_MAX_PENDING_PER_USER', 2))
+
+
+@st.cache_resource
+def get_executor():
+    return fair_executor(APP_WORKERS, APP_MAX_PENDING, APP_MAX_PENDING_PER_USER)
+
+
+def session_id():
+    if 'session_id' not in st.session_state:
+        st.session_state.session_id = uuid.uuid4().hex
+    return st.session_state.session_id
+
+
+def output_path(suffix=''):
+    # свой временный файл на каждый вызов, чтобы параллельные пользователи не перезаписывали файлы
+    # друг друга; вызывающий код удаляет его в finally вместе с остальными временными файлами
+    with tempfile.NamedTemporaryFile(delete=False, prefix='pvd_out_', suffix=suffix) as tmp_out:
+        return tmp_out.name
+
+
+def read_and_remove(path):
+    # результат забираем в память сессии, на диске ничего не остается
+    try:
+        with open(path, "rb") as f:
+            return f.read()
+    finally:
+        if os.path.exists(path):
+            os.unlink(path)
+
+
+def make_progress_callback(progress_bar):
+    # pvd_lib сообщает прогресс раз в строку блоков, браузер обновляем не чаще PROGRESS_MIN_INTERVAL
+    last_update = [0.0]
+
+    def on_progress(info):
+        now = time.perf_counter()
+        if now - last_update[0] < PROGRESS_MIN_INTERVAL:
+            return
+        last_update[0] = now
+
+        if info.bits_total:
+            done = min(1.0, info.bits_done / info.bits_total)
+        else:
+            done = info.blocks_done / max(1, info.blocks_total)
+        eta = f", осталось ~{info.eta:.0f} с" if info.eta is not None else ""
+        progress_bar.progress(done, text=f"Блоков: {info.blocks_done}/{info.blocks_total}{eta}")
+
+    return on_progress
+
+
+def run_job(kind, *args, key, **options):
+    # задача уходит в общий пул, скрипт только ждет и рисует прогресс;
+    # нажатие "Отменить" перезапускает скрипт, ожидание прерывается и задача отменяется
+    job = get_executor().submit(session_id(), kind, *args, **options)
+
+    def on_cancel():
+        job.cancel()
+        st.session_state.operation_cancelled = True
+
+    st.button("Отменить", key=key, on_click=on_cancel)
+    progress_bar = st.progress(0.0, text="В очереди...")
+    on_progress = make_progress_callback(progress_bar)
+    try:
+        while True:
+            try:
+                return job.result(timeout=PROGRESS_MIN_INTERVAL)
+            except concurrent.futures.TimeoutError:
+                info = job.progress()
+                if info:
+                    on_progress(info)
+                else:
+                    progress_bar.progress(0.0, text="В очереди...")
+    except BaseException:
+        job.cancel()
+        raise
+
+
+def show_cancelled_notice():
+    if st.session_state.get('operation_cancelled'):
+        st.warning("Операция отменена")
+        st.session_state.operation_cancelled = False
+
+
+
+@st.cache_data(show_spinner=False, max_entries=64)
+def estimate_capacity(image_bytes):
+    # оценка по выборке блоков: миллисекунды даже для больших изображений
+    return pvd_lib._estimate_capacity(io.BytesIO(image_bytes))
+
+
+@st.cache_data(show_spinner=False, max_entries=64)
+def payload_size(data):
+    # сколько байт займет встраивание: заголовок и данные после выбора сжатия
+    return file_bits_reader(None, PVD_COMPRESSION_AUTO, data=data).total_bytes
+
+
+def exact_capacity(image_bytes, key):
+    # точная емкость считается в общем пуле, результат запоминаем на сессию
+    cache = st.session_state.setdefault('exact_capacity', {})
+    digest = hashlib.sha256(image_bytes).hexdigest()
+    if digest not in cache:
+        with tempfile.NamedTemporaryFile(delete=False) as tmp_img:
+            tmp_img.write(image_bytes)
+        try:
+            cache[digest] = run_job("capacity", tmp_img.name, key=key)
+        finally:
+            os.unlink(tmp_img.name)
+    return cache[digest]
+
+
+def show_capacity_check(image_bytes, total_bytes, key):
+    # True / False - поместятся ли данные, None - не удалось проверить
+    estimate = estimate_capacity(image_bytes)
+    fits = estimate.fits(total_bytes)
+    capacity = f"~{estimate.capacity} байт ({estimate.low}-{estimate.high})"
+    if fits is None:
+        # оценка на границе, нужен точный расчет
+        try:
+            exact = exact_capacity(image_bytes, key)
+        except executor_full:
+            st.warning("Сервер занят, емкость не проверена")
+            return None
+        fits = total_bytes <= exact
+        capacity = f"{exact} байт"
+
+    if fits:
+        st.success(f"Данные поместятся: {total_bytes} байт, емкость {capacity}")
+    else:
+        st.error(f"Данные не поместятся: {total_bytes} байт, емкость {capacity}")
+    return fits
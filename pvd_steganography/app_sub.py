@@ -1,60 +1,12 @@
 import streamlit as st
 import os
 import tempfile
+import io
 from PIL import Image
-import hashlib
-import random
-from pvd_lib import pvd_lib
-
-
-class SimpleECDSA:
-    #упрощенная ЭЦП RSA для интеграции
-    @staticmethod
-    def generate_keys(key_size=512):
-        def is_prime(n, k=128):
-            if n < 2: return False
-            for _ in range(k):
-                a = random.randrange(2, n - 1)
-                if pow(a, n - 1, n) != 1:
-                    return False
-            return True
-
-        def generate_prime(bits):
-            while True:
-                p = random.getrandbits(bits)
-                p |= (1 << bits - 1) | 1
-                if is_prime(p):
-                    return p
-
-        p = generate_prime(key_size // 2)
-        q = generate_prime(key_size // 2)
-        n = p * q
-        phi = (p - 1) * (q - 1)
-        e = 65537
-        d = pow(e, -1, phi)
-
-        return (e, n), (d, n)
-
-    @staticmethod
-    def hash_message(message):
-        if isinstance(message, str):
-            message = message.encode('utf-8')
-        return int.from_bytes(hashlib.sha256(message).digest(), 'big')
-
-    @staticmethod
-    def create_signature(message, private_key):
-        d, n = private_key
-        message_hash = SimpleECDSA.hash_message(message)
-        signature = pow(message_hash, d, n)
-        return signature
-
-    @staticmethod
-    def verify_signature(message, signature, public_key):
-        #проверка эцп
-        e, n = public_key
-        message_hash = SimpleECDSA.hash_message(message)
-        decrypted_hash = pow(signature, e, n)
-        return message_hash == decrypted_hash
+from pvd_lib import pvd_cancelled
+from pvd_executor import executor_full
+from app_common import run_job, output_path, read_and_remove, show_cancelled_notice, payload_size, show_capacity_check
+from pvd_signature import SimpleECDSA, signature_record
 
 
 #сессия
@@ -64,9 +16,12 @@ if 'extracted_signature' not in st.session_state:
     st.session_state.extracted_signature = None
 if 'extracted_message' not in st.session_state:
     st.session_state.extracted_message = None
+if 'extracted_key_id' not in st.session_state:
+    st.session_state.extracted_key_id = None
 
 st.set_page_config(page_title="Stego-ЭЦП", layout="wide")
 st.title("Стеганография с ЭЦП")
+show_cancelled_notice()
 
 #ключи в сайдбаре
 st.sidebar.header("Ключи ЭЦП")
@@ -117,48 +72,62 @@ with tab1:
             image = Image.open(carrier_image)
             st.image(image, caption="Изображение-контейнер", use_column_width=True)
 
-            if st.button("Спрятать ЭЦП в изображение", type="secondary"):
+            #бинарная запись подписи: id ключа, подпись, сообщение
+            signature_rec = signature_record.pack(
+                signature_record.key_id(public_key),
+                signature_record.signature_to_bytes(st.session_state.current_signature, public_key),
+                st.session_state.current_message
+            )
+            fits = show_capacity_check(carrier_image.getvalue(), payload_size(signature_rec), key="cancel_capacity")
+
+            if st.button("Спрятать ЭЦП в изображение", type="secondary", disabled=fits is False):
                 with st.spinner("Прячу подпись..."):
+                    tmp_paths = []
                     try:
                         #создание временного файла
                         with tempfile.NamedTemporaryFile(delete=False, suffix='.png') as tmp_img:
                             image.save(tmp_img.name)
                             carrier_path = tmp_img.name
+                            tmp_paths.append(carrier_path)
 
                         #создание временного файла с подписью
-                        signature_str = f"SIGNATURE:{st.session_state.current_signature}:MESSAGE:{st.session_state.current_message}"
-                        # ЯВНО указываем кодировку UTF-8 при записи
-                        with tempfile.NamedTemporaryFile(delete=False, mode='w', suffix='.txt', encoding='utf-8') as tmp_sig:
-                            tmp_sig.write(signature_str)
+                        with tempfile.NamedTemporaryFile(delete=False, suffix='.bin') as tmp_sig:
+                            tmp_sig.write(signature_rec)
                             signature_path = tmp_sig.name
+                            tmp_paths.append(signature_path)
 
                         #прячем подпись в изображение
-                        stego_path = "stego_signed_image.png"
-                        pvd = pvd_lib()
-                        result = pvd.pvd_embed(carrier_path, signature_path, stego_path)
+                        stego_path = output_path(".png")
+                        tmp_paths.append(stego_path)
+                        result = run_job("embed", carrier_path, signature_path, stego_path, key="cancel_embed")
 
                         if result:
                             st.success(f"Подпись спрятана! Использовано бит: {result}")
+                            stego_bytes = read_and_remove(stego_path)
 
                             # Показываем результат
-                            stego_image = Image.open(stego_path)
+                            stego_image = Image.open(io.BytesIO(stego_bytes))
                             st.image(stego_image, caption="Изображение со скрытой подписью", use_column_width=True)
 
                             # Кнопка скачивания
-                            with open(stego_path, "rb") as file:
-                                st.download_button(
-                                    label="Скачать изображение со скрытой подписью",
-                                    data=file,
-                                    file_name="signed_image.png",
-                                    mime="image/png"
-                                )
-
-                        #чистка
-                        os.unlink(carrier_path)
-                        os.unlink(signature_path)
-
+                            st.download_button(
+                                label="Скачать изображение со скрытой подписью",
+                                data=stego_bytes,
+                                file_name="signed_image.png",
+                                mime="image/png"
+                            )
+
+                    except executor_full:
+                        st.warning("Сервер занят, попробуйте позже")
+                    except pvd_cancelled:
+                        st.warning("Операция отменена")
                     except Exception as e:
                         st.error(f"Ошибка: {str(e)}")
+                    finally:
+                        #чистка (и при отмене)
+                        for path in tmp_paths:
+                            if os.path.exists(path):
+                                os.unlink(path)
 
 with tab2:
     st.header("Извлечение и проверка ЭЦП")
@@ -193,63 +162,57 @@ with tab2:
 
             if st.button("Извлечь подпись", type="primary"):
                 with st.spinner("Извлекаю подпись..."):
+                    tmp_paths = []
                     try:
                         #сохранение временных файлов
                         with tempfile.NamedTemporaryFile(delete=False, suffix='.png') as tmp_orig:
                             original_img.save(tmp_orig.name)
                             original_path = tmp_orig.name
+                            tmp_paths.append(original_path)
 
                         with tempfile.NamedTemporaryFile(delete=False, suffix='.png') as tmp_stego:
                             stego_img.save(tmp_stego.name)
                             stego_path = tmp_stego.name
+                            tmp_paths.append(stego_path)
 
                         #извлечение подписи
-                        extracted_path = "extracted_signature.txt"
-                        pvd = pvd_lib()
+                        extracted_path = output_path(".bin")
+                        tmp_paths.append(extracted_path)
 
                         #вызов с двумя разными файлами
-                        result = pvd.pvd_extract(original_path, extracted_path, stego_path)
+                        result = run_job("extract", original_path, extracted_path, stego_path, key="cancel_extract")
 
                         if result and os.path.exists(extracted_path):
-                            #чтение с указанием кодировки UTF-8 и обработкой ошибок
-                            try:
-                                with open(extracted_path, 'r', encoding='utf-8') as f:
-                                    extracted_data = f.read()
-                            except UnicodeDecodeError:
-                                try:
-                                    with open(extracted_path, 'r', encoding='cp1251') as f:
-                                        extracted_data = f.read()
-                                except UnicodeDecodeError:
-                                    with open(extracted_path, 'r', encoding='latin-1') as f:
-                                        extracted_data = f.read()
-
-                            #парсинг подписи и сообщения
-                            if "SIGNATURE:" in extracted_data and "MESSAGE:" in extracted_data:
-                                parts = extracted_data.split(":")
-                                if len(parts) >= 4:
-                                    signature = int(parts[1])
-                                    message = parts[3]
-
-                                    st.session_state.extracted_signature = signature
-                                    st.session_state.extracted_message = message
-
-                                    st.success("Подпись извлечена!")
-                                    st.info(f"Извлеченное сообщение: {message}")
-                                    st.code(f"Извлеченная подпись: {signature}")
-                                else:
-                                    st.error("Неверный формат извлеченных данных")
-                            else:
-                                st.error("Не удалось распарсить извлеченные данные")
-                                st.code(f"Сырые данные: {extracted_data[:100]}...")
-
-                        #чистка временных файлов
-                        os.unlink(original_path)
-                        os.unlink(stego_path)
-                        if os.path.exists(extracted_path):
-                            os.unlink(extracted_path)
+                            extracted_data = read_and_remove(extracted_path)
 
+                            #разбор бинарной записи подписи
+                            try:
+                                key_id, sig_bytes, message_bytes = signature_record.unpack(extracted_data)
+                                signature = signature_record.signature_from_bytes(sig_bytes)
+                                message = message_bytes.decode('utf-8')
+
+                                st.session_state.extracted_signature = signature
+                                st.session_state.extracted_message = message
+                                st.session_state.extracted_key_id = key_id
+
+                                st.success("Подпись извлечена!")
+                                st.info(f"Извлеченное сообщение: {message}")
+                                st.code(f"Извлеченная подпись: {signature}\nID ключа: {key_id.hex()}")
+                            except (ValueError, UnicodeDecodeError) as e:
+                                st.error(f"Не удалось распарсить извлеченные данные: {e}")
+                                st.code(f"Сырые данные: {extracted_data[:100]!r}...")
+
+                    except executor_full:
+                        st.warning("Сервер занят, попробуйте позже")
+                    except pvd_cancelled:
+                        st.warning("Операция отменена")
                     except Exception as e:
                         st.error(f"Ошибка при извлечении: {str(e)}")
+                    finally:
+                        #чистка временных файлов
+                        for path in tmp_paths:
+                            if os.path.exists(path):
+                                os.unlink(path)
 
     with col2:
         #проверка подписи
@@ -259,6 +222,9 @@ with tab2:
             st.info(f"Сообщение для проверки: {st.session_state.extracted_message}")
             st.code(f"Подпись для проверки: {st.session_state.extracted_signature}")
 
+            if st.session_state.extracted_key_id != signature_record.key_id(public_key):
+                st.warning("ID ключа в подписи не совпадает с текущим публичным ключом")
+
             if st.button("Проверить подпись", type="secondary", use_container_width=True):
                 is_valid = SimpleECDSA.verify_signature(
                     st.session_state.extracted_message,
@@ -281,8 +247,8 @@ with col1:
     st.subheader("1. Подписание")
     st.markdown("""
     - Создается ЭЦП сообщения
-    - Подпись преобразуется в текст
-    - Данные готовы к скрытию
+    - Подпись упаковывается в бинарную запись: id ключа, подпись и сообщение с префиксами длины
+    - Запись готова к скрытию
     """)
 
 with col2:
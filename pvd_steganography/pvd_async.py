@@ -0,0 +1,180 @@
+import asyncio
+import concurrent.futures
+import inspect
+import io
+import multiprocessing
+import os
+import threading
+from pvd_lib import pvd_lib, pvd_cancel_token, PVD_COMPRESSION_AUTO
+
+"""
+asyncio facade of pvd_lib: await embed(...), extract(...), capacity(...) run the blocking work on a
+process (or thread) pool, so the event loop keeps serving while an image is processed.
+
+Images and payloads are bytes, paths or async byte streams (an object with an async read(), like
+asyncio.StreamReader, or an async iterator of bytes). Cancelling the awaiting task drops a queued
+job and stops a running one at its next block row.
+
+    async with pvd_async() as pvd:
+        stego = await pvd.embed(cover_bytes, reader)
+        payloads = await pvd.batch([pvd.extract(cover_bytes, s) for s in stegos], limit=4)
+"""
+
+PVD_ASYNC_CHUNK = 1 << 16
+
+
+def _source(value):
+    # what pvd_lib opens in the worker: a path as it is, bytes as a file object
+    return io.BytesIO(value) if isinstance(value, bytes) else value
+
+
+def _run_job(kind, args, options, cancel_event):
+    # runs in a worker process or thread
+    pvd = pvd_lib(**options)
+    cancel = pvd_cancel_token(cancel_event)
+    if kind == 'embed':
+        cover, payload = args
+        stego = io.BytesIO()
+        if not pvd.pvd_embed(_source(cover), _source(payload), stego, cancel=cancel):
+            raise ValueError("Secret file size is more than embedding capacity of image")
+        return stego.getvalue()
+    elif kind == 'extract':
+        ref, stego = args
+        payload = io.BytesIO()
+        embedded_ds = pvd.pvd_extract(_source(ref), payload, _source(stego), cancel=cancel)
+        if not embedded_ds or embedded_ds < 0:
+            raise ValueError("No embedded data found")
+        return payload.getvalue()
+    elif kind == 'capacity':
+        image = _source(args[0])
+        lanes = pvd._lanes(image)
+        return pvd_lib._embed_capacity(image, lanes) if lanes else 0
+    raise ValueError("Unknown job: {}".format(kind))
+
+
+async def _read_input(value):
+    # bytes or a path go to the worker as they are, a stream is read here without blocking the loop
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        return bytes(value)
+    if isinstance(value, (str, os.PathLike)):
+        return os.fspath(value)
+    if hasattr(value, 'read'):
+        chunks = []
+        while True:
+            chunk = await value.read(PVD_ASYNC_CHUNK)
+            if not chunk:
+                return b''.join(chunks)
+            chunks.append(chunk)
+    if hasattr(value, '__aiter__'):
+        return b''.join([chunk async for chunk in value])
+    raise TypeError("Expected bytes, a path or an async byte stream: {}".format(type(value).__name__))
+
+
+async def _write_output(output, data):
+    # output.write() may be plain (asyncio.StreamWriter, then drain()) or a coroutine
+    for start in range(0, len(data), PVD_ASYNC_CHUNK):
+        written = output.write(data[start:start + PVD_ASYNC_CHUNK])
+        if inspect.isawaitable(written):
+            await written
+        drain = getattr(output, 'drain', None)
+        if drain is not None:
+            await drain()
+
+
+class pvd_async:
+
+    def __init__(self, executor=None, processes=True, max_workers=None, compression=PVD_COMPRESSION_AUTO,
+            chunk_size=None, use_alpha=False, use_16bit=False, table=None, dense=False):
+        pvd_lib.check_options(compression, chunk_size)
+        # executor - a concurrent.futures executor shared with other code, created on first use otherwise
+        self.executor = executor
+        self.own_executor = executor is None
+        self.processes = isinstance(executor, concurrent.futures.ProcessPoolExecutor) if executor else processes
+        self.max_workers = max_workers or getattr(executor, '_max_workers', None) or os.cpu_count() or 1
+        self.options = {'compression': compression, 'chunk_size': chunk_size, 'use_alpha': use_alpha,
+            'use_16bit': use_16bit, 'table': table, 'dense': dense}
+        self.manager = None
+        self.lock = threading.Lock()
+
+    def _executor(self):
+        with self.lock:
+            if self.executor is None:
+                if self.processes:
+                    # the loop may run other threads, spawn is safer than fork there
+                    self.executor = concurrent.futures.ProcessPoolExecutor(self.max_workers,
+                        mp_context=multiprocessing.get_context('spawn'))
+                else:
+                    self.executor = concurrent.futures.ThreadPoolExecutor(self.max_workers,
+                        thread_name_prefix='pvd_async')
+            return self.executor
+
+    def _cancel_event(self):
+        if not self.processes:
+            return threading.Event()
+        with self.lock:
+            # a worker process sees the event through the manager, as in fair_executor
+            if self.manager is None:
+                self.manager = multiprocessing.get_context('spawn').Manager()
+            return self.manager.Event()
+
+    async def _run(self, kind, *args):
+        loop = asyncio.get_running_loop()
+        executor = self._executor()
+        cancel_event = self._cancel_event()
+        future = loop.run_in_executor(executor, _run_job, kind, args, self.options, cancel_event)
+        try:
+            return await future
+        except asyncio.CancelledError:
+            # a queued job is dropped with the future, a running one stops at the next block row
+            cancel_event.set()
+            raise
+
+    async def embed(self, cover, payload):
+        # the stego image as PNG bytes
+        return await self._run('embed', await _read_input(cover), await _read_input(payload))
+
+    async def extract(self, ref, stego, output=None):
+        # the payload bytes, or with an output stream the number of bytes written to it
+        payload = await self._run('extract', await _read_input(ref), await _read_input(stego))
+        if output is None:
+            return payload
+        await _write_output(output, payload)
+        return len(payload)
+
+    async def capacity(self, image):
+        # embedding capacity in bytes
+        return await self._run('capacity', await _read_input(image))
+
+    async def batch(self, jobs, limit=None, return_exceptions=False):
+        # awaits the jobs (e.g. pvd.embed(...) coroutines) with at most limit of them running,
+        # results in the order of jobs as with asyncio.gather
+        semaphore = asyncio.Semaphore(limit or self.max_workers)
+
+        async def run(job):
+            started = False
+            try:
+                async with semaphore:
+                    started = True
+                    return await job
+            finally:
+                if not started and inspect.iscoroutine(job):
+                    # cancelled while waiting for its turn
+                    job.close()
+
+        return await asyncio.gather(*(run(job) for job in jobs), return_exceptions=return_exceptions)
+
+    def close(self):
+        with self.lock:
+            if self.own_executor and self.executor is not None:
+                self.executor.shutdown(cancel_futures=True)
+                self.executor = None
+            if self.manager is not None:
+                self.manager.shutdown()
+                self.manager = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        # shutdown waits for the running jobs, not on the loop
+        await asyncio.get_running_loop().run_in_executor(None, self.close)
@@ -0,0 +1,85 @@
+import argparse
+import asyncio
+import io
+import os
+import time
+from pvd_lib import pvd_lib
+from pvd_async import pvd_async
+from pvd_load_test import make_cover
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(p * len(values)))] if values else float('nan')
+
+
+async def watch_loop(interval, lags, stop):
+    # how late the loop wakes a coroutine that sleeps for interval
+    loop = asyncio.get_running_loop()
+    while not stop.is_set():
+        expected = loop.time() + interval
+        await asyncio.sleep(interval)
+        lags.append(loop.time() - expected)
+
+
+def round_trip_inline(cover, secret):
+    # what an async service does without the facade: pvd_lib called on the loop
+    stego = io.BytesIO()
+    pvd_lib().pvd_embed(io.BytesIO(cover), io.BytesIO(secret), stego)
+    payload = io.BytesIO()
+    pvd_lib().pvd_extract(io.BytesIO(cover), payload, io.BytesIO(stego.getvalue()))
+    return payload.getvalue() == secret
+
+
+async def round_trip(pvd, cover, secret):
+    stego = await pvd.embed(cover, secret)
+    return await pvd.extract(cover, stego) == secret
+
+
+async def run_mode(mode, args, cover, secret):
+    lags = []
+    stop = asyncio.Event()
+    watcher = asyncio.create_task(watch_loop(args.interval, lags, stop))
+    started = time.perf_counter()
+
+    if mode == 'inline':
+        matched = []
+        for _ in range(args.jobs):
+            matched.append(round_trip_inline(cover, secret))
+            # the watcher gets a turn between jobs only
+            await asyncio.sleep(0)
+    else:
+        async with pvd_async(processes=(mode == 'process'), max_workers=args.workers) as pvd:
+            # the pool is started before the clock, as in a long-running service
+            await pvd.capacity(cover)
+            started = time.perf_counter()
+            matched = await pvd.batch([round_trip(pvd, cover, secret) for _ in range(args.jobs)], args.limit)
+
+    elapsed = time.perf_counter() - started
+    stop.set()
+    await watcher
+    return elapsed, lags, matched.count(False)
+
+
+async def main(args):
+    cover = make_cover(args.size, args.size)
+    secret = os.urandom(args.secret)
+    for mode in args.modes:
+        elapsed, lags, mismatches = await run_mode(mode, args, cover, secret)
+        print("{}: {} round trips in {:.2f} s ({:.2f}/s), payload mismatches: {}".format(mode, args.jobs, elapsed,
+            args.jobs / elapsed, mismatches))
+        print("  loop lag ms: p50 {:.1f} p95 {:.1f} p99 {:.1f} max {:.1f}".format(
+            *(1000 * percentile(lags, p) for p in (0.50, 0.95, 0.99)), 1000 * max(lags, default=float('nan'))))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Event loop latency while pvd_async embeds and extracts")
+    parser.add_argument('--modes', nargs='+', choices=['inline', 'thread', 'process'],
+        default=['inline', 'thread', 'process'], help="inline - pvd_lib called on the loop, for comparison")
+    parser.add_argument('--jobs', type=int, default=16, help="embed + extract round trips")
+    parser.add_argument('--workers', type=int, default=None, help="pool size, CPU count by default")
+    parser.add_argument('--limit', type=int, default=None, help="round trips running at once, pool size by default")
+    parser.add_argument('--size', type=int, default=300, help="cover width and height in pixels")
+    parser.add_argument('--secret', type=int, default=2000, help="secret size in bytes")
+    parser.add_argument('--interval', type=float, default=0.005, help="loop probe interval in seconds")
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,377 @@
+import argparse
+import contextlib
+import os
+import sys
+
+"""
+pvd embed COVER SECRET OUTPUT     - hides SECRET in COVER, writes the stego image to OUTPUT
+pvd extract REF STEGO OUTPUT      - writes the payload hidden in STEGO to OUTPUT
+pvd update REF STEGO SECRET OUTPUT - replaces the payload of STEGO, rewriting only the changed blocks
+pvd capacity IMAGE                - prints the embedding capacity in bytes
+pvd capacity --estimate IMAGE     - prints a sampled estimate and its confidence interval: "capacity low high"
+pvd metrics ORIGINAL STEGO        - prints PSNR, MSE, RMSE and SSIM
+pvd heatmap IMAGE                 - prints the capacity, writes the capacity of every block
+                                    (--png, --npy, --sums) and of regions (--region X0 Y0 X1 Y1)
+pvd library scan DIR              - indexes the covers of DIR (only new and changed files)
+pvd library best DIR SIZE         - prints the indexed covers a payload of SIZE bytes fits into
+pvd recipients embed COVER OUTPUT SECRET... --key KEY
+                                  - one payload per recipient, each in its own set of blocks
+pvd recipients extract REF STEGO OUTPUT --key KEY --count N --index I
+                                  - writes the payload of recipient I (of N) to OUTPUT
+pvd recipients capacity IMAGE --key KEY --count N - prints the capacity of every set in bytes
+
+embed, extract and capacity take --frames for animated PNG and multi-page TIFF containers.
+"-" as SECRET is stdin, "-" as OUTPUT is stdout (a PNG image or the payload, written as it is
+decoded); messages then go to stderr. Exit code: 0 - done, 1 - failed, 2 - bad arguments
+
+PIL is imported by the subcommands, numpy only by "metrics" and "heatmap", skimage only by "metrics",
+so a shell loop over many files pays only for what it runs
+"""
+
+PVD_CLI_COMPRESSION = ['auto', 'none', 'zlib', 'lzma', 'bz2']
+# PVD_MAX_CHUNK_SIZE of pvd_lib, the chunk size field of the header is 4 bytes
+PVD_CLI_MAX_CHUNK_SIZE = (1 << 32) - 1
+
+
+def table_arg(value):
+    # range table by id or by name
+    return int(value) if value.isdigit() else value
+
+
+def chunk_size_arg(value):
+    chunk_size = int(value)
+    if not 1 <= chunk_size <= PVD_CLI_MAX_CHUNK_SIZE:
+        raise argparse.ArgumentTypeError("should be between 1 and {}: {}".format(PVD_CLI_MAX_CHUNK_SIZE, chunk_size))
+    return chunk_size
+
+
+def stream_arg(path, stream):
+    # "-" is the binary stdin / stdout
+    return getattr(stream, 'buffer', stream) if path == '-' else path
+
+
+def lib_options(args):
+    return {
+        'use_alpha': args.alpha,
+        'use_16bit': args.use_16bit,
+        'table': args.table,
+        'dense': args.dense,
+    }
+
+
+def cmd_embed(args):
+    compression = None if args.compression == 'none' else args.compression
+    if args.frames:
+        return embed_frames(args, compression)
+
+    from pvd_lib import pvd_lib
+
+    pvd = pvd_lib(compression, args.chunk_size, **lib_options(args))
+    embedded_bits = pvd.pvd_embed(args.cover, stream_arg(args.secret, args.stdin), stream_arg(args.output, args.stdout))
+    if not embedded_bits:
+        print("pvd: nothing embedded, see the error above", file=sys.stderr)
+        return 1
+    if args.verbose:
+        print("embedded bits: {}".format(embedded_bits))
+    return 0
+
+
+def embed_frames(args, compression):
+    from pvd_frames import pvd_frames
+
+    if args.chunk_size or any(lib_options(args).values()):
+        raise ValueError("--frames embeds with the default lanes, without chunks")
+    embedded = pvd_frames(compression=compression).embed(args.cover, stream_arg(args.secret, args.stdin),
+        stream_arg(args.output, args.stdout))
+    for frame_idx, embedded_bits in embedded:
+        if args.verbose:
+            print("frame {}: embedded bits: {}".format(frame_idx, embedded_bits))
+    return 0
+
+
+def cmd_extract(args):
+    if args.frames:
+        from pvd_frames import pvd_frames
+
+        size = pvd_frames().extract(args.ref, args.stego, stream_arg(args.output, args.stdout))
+        if args.verbose:
+            print("extracted bytes: {}".format(size))
+        return 0
+
+    from pvd_lib import pvd_lib
+
+    embedded_bits = pvd_lib().pvd_extract(args.ref, stream_arg(args.output, args.stdout), args.stego)
+    if embedded_bits is None or embedded_bits <= 0:
+        print("pvd: no payload found in {}".format(args.stego), file=sys.stderr)
+        return 1
+    if args.verbose:
+        print("extracted bits: {}".format(embedded_bits))
+    return 0
+
+
+def cmd_update(args):
+    from pvd_lib import pvd_lib
+
+    compression = None if args.compression == 'none' else args.compression
+    result = pvd_lib(compression).update_payload(args.ref, args.stego, stream_arg(args.secret, args.stdin),
+        stream_arg(args.output, args.stdout))
+    if args.verbose:
+        print("blocks touched: {} of {}, bytes changed: {}".format(*result))
+    return 0
+
+
+def cmd_capacity(args):
+    if args.frames:
+        from pvd_frames import pvd_frames
+
+        capacities = pvd_frames().capacity(args.image)
+        print(pvd_frames.payload_capacity(capacities))
+        return 0
+
+    from pvd_lib import pvd_lib
+
+    pvd = pvd_lib(**lib_options(args))
+    lanes = pvd._lanes(args.image)
+    if args.estimate:
+        estimate = pvd_lib._estimate_capacity(args.image, lanes, args.fraction) if lanes else None
+        print("{} {} {}".format(*estimate[:3]) if estimate else "0 0 0")
+        return 0
+    print(pvd_lib._embed_capacity(args.image, lanes) if lanes else 0)
+    return 0
+
+
+def cmd_metrics(args):
+    from pvd_metrics import PVDSteganographyAnalyzer
+
+    analyzer = PVDSteganographyAnalyzer()
+    try:
+        quality = analyzer.calculate_quality_metrics(args.original, args.stego)
+    except ImportError as e:
+        print("pvd: metrics need the [metrics] extra (numpy, scikit-image): {}".format(e), file=sys.stderr)
+        return 1
+    interpretation = analyzer.interpret_metrics(quality)
+    for name in ('PSNR', 'MSE', 'RMSE', 'SSIM'):
+        print("{}: {:.6f} - {}".format(name, quality[name], interpretation[name + '_interpretation']))
+    return 0
+
+
+def cmd_heatmap(args):
+    try:
+        from pvd_heatmap import pvd_capacity_map
+
+        capacity_map = pvd_capacity_map.from_image(args.image, **lib_options(args))
+    except ImportError as e:
+        print("pvd: heatmap needs numpy: {}".format(e), file=sys.stderr)
+        return 1
+
+    print(capacity_map.capacity)
+    for region in args.region:
+        print("{} {} {} {} {}".format(*region, capacity_map.region_capacity(*region)))
+    if args.png:
+        capacity_map.save_png(args.png, args.scale)
+    if args.npy:
+        capacity_map.save_npy(args.npy)
+    if args.sums:
+        with open(args.sums, 'w') as f:
+            f.write("axis,index,bits\n")
+            for axis, sums in (('row', capacity_map.row_sums()), ('col', capacity_map.col_sums())):
+                for index, bits in enumerate(sums):
+                    f.write("{},{},{}\n".format(axis, index, bits))
+    return 0
+
+
+def cmd_library_scan(args):
+    from pvd_library import pvd_library
+
+    with pvd_library(args.directory, args.db, args.workers, **lib_options(args)) as library:
+        result = library.scan()
+    print("added: {} updated: {} unchanged: {} removed: {}".format(*result))
+    return 0
+
+
+def cmd_library_best(args):
+    from pvd_library import pvd_library
+
+    with pvd_library(args.directory, args.db, **lib_options(args)) as library:
+        covers = library.best(args.size, args.order, args.limit)
+    if not covers:
+        print("pvd: no indexed cover fits {} bytes".format(args.size), file=sys.stderr)
+        return 1
+    for cover in covers:
+        print("{}\t{}x{}\t{}\t{}\t{:.4f}".format(cover.path, cover.width, cover.height, cover.mode,
+            cover.payload_capacity, cover.expected_mse))
+    return 0
+
+
+def cmd_recipients_embed(args):
+    from pvd_recipients import pvd_recipients
+
+    compression = None if args.compression == 'none' else args.compression
+    embedded_bits = pvd_recipients(compression, args.chunk_size, **lib_options(args)).embed(args.cover,
+        args.secrets, stream_arg(args.output, args.stdout), args.key)
+    if args.verbose:
+        print("embedded bits: {}".format(' '.join(str(bits) for bits in embedded_bits)))
+    return 0
+
+
+def cmd_recipients_extract(args):
+    from pvd_recipients import pvd_recipients
+
+    embedded_bits = pvd_recipients(**lib_options(args)).extract(args.ref, args.stego,
+        stream_arg(args.output, args.stdout), args.key, args.count, args.index)
+    if args.verbose:
+        print("extracted bits: {}".format(embedded_bits))
+    return 0
+
+
+def cmd_recipients_capacity(args):
+    from pvd_recipients import pvd_recipients
+
+    print(' '.join(str(cap) for cap in pvd_recipients(**lib_options(args)).capacity(args.image, args.key, args.count)))
+    return 0
+
+
+def add_frames_option(parser):
+    parser.add_argument('--frames', action='store_true', help="all frames of an animated PNG or a multi-page TIFF")
+
+
+def add_lane_options(parser):
+    parser.add_argument('--alpha', action='store_true', help="embed into the alpha channel too")
+    parser.add_argument('--16bit', dest='use_16bit', action='store_true', help="use 16-bit samples")
+    parser.add_argument('--table', type=table_arg, default=None, help="range table id or name (pvd, wu_tsai, ...)")
+    parser.add_argument('--dense', action='store_true', help="use all 8 neighbours of every block")
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog='pvd', description="PVD steganography")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    embed = subparsers.add_parser('embed', help="hide a file in an image")
+    embed.add_argument('cover')
+    embed.add_argument('secret', help='"-" - stdin')
+    embed.add_argument('output', help='"-" - stdout (PNG)')
+    embed.add_argument('--compression', choices=PVD_CLI_COMPRESSION, default='auto')
+    embed.add_argument('--chunk-size', type=chunk_size_arg, default=None, help="CRC-checked chunks of this size")
+    embed.add_argument('-v', '--verbose', action='store_true')
+    add_lane_options(embed)
+    add_frames_option(embed)
+    embed.set_defaults(func=cmd_embed)
+
+    extract = subparsers.add_parser('extract', help="extract a hidden file")
+    extract.add_argument('ref', help="original (reference) image")
+    extract.add_argument('stego')
+    extract.add_argument('output', help='"-" - stdout')
+    extract.add_argument('-v', '--verbose', action='store_true')
+    add_frames_option(extract)
+    extract.set_defaults(func=cmd_extract)
+
+    update = subparsers.add_parser('update', help="replace a hidden file, rewriting only the changed blocks")
+    update.add_argument('ref', help="original (reference) image")
+    update.add_argument('stego')
+    update.add_argument('secret', help='"-" - stdin')
+    update.add_argument('output', help='"-" - stdout (PNG)')
+    update.add_argument('--compression', choices=PVD_CLI_COMPRESSION + ['keep'], default='keep',
+        help="keep - the codec of the replaced payload, so a small edit changes only a part of the body")
+    update.add_argument('-v', '--verbose', action='store_true')
+    update.set_defaults(func=cmd_update)
+
+    capacity = subparsers.add_parser('capacity', help="print the embedding capacity in bytes")
+    capacity.add_argument('image')
+    capacity.add_argument('--estimate', action='store_true', help="estimate from a sample of blocks (fast on huge images)")
+    capacity.add_argument('--fraction', type=float, default=0.01, help="share of blocks to sample with --estimate")
+    add_lane_options(capacity)
+    add_frames_option(capacity)
+    capacity.set_defaults(func=cmd_capacity)
+
+    metrics = subparsers.add_parser('metrics', help="image quality of a stego image (needs numpy, scikit-image)")
+    metrics.add_argument('original')
+    metrics.add_argument('stego')
+    metrics.set_defaults(func=cmd_metrics)
+
+    heatmap = subparsers.add_parser('heatmap', help="capacity of every 3x3 block and of regions (needs numpy)")
+    heatmap.add_argument('image')
+    heatmap.add_argument('--region', type=int, nargs=4, action='append', default=[], metavar=('X0', 'Y0', 'X1', 'Y1'),
+        help="prints the capacity in bytes of the blocks inside X0 <= x < X1, Y0 <= y < Y1")
+    heatmap.add_argument('--png', default=None, help="heatmap image")
+    heatmap.add_argument('--scale', type=int, default=3, help="pixels per block in the heatmap image")
+    heatmap.add_argument('--npy', default=None, help="bits per block as a numpy array (block rows x block columns)")
+    heatmap.add_argument('--sums', default=None, help="CSV of the bits per block row and per block column")
+    add_lane_options(heatmap)
+    heatmap.set_defaults(func=cmd_heatmap)
+
+    library = subparsers.add_parser('library', help="index of the covers of a directory")
+    library_commands = library.add_subparsers(dest='library_command', required=True)
+
+    scan = library_commands.add_parser('scan', help="index new and changed covers")
+    scan.add_argument('directory')
+    scan.add_argument('--db', default=None, help="index file (DIR/.pvd_library.sqlite by default)")
+    scan.add_argument('--workers', type=int, default=None)
+    add_lane_options(scan)
+    scan.set_defaults(func=cmd_library_scan)
+
+    best = library_commands.add_parser('best', help="covers a payload fits into: path, size, mode, free bytes, expected MSE")
+    best.add_argument('directory')
+    best.add_argument('size', type=int, help="payload size in bytes")
+    best.add_argument('--db', default=None)
+    best.add_argument('--order', choices=['smallest', 'distortion'], default='smallest')
+    best.add_argument('-n', '--limit', type=int, default=5)
+    add_lane_options(best)
+    best.set_defaults(func=cmd_library_best)
+
+    recipients = subparsers.add_parser('recipients', help="one cover, a payload per recipient in disjoint block sets")
+    recipients_commands = recipients.add_subparsers(dest='recipients_command', required=True)
+
+    r_embed = recipients_commands.add_parser('embed', help="hide one file per recipient in a single pass")
+    r_embed.add_argument('cover')
+    r_embed.add_argument('output', help='"-" - stdout (PNG)')
+    r_embed.add_argument('secrets', nargs='+', help="a file per recipient, recipient I gets the I-th (from 0)")
+    r_embed.add_argument('--key', required=True, help="key the blocks are split with")
+    r_embed.add_argument('--compression', choices=PVD_CLI_COMPRESSION, default='auto')
+    r_embed.add_argument('--chunk-size', type=chunk_size_arg, default=None, help="CRC-checked chunks of this size")
+    r_embed.add_argument('-v', '--verbose', action='store_true')
+    add_lane_options(r_embed)
+    r_embed.set_defaults(func=cmd_recipients_embed)
+
+    r_extract = recipients_commands.add_parser('extract', help="extract the file of one recipient")
+    r_extract.add_argument('ref', help="original (reference) image")
+    r_extract.add_argument('stego')
+    r_extract.add_argument('output', help='"-" - stdout')
+    r_extract.add_argument('--key', required=True)
+    r_extract.add_argument('--count', type=int, required=True, help="number of recipients")
+    r_extract.add_argument('--index', type=int, required=True, help="recipient, from 0")
+    r_extract.add_argument('-v', '--verbose', action='store_true')
+    add_lane_options(r_extract)
+    r_extract.set_defaults(func=cmd_recipients_extract)
+
+    r_capacity = recipients_commands.add_parser('capacity', help="print the capacity of every set in bytes")
+    r_capacity.add_argument('image')
+    r_capacity.add_argument('--key', required=True)
+    r_capacity.add_argument('--count', type=int, required=True, help="number of recipients")
+    add_lane_options(r_capacity)
+    r_capacity.set_defaults(func=cmd_recipients_capacity)
+
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    args.stdin = sys.stdin
+    args.stdout = sys.stdout
+
+    # with the image or the payload on stdout every message (also of the library) goes to stderr
+    quiet_stdout = getattr(args, 'output', None) == '-'
+    try:
+        with contextlib.redirect_stdout(sys.stderr) if quiet_stdout else contextlib.nullcontext():
+            return args.func(args)
+    except BrokenPipeError:
+        # the reader went away (| head), the interpreter should not fail flushing stdout at exit
+        os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+        print("pvd: output pipe closed", file=sys.stderr)
+        return 1
+    except (OSError, ValueError) as e:
+        print("pvd: {}".format(e), file=sys.stderr)
+        return 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,162 @@
+import collections
+import concurrent.futures
+import itertools
+import multiprocessing
+import os
+import threading
+from pvd_lib import pvd_lib, pvd_cancel_token, pvd_progress_info
+
+
+class executor_full(Exception):
+    pass
+
+
+def _run_job(kind, args, options, progress_state, job_id, cancel_event):
+    # runs in a worker process, progress goes back through the manager dict
+
+    def on_progress(info):
+        progress_state[job_id] = tuple(info)
+
+    pvd = pvd_lib(**options)
+    cancel = pvd_cancel_token(cancel_event)
+    try:
+        if kind == 'embed':
+            return pvd.pvd_embed(*args, progress=on_progress, cancel=cancel)
+        elif kind == 'extract':
+            return pvd.pvd_extract(*args, progress=on_progress, cancel=cancel)
+        elif kind == 'capacity':
+            return pvd_lib._embed_capacity(*args)
+        raise ValueError("Unknown job: {}".format(kind))
+    finally:
+        progress_state.pop(job_id, None)
+
+
+class pvd_job:
+
+    def __init__(self, executor, user, job_id, kind, args, options, cancel_event):
+        self.executor = executor
+        self.user = user
+        self.job_id = job_id
+        self.kind = kind
+        self.args = args
+        self.options = options
+        self.cancel_event = cancel_event
+        self.future = concurrent.futures.Future()
+
+    def cancel(self):
+        # a queued job is dropped, a running one stops at the next block row
+        self.cancel_event.set()
+        self.future.cancel()
+
+    def progress(self):
+        state = self.executor.progress_state.get(self.job_id)
+        return pvd_progress_info(*state) if state else None
+
+    def result(self, timeout=None):
+        return self.future.result(timeout)
+
+
+class fair_executor:
+    """
+    Process pool shared by all users (sessions). Jobs wait in per-user queues, a free worker
+    takes the next job of the user with the fewest running jobs (round robin between equals),
+    so one user with many uploads does not block the others. The number of waiting jobs is
+    bounded overall and per user.
+    """
+
+    def __init__(self, workers=None, max_pending=None, max_pending_per_user=2):
+        self.workers = workers or os.cpu_count() or 1
+        self.max_pending = self.workers * 4 if max_pending is None else max_pending
+        self.max_pending_per_user = max_pending_per_user
+
+        # the apps run in a threaded server, spawn is safer than fork there
+        mp_context = multiprocessing.get_context('spawn')
+        self.pool = concurrent.futures.ProcessPoolExecutor(self.workers, mp_context=mp_context)
+        self.manager = mp_context.Manager()
+        self.progress_state = self.manager.dict()
+
+        self.lock = threading.Lock()
+        self.queues = collections.OrderedDict()
+        self.pending_per_user = collections.Counter()
+        self.running_per_user = collections.Counter()
+        self.pending = 0
+        self.running = 0
+        self.job_ids = itertools.count()
+
+    def submit(self, user, kind, *args, **options):
+        with self.lock:
+            if self.pending >= self.max_pending:
+                raise executor_full("Too many jobs: {}".format(self.pending))
+            if self.pending_per_user[user] >= self.max_pending_per_user:
+                raise executor_full("Too many jobs of this user: {}".format(self.pending_per_user[user]))
+
+            job = pvd_job(self, user, next(self.job_ids), kind, args, options, self.manager.Event())
+            self.queues.setdefault(user, collections.deque()).append(job)
+            self.pending += 1
+            self.pending_per_user[user] += 1
+            started = self._dispatch()
+        self._watch(started)
+        return job
+
+    def stats(self):
+        with self.lock:
+            return {'workers': self.workers, 'running': self.running, 'pending': self.pending,
+                    'users': len(self.pending_per_user)}
+
+    def _dispatch(self):
+        # called with self.lock held, returns [(job, inner future)] of the started jobs;
+        # their callbacks are added by _watch after the lock is released
+        started = []
+        while self.running < self.workers and self.queues:
+            # users with fewer running jobs first, round robin between equals
+            user = min(self.queues, key=lambda u: self.running_per_user[u])
+            queue = self.queues.pop(user)
+            job = queue.popleft()
+            if queue:
+                # the user goes to the end of the line
+                self.queues[user] = queue
+
+            if not job.future.set_running_or_notify_cancel():
+                self._finished(job)
+                continue
+
+            self.running += 1
+            self.running_per_user[user] += 1
+            inner = self.pool.submit(_run_job, job.kind, job.args, job.options,
+                self.progress_state, job.job_id, job.cancel_event)
+            started.append((job, inner))
+        return started
+
+    def _watch(self, started):
+        # a future that is already done runs its callback right here, so self.lock must not be held
+        for job, inner in started:
+            inner.add_done_callback(lambda inner, job=job: self._on_done(job, inner))
+
+    def _finished(self, job):
+        self.pending -= 1
+        self.pending_per_user[job.user] -= 1
+        if self.pending_per_user[job.user] <= 0:
+            del self.pending_per_user[job.user]
+
+    def _on_done(self, job, inner):
+        with self.lock:
+            self.running -= 1
+            self.running_per_user[job.user] -= 1
+            if self.running_per_user[job.user] <= 0:
+                del self.running_per_user[job.user]
+            if job.user in self.queues:
+                self.queues.move_to_end(job.user)
+            self._finished(job)
+            started = self._dispatch()
+        self._watch(started)
+
+        if inner.cancelled():
+            job.future.set_exception(concurrent.futures.CancelledError())
+        elif inner.exception() is not None:
+            job.future.set_exception(inner.exception())
+        else:
+            job.future.set_result(inner.result())
+
+    def shutdown(self):
+        self.pool.shutdown(cancel_futures=True)
+        self.manager.shutdown()
@@ -0,0 +1,202 @@
+import concurrent.futures
+import hashlib
+import os
+import tempfile
+from PIL import Image, ImageSequence
+from PIL.PngImagePlugin import Blend, Disposal
+from pvd_lib import pvd_lib, PVD_COMPRESSION_AUTO, PVD_BYTE_ORDER
+from pvd_shard import _embed_shard, _extract_shard, PVD_SHARD_HEADER_SIZE
+
+"""
+Multi-frame containers: an animated PNG or a multi-page TIFF is one carrier. The payload fills
+the frames in order, every frame used carries a shard header (frame sequence number, number of
+frames used, sha256 of the whole payload) and the size of its part, so the frame boundaries are
+in the frames themselves. Capacity and embedding run per frame on a process pool, extraction
+reads the frames one by one and stops after the last used frame.
+"""
+
+PVD_FRAME_FORMATS = {'PNG': '.png', 'TIFF': '.tiff'}
+PVD_TIFF_LOSSY = ('jpeg', 'webp')
+
+
+def _open_container(path):
+    img = Image.open(path)
+    if img.format not in PVD_FRAME_FORMATS:
+        img.close()
+        raise ValueError("Not a PNG or TIFF container: {}".format(path))
+    if img.format == 'TIFF' and img.info.get('compression') in PVD_TIFF_LOSSY:
+        img.close()
+        raise ValueError("Lossy TIFF compression: {}".format(img.info.get('compression')))
+    return img
+
+
+def _frame_file(frame, directory, name, suffix):
+    path = os.path.join(directory, name + suffix)
+    frame.save(path)
+    return path
+
+
+class pvd_frames:
+
+    def __init__(self, max_workers=None, compression=PVD_COMPRESSION_AUTO):
+        pvd_lib.check_options(compression)
+        self.max_workers = max_workers
+        self.compression = compression
+
+    @staticmethod
+    def plan(capacities, payload_size):
+        # [(frame index, start, end)] - the payload fills the frames in order,
+        # frames that can not hold a shard header are left out
+        shards = []
+        start = 0
+        for frame_idx, cap in enumerate(capacities):
+            usable = cap - PVD_SHARD_HEADER_SIZE
+            if usable < 0 or (usable == 0 and payload_size > 0):
+                continue
+            end = start + min(usable, payload_size - start)
+            shards.append((frame_idx, start, end))
+            start = end
+            if start == payload_size:
+                return shards
+
+        raise ValueError("Secret file size is more than embedding capacity of all frames - " \
+            "Embedding capacity: {} bytes, Secret file size: {} bytes".format(
+                pvd_frames.payload_capacity(capacities), payload_size))
+
+    @staticmethod
+    def payload_capacity(capacities):
+        # bytes of payload the frames hold together, without their shard headers
+        return sum(max(0, cap - PVD_SHARD_HEADER_SIZE) for cap in capacities)
+
+    def capacity(self, container_path):
+        # embedding capacity of every frame in bytes
+        with tempfile.TemporaryDirectory() as tmp_dir, _open_container(container_path) as img:
+            suffix = PVD_FRAME_FORMATS[img.format]
+            frame_paths = [_frame_file(frame, tmp_dir, str(frame_idx), suffix)
+                for frame_idx, frame in enumerate(ImageSequence.Iterator(img))]
+            with concurrent.futures.ProcessPoolExecutor(self.max_workers) as executor:
+                return list(executor.map(pvd_lib._embed_capacity, frame_paths))
+
+    def embed(self, container_path, secret_file_path, op_path):
+        # [(frame index, embedded bits)] of the frames used
+        if hasattr(secret_file_path, 'read'):
+            data = secret_file_path.read()
+        else:
+            with open(secret_file_path, "rb") as f:
+                data = f.read()
+        payload_hash = int.from_bytes(hashlib.sha256(data).digest(), PVD_BYTE_ORDER)
+
+        with tempfile.TemporaryDirectory() as tmp_dir, _open_container(container_path) as img:
+            container_format = img.format
+            suffix = PVD_FRAME_FORMATS[container_format]
+            frame_paths = []
+            durations = []
+            for frame_idx, frame in enumerate(ImageSequence.Iterator(img)):
+                frame_paths.append(_frame_file(frame, tmp_dir, str(frame_idx), suffix))
+                durations.append(frame.info.get('duration'))
+            info = dict(img.info)
+
+            with concurrent.futures.ProcessPoolExecutor(self.max_workers) as executor:
+                capacities = list(executor.map(pvd_lib._embed_capacity, frame_paths))
+                shards = pvd_frames.plan(capacities, len(data))
+
+                futures = []
+                for seq, (frame_idx, start, end) in enumerate(shards):
+                    stego_path = os.path.join(tmp_dir, 'stego_{}{}'.format(frame_idx, suffix))
+                    futures.append(executor.submit(_embed_shard, frame_paths[frame_idx], stego_path,
+                        data[start:end], (seq, len(shards), payload_hash), self.compression))
+
+                embedded_ds = []
+                for (frame_idx, _, _), future in zip(shards, futures):
+                    bits = future.result()
+                    if not bits:
+                        raise ValueError("Embedding into frame {} failed".format(frame_idx))
+                    frame_paths[frame_idx] = os.path.join(tmp_dir, 'stego_{}{}'.format(frame_idx, suffix))
+                    embedded_ds.append((frame_idx, bits))
+
+            frames = []
+            for path in frame_paths:
+                with Image.open(path) as frame:
+                    frames.append(frame.copy())
+            pvd_frames._save_container(frames, op_path, container_format, durations, info)
+
+        return embedded_ds
+
+    @staticmethod
+    def _save_container(frames, op_path, container_format, durations, info):
+        options = {'format': container_format, 'save_all': True, 'append_images': frames[1:]}
+        if container_format == 'PNG':
+            # the frames are whole pictures now: every frame replaces the canvas (blend source),
+            # the disposal alternates so that identical neighbours are not merged into one frame
+            options['loop'] = info.get('loop', 0)
+            options['blend'] = Blend.OP_SOURCE
+            options['disposal'] = [Disposal.OP_NONE if idx % 2 == 0 else Disposal.OP_BACKGROUND
+                for idx in range(len(frames))]
+            if all(duration is not None for duration in durations):
+                options['duration'] = durations
+        else:
+            options['compression'] = info.get('compression', 'raw')
+        for name in ('dpi', 'icc_profile'):
+            if name in info:
+                options[name] = info[name]
+        frames[0].save(op_path, **options)
+
+    def extract(self, ref_container_path, pvd_container_path, secret_op_file):
+        # frame by frame: every part is written as soon as its frame is read,
+        # secret_op_file is a path or a binary stream
+        shard_total = None
+        payload_hash = None
+        next_seq = 0
+        digest = hashlib.sha256()
+        size = 0
+
+        with tempfile.TemporaryDirectory() as tmp_dir, \
+                _open_container(ref_container_path) as ref_img, _open_container(pvd_container_path) as pvd_img:
+            if getattr(ref_img, 'n_frames', 1) != getattr(pvd_img, 'n_frames', 1) or ref_img.size != pvd_img.size:
+                raise ValueError("Ref vs embedded container not matching")
+            suffix = PVD_FRAME_FORMATS[ref_img.format]
+
+            # a stream (stdout) gets every part as its frame is read and is left open
+            stream = hasattr(secret_op_file, 'write')
+            f = secret_op_file if stream else open(secret_op_file, "wb")
+            try:
+                try:
+                    for frame_idx, (ref_frame, pvd_frame) in enumerate(zip(ImageSequence.Iterator(ref_img),
+                            ImageSequence.Iterator(pvd_img))):
+                        ref_path = _frame_file(ref_frame, tmp_dir, 'ref', suffix)
+                        pvd_path = _frame_file(pvd_frame, tmp_dir, 'pvd', suffix)
+                        try:
+                            header = pvd_lib().read_header(ref_path, pvd_path)
+                        except ValueError:
+                            # a frame too small to hold a shard; errors of a frame with a shard header
+                            # (corrupted chunk, truncated payload) are not skipped
+                            continue
+                        seq, total, s_hash, data = _extract_shard(ref_path, pvd_path, header)
+
+                        if shard_total is None:
+                            shard_total, payload_hash = total, s_hash
+                        if total != shard_total or s_hash != payload_hash or seq != next_seq:
+                            raise ValueError("Frame {} holds shard {} of another payload".format(frame_idx, seq))
+
+                        f.write(data)
+                        if stream:
+                            f.flush()
+                        digest.update(data)
+                        size += len(data)
+                        next_seq += 1
+                        if next_seq == shard_total:
+                            break
+                finally:
+                    if not stream:
+                        f.close()
+
+                if shard_total is None or next_seq != shard_total:
+                    raise ValueError("Missing frames: {} of {} found".format(next_seq, shard_total or 0))
+                if int.from_bytes(digest.digest(), PVD_BYTE_ORDER) != payload_hash:
+                    raise ValueError("Payload hash mismatch")
+            except BaseException:
+                if not stream and os.path.exists(secret_op_file):
+                    os.remove(secret_op_file)
+                raise
+
+        return size
@@ -0,0 +1,116 @@
+from PIL import Image
+from pvd_lib import pvd_lanes, PVD_BYTES_TO_BITS
+
+"""
+Capacity map of a cover: the bits every 3x3 block carries, laid out as the blocks are in the image
+(row - block row, column - block column), computed in one numpy pass over all blocks. A summed-area
+table over the map answers the capacity of any rectangle in O(1), so crops can be planned without
+rescanning the image.
+
+numpy is imported inside the functions that need it, like in pvd_metrics.py
+"""
+
+
+class pvd_capacity_map:
+
+    def __init__(self, bits, lanes):
+        import numpy as np
+
+        # bits[block_row, block_col], block (r, c) covers the pixels x 3c..3c+2, y 3r..3r+2
+        self.bits = bits
+        self.lanes = lanes
+        self.sat = np.zeros((bits.shape[0] + 1, bits.shape[1] + 1), dtype=np.int64)
+        np.cumsum(np.cumsum(bits, axis=0), axis=1, out=self.sat[1:, 1:])
+
+    @staticmethod
+    def from_image(image, use_alpha=False, use_16bit=False, table=None, dense=False):
+        # image is a path, a file object or a PIL image
+        if isinstance(image, Image.Image):
+            return pvd_capacity_map._from_image(image, use_alpha, use_16bit, table, dense)
+        with Image.open(image) as img_obj:
+            return pvd_capacity_map._from_image(img_obj, use_alpha, use_16bit, table, dense)
+
+    @staticmethod
+    def _from_image(img_obj, use_alpha, use_16bit, table, dense):
+        import numpy as np
+
+        lanes = pvd_lanes.for_image(img_obj, use_alpha, use_16bit, table, dense)
+        if lanes is None:
+            raise ValueError("Image has no channels to carry data: {}".format(img_obj.mode))
+
+        # the legacy layout goes column by column, the dense one row by row
+        no_of_matrix_outer, no_of_matrix_inner = lanes.block_grid(img_obj.size)
+        if lanes.dense:
+            block_rows, block_cols = no_of_matrix_outer, no_of_matrix_inner
+        else:
+            block_cols, block_rows = no_of_matrix_outer, no_of_matrix_inner
+        block_rows, block_cols = max(0, block_rows), max(0, block_cols)
+
+        samples = np.asarray(img_obj)
+        if samples.ndim == 2:
+            samples = samples[:, :, np.newaxis]
+        samples = samples[:block_rows * 3, :block_cols * 3, :lanes.channels].astype(np.int32)
+        # [block row, y in block, block col, x in block, channel]
+        blocks = samples.reshape(block_rows, 3, block_cols, 3, lanes.channels)
+
+        lut = np.asarray(lanes.lut, dtype=np.int64)
+        centre = blocks[:, 1, :, 1, :]
+        bits = np.zeros((block_rows, block_cols), dtype=np.int64)
+        for d_x, d_y in lanes.offsets:
+            bits += lut[np.abs(blocks[:, d_y, :, d_x, :] - centre)].sum(axis=-1)
+        return pvd_capacity_map(bits, lanes)
+
+    @property
+    def total_bits(self):
+        return int(self.sat[-1, -1])
+
+    @property
+    def capacity(self):
+        # embedding capacity in bytes, the same as pvd_lib._embed_capacity
+        return self.total_bits // PVD_BYTES_TO_BITS
+
+    def row_sums(self):
+        # bits per block row (top to bottom)
+        return self.bits.sum(axis=1)
+
+    def col_sums(self):
+        # bits per block column (left to right)
+        return self.bits.sum(axis=0)
+
+    def region_bits(self, x0, y0, x1, y1):
+        # bits of the blocks lying wholly inside the pixels x0 <= x < x1, y0 <= y < y1;
+        # that is the capacity of the crop when x0 and y0 are multiples of 3 (for the legacy
+        # layout the last block row and column of the crop are not used, as in any image)
+        rows, cols = self.bits.shape
+        c0 = min(cols, max(0, -(-x0 // 3)))
+        r0 = min(rows, max(0, -(-y0 // 3)))
+        c1 = min(cols, max(c0, x1 // 3))
+        r1 = min(rows, max(r0, y1 // 3))
+        sat = self.sat
+        return int(sat[r1, c1] - sat[r0, c1] - sat[r1, c0] + sat[r0, c0])
+
+    def region_capacity(self, x0, y0, x1, y1):
+        # the same in bytes
+        return self.region_bits(x0, y0, x1, y1) // PVD_BYTES_TO_BITS
+
+    def to_image(self, scale=3):
+        # heatmap, black (no bits) - red - yellow - white (the most bits of a block), every block
+        # is scale x scale pixels, with scale 3 it lies over the cover
+        import numpy as np
+
+        top = max(1, int(self.bits.max())) if self.bits.size else 1
+        level = (self.bits * 255 // top).astype(np.uint8)
+        if scale > 1:
+            level = level.repeat(scale, axis=0).repeat(scale, axis=1)
+
+        t = np.arange(256) / 255
+        palette = np.stack([np.clip(3 * t, 0, 1), np.clip(3 * t - 1, 0, 1), np.clip(3 * t - 2, 0, 1)], axis=1)
+        return Image.fromarray((palette * 255).round().astype(np.uint8)[level])
+
+    def save_png(self, op_path, scale=3):
+        self.to_image(scale).save(op_path, format='PNG')
+
+    def save_npy(self, op_path):
+        import numpy as np
+
+        np.save(op_path, self.bits)
@@ -1,38 +1,646 @@
+import bisect
+import bz2
+import collections
+import itertools
+import lzma
+import math
 import os
+import random
+import statistics
+import threading
+import time
+import zlib
 from PIL import Image
 
 PVD_MAGIC = [1, 0, 1, 0]
 PVD_VERSION = [1, 0, 0]
+PVD_VERSION_EXT = [1, 1, 0]
 PVD_MAX_LENGTH_FIELD = 4
 PVD_HEADER_SIZE = 11
+PVD_FLAGS_SIZE = 2
 PVD_BYTES_TO_BITS = 8
 
 PVD_BYTE_ORDER = 'big'
 
+"""
+[magic 4][version 3][length 4]                         - PVD_VERSION, payload as is
+[magic 4][version 3][length 4][flags 2][fields...]     - PVD_VERSION_EXT
+length - number of bytes after the first PVD_HEADER_SIZE bytes
+"""
+PVD_FLAG_CODEC_MASK = 0x0003
+PVD_FLAG_CHUNKED = 0x0004
+PVD_FLAG_SHARD = 0x0008
+# pixel lanes - which samples carry data and in which order, the extractor tries the lanes the image allows
+PVD_FLAG_ALPHA = 0x0010
+PVD_FLAG_16BIT = 0x0020
+PVD_FLAG_TABLE = 0x0040
+PVD_FLAG_DENSE = 0x0080
+PVD_LANE_FLAGS = PVD_FLAG_ALPHA | PVD_FLAG_16BIT | PVD_FLAG_TABLE | PVD_FLAG_DENSE
+# tag of a recipient set, derived from the key, see pvd_recipients.py
+PVD_FLAG_SET_TAG = 0x0100
+
+# (flag, field name, field size) - fields follow the flags in this order when the flag is set
+PVD_EXT_FIELDS = [
+    (PVD_FLAG_CHUNKED, 'chunk_size', 4),
+    (PVD_FLAG_SHARD, 'shard_seq', 2),
+    (PVD_FLAG_SHARD, 'shard_total', 2),
+    (PVD_FLAG_SHARD, 'payload_hash', 32),
+    (PVD_FLAG_TABLE, 'table_id', 1),
+    (PVD_FLAG_SET_TAG, 'set_tag', 8),
+]
+
+PVD_CODEC_NONE = 0
+PVD_CODEC_ZLIB = 1
+PVD_CODEC_LZMA = 2
+PVD_CODEC_BZ2 = 3
+
+PVD_COMPRESSION_AUTO = 'auto'
+# update_payload only: the codec of the payload that is replaced
+PVD_COMPRESSION_KEEP = 'keep'
+PVD_CODECS = {
+    None: PVD_CODEC_NONE,
+    'none': PVD_CODEC_NONE,
+    'zlib': PVD_CODEC_ZLIB,
+    'lzma': PVD_CODEC_LZMA,
+    'bz2': PVD_CODEC_BZ2,
+}
+PVD_CODEC_NAMES = {codec: name for name, codec in PVD_CODECS.items() if name != 'none'}
+PVD_LZMA_FILTERS = [{"id": lzma.FILTER_LZMA2, "preset": 6}]
+
+PVD_WRITE_CHUNK = 1 << 16
+
+PVD_CRC_SIZE = 4
+PVD_DEFAULT_CHUNK_SIZE = 4096
+# the chunk size field of the header is 4 bytes
+PVD_MAX_CHUNK_SIZE = (1 << 32) - 1
+
+# Pillow keeps 16 bits per sample only for single channel images
+PVD_16BIT_MODES = ('I;16', 'I;16B', 'I;16L')
+PVD_ALPHA_CHANNEL = 3
+PVD_SAMPLE_VALUES = 1 << 8
+PVD_SAMPLE_VALUES_16 = 1 << 16
+
+"""
+(x, y) offsets of the pixels carrying data in a 3x3 block, the centre one is the reference
+[1 2 3]
+[4 - 5]
+[6 7 8]
+"""
+PVD_CORNER_OFFSETS = [(0, 0), (0, 2), (2, 0), (2, 2)]
+PVD_DENSE_OFFSETS = [(0, 0), (1, 0), (2, 0), (0, 1), (2, 1), (0, 2), (1, 2), (2, 2)]
+
+# ids below PVD_USER_TABLE_ID are reserved for the tables defined here
+PVD_USER_TABLE_ID = 128
+PVD_RANGE_TABLES = {}
+
+PVD_CAPACITY_CACHE_SIZE = 256
+
+# capacity estimate: a random sample of blocks from every cell of a PVD_ESTIMATE_STRATA x PVD_ESTIMATE_STRATA grid
+PVD_ESTIMATE_FRACTION = 0.01
+PVD_ESTIMATE_MAX_BLOCKS = 4096
+PVD_ESTIMATE_STRATA = 16
+PVD_ESTIMATE_MIN_PER_STRATUM = 2
+PVD_ESTIMATE_CONFIDENCE = 0.95
+
+pvd_progress_info = collections.namedtuple('pvd_progress_info',
+    ['blocks_done', 'blocks_total', 'bits_done', 'bits_total', 'elapsed', 'eta'])
+
+pvd_update_result = collections.namedtuple('pvd_update_result', ['blocks_touched', 'blocks_used', 'bytes_changed'])
+
+class pvd_capacity_estimate(collections.namedtuple('pvd_capacity_estimate',
+        ['capacity', 'low', 'high', 'blocks_sampled', 'blocks_total', 'exact'])):
+    # capacity in bytes with the [low, high] confidence interval
+
+    def fits(self, total_bytes):
+        # True / False when the interval decides it, None when the exact capacity is needed
+        if total_bytes <= self.low:
+            return True
+        if total_bytes > self.high:
+            return False
+        return None
+
+class pvd_cancelled(Exception):
+    pass
+
+class pvd_stream_ended(ValueError):
+    # the image holds fewer bits than asked for
+    pass
+
+class pvd_cancel_token:
+    # any event with set() / is_set() works, e.g. multiprocessing.Manager().Event() for worker processes
+
+    def __init__(self, event=None):
+        self.event = event if event is not None else threading.Event()
+
+    def cancel(self):
+        self.event.set()
+
+    @property
+    def cancelled(self):
+        return self.event.is_set()
+
+class pvd_progress:
+    # called once per block row: checks the cancel token and reports progress
+
+    def __init__(self, callback, cancel, blocks_total, bits_total=None):
+        self.callback = callback
+        self.cancel = cancel
+        self.blocks_total = blocks_total
+        self.bits_total = bits_total
+        self.started = time.perf_counter()
+
+    def step(self, blocks_done, bits_done):
+        if self.cancel is not None and self.cancel.cancelled:
+            raise pvd_cancelled("Operation cancelled after {} blocks".format(blocks_done))
+
+        if self.callback is None:
+            return
+
+        elapsed = time.perf_counter() - self.started
+        eta = None
+        if self.bits_total and bits_done > 0:
+            eta = elapsed * max(0, self.bits_total - bits_done) / bits_done
+        self.callback(pvd_progress_info(blocks_done, self.blocks_total, bits_done, self.bits_total, elapsed, eta))
+
+class pvd_codec:
+
+    @staticmethod
+    def compress(codec, data):
+        if codec == PVD_CODEC_ZLIB:
+            return zlib.compress(data, 9)
+        elif codec == PVD_CODEC_LZMA:
+            return lzma.compress(data, format=lzma.FORMAT_RAW, filters=PVD_LZMA_FILTERS)
+        elif codec == PVD_CODEC_BZ2:
+            return bz2.compress(data, 9)
+        return data
+
+    @staticmethod
+    def decompressor(codec):
+        if codec == PVD_CODEC_ZLIB:
+            return zlib.decompressobj()
+        elif codec == PVD_CODEC_LZMA:
+            return lzma.LZMADecompressor(format=lzma.FORMAT_RAW, filters=PVD_LZMA_FILTERS)
+        elif codec == PVD_CODEC_BZ2:
+            return bz2.BZ2Decompressor()
+        return None
+
+    @staticmethod
+    def choose(data, compression):
+        # returns (codec, body) - the smallest body, the raw payload if nothing shrinks it
+        if compression == PVD_COMPRESSION_AUTO:
+            candidates = [PVD_CODEC_ZLIB, PVD_CODEC_LZMA, PVD_CODEC_BZ2]
+        elif compression in PVD_CODECS:
+            candidates = [PVD_CODECS[compression]]
+        else:
+            raise ValueError("Unknown compression: {}".format(compression))
+
+        best_codec, best_body = PVD_CODEC_NONE, data
+        best_cost = len(data)
+        for codec in candidates:
+            if codec == PVD_CODEC_NONE:
+                continue
+            body = pvd_codec.compress(codec, data)
+            # the extended header costs PVD_FLAGS_SIZE bytes more than the legacy one
+            cost = len(body) + PVD_FLAGS_SIZE
+            if cost < best_cost or compression != PVD_COMPRESSION_AUTO:
+                best_codec, best_body, best_cost = codec, body, cost
+        return best_codec, best_body
+
+class pvd_chunks:
+    """
+    [chunk 0 data][crc32][chunk 1 data][crc32]...[last chunk data][crc32]
+    every chunk except the last one holds exactly chunk_size bytes
+    """
+
+    @staticmethod
+    def encode(data, chunk_size):
+        body = bytearray()
+        for pos in range(0, len(data), chunk_size):
+            chunk = data[pos:pos + chunk_size]
+            body += chunk
+            body += zlib.crc32(chunk).to_bytes(PVD_CRC_SIZE, PVD_BYTE_ORDER)
+        return bytes(body)
+
+    @staticmethod
+    def payload_size(body_size, chunk_size):
+        full_chunks, rest = divmod(body_size, chunk_size + PVD_CRC_SIZE)
+        return full_chunks * chunk_size + max(0, rest - PVD_CRC_SIZE)
+
+    @staticmethod
+    def body_range(offset, length, payload_size, chunk_size):
+        # body byte range [start, end) of the chunks holding payload bytes [offset, offset + length)
+        first_chunk = offset // chunk_size
+        last_chunk = (offset + length - 1) // chunk_size
+        start = first_chunk * (chunk_size + PVD_CRC_SIZE)
+        end = min((last_chunk + 1) * chunk_size, payload_size) + (last_chunk + 1) * PVD_CRC_SIZE
+        return first_chunk, start, end
+
+    @staticmethod
+    def verify(body, chunk_size, first_chunk=0):
+        data = bytearray()
+        for pos in range(0, len(body), chunk_size + PVD_CRC_SIZE):
+            # the last chunk may be shorter, its crc ends the body
+            end = min(pos + chunk_size, len(body) - PVD_CRC_SIZE)
+            chunk = body[pos:max(pos, end)]
+            crc = body[max(pos, end):end + PVD_CRC_SIZE]
+            if len(crc) != PVD_CRC_SIZE or zlib.crc32(chunk) != int.from_bytes(crc, PVD_BYTE_ORDER):
+                raise ValueError("Corrupted chunk: {}".format(first_chunk + pos // (chunk_size + PVD_CRC_SIZE)))
+            data += chunk
+        return bytes(data)
+
+class pvd_chunk_decoder:
+    # same interface as the decompressors: decompress() + eof
+
+    def __init__(self, chunk_size, body_size):
+        self.chunk_size = chunk_size
+        self.body_size = body_size
+        self.consumed = 0
+        self.chunks_done = 0
+        self.pending = b''
+        self.eof = body_size == 0
+
+    def decompress(self, data):
+        self.pending += data
+        self.consumed += len(data)
+
+        stride = self.chunk_size + PVD_CRC_SIZE
+        usable = len(self.pending) if self.consumed >= self.body_size else \
+            len(self.pending) - len(self.pending) % stride
+        out = pvd_chunks.verify(self.pending[:usable], self.chunk_size, self.chunks_done)
+
+        self.chunks_done += usable // stride
+        self.pending = self.pending[usable:]
+        self.eof = self.consumed >= self.body_size
+        return out
+
+class pvd_range_table:
+    """
+    ranges - (low, high, bits): a difference in low..high carries bits, the ranges go on from 0 without gaps
+    a difference above the last range carries the bits of the last range
+    """
+
+    def __init__(self, table_id, name, ranges):
+        if not 0 <= table_id <= 0xff:
+            raise ValueError("Table id should fit in a byte: {}".format(table_id))
+
+        expected_low = 0
+        for low, high, bits in ranges:
+            if low != expected_low or high < low:
+                raise ValueError("Ranges should go on from 0 without gaps: {}".format((low, high, bits)))
+            if bits > 8 or bits <= 0:
+                raise ValueError("Bits should be between 0 and 8 bits")
+            expected_low = high + 1
+        if not ranges:
+            raise ValueError("Table has no ranges")
+
+        self.table_id = table_id
+        self.name = name
+        self.ranges = [tuple(r) for r in ranges]
+        self.luts = {}
+        # bit width per 8-bit difference, for the scalar and the array engines
+        self.lut = self.compile(PVD_SAMPLE_VALUES)
+
+    def compile(self, size):
+        # bit width lookup list for differences 0..size-1
+        lut = self.luts.get(size)
+        if lut is None:
+            lut = []
+            for low, high, bits in self.ranges:
+                lut += [bits] * (min(high + 1, size) - len(lut))
+                if len(lut) >= size:
+                    break
+            lut += [self.ranges[-1][2]] * (size - len(lut))
+            self.luts[size] = lut
+        return lut
+
+    @staticmethod
+    def register(table):
+        # tables are found by id when extracting, so both sides should register the same table
+        if table.table_id in PVD_RANGE_TABLES and PVD_RANGE_TABLES[table.table_id].ranges != table.ranges:
+            raise ValueError("Table id is taken: {}".format(table.table_id))
+        PVD_RANGE_TABLES[table.table_id] = table
+        return table
+
+    @staticmethod
+    def get(table):
+        # a table, its id or its name
+        if isinstance(table, pvd_range_table):
+            return table
+        for registered in PVD_RANGE_TABLES.values():
+            if table in (registered.table_id, registered.name):
+                return registered
+        raise ValueError("Unknown range table: {}".format(table))
+
+# the original table of this project, a difference of exactly 16 carries 4 bits
+PVD_TABLE_PVD = pvd_range_table.register(pvd_range_table(0, 'pvd', [(0, 15, 2), (16, 16, 4), (17, 31, 3), (32, 255, 4)]))
+# Wu-Tsai ranges, bits = log2 of the range width
+PVD_TABLE_WU_TSAI = pvd_range_table.register(pvd_range_table(1, 'wu_tsai',
+    [(0, 7, 3), (8, 15, 3), (16, 31, 4), (32, 63, 5), (64, 127, 6), (128, 255, 7)]))
+# 16-bit samples: up to 8 bits, so a sample changes by less than one 8-bit level
+PVD_TABLE_PVD16 = pvd_range_table.register(pvd_range_table(2, 'pvd16', [(0, 4095, 6), (4096, 8191, 7), (8192, 65535, 8)]))
+
+class pvd_lanes:
+    """
+    flags 0                  - channels 0-2 of an 8-bit image (legacy)
+    PVD_FLAG_ALPHA           - channels 0-3, the alpha channel follows the same reference-difference rule
+    PVD_FLAG_16BIT           - the single 16-bit channel, with the wider range table
+    PVD_FLAG_TABLE           - a range table other than the default one, its id is in the header
+
+    layout, blocks are numbered in embedding order:
+    flags 0                  - the 4 corners of a block, blocks column by column, the last block row
+                               and column of the image are left out (legacy)
+    PVD_FLAG_DENSE           - all 8 neighbours of the centre, blocks and pixels row by row
+    """
+
+    def __init__(self, flags=0, table=None):
+        flags &= PVD_LANE_FLAGS
+        self.wide = bool(flags & PVD_FLAG_16BIT)
+        default_table = PVD_TABLE_PVD16 if self.wide else PVD_TABLE_PVD
+        self.range_table = default_table if table is None else pvd_range_table.get(table)
+        if self.range_table is default_table:
+            flags &= ~PVD_FLAG_TABLE
+        else:
+            flags |= PVD_FLAG_TABLE
+
+        self.flags = flags
+        self.channels = (1 if self.wide else 3) + (1 if self.flags & PVD_FLAG_ALPHA else 0)
+        self.dense = bool(flags & PVD_FLAG_DENSE)
+        self.offsets = PVD_DENSE_OFFSETS if self.dense else PVD_CORNER_OFFSETS
+        self.lut = self.range_table.compile(PVD_SAMPLE_VALUES_16 if self.wide else PVD_SAMPLE_VALUES)
+        self.table = self.lut.__getitem__
+
+    @property
+    def key(self):
+        return (self.flags, self.range_table.table_id)
+
+    @staticmethod
+    def from_header(header):
+        return pvd_lanes(header.flags, header.fields.get('table_id'))
+
+    def supports(self, img):
+        bands = img.getbands()
+        if self.wide != (img.mode in PVD_16BIT_MODES):
+            return False
+        if self.flags & PVD_FLAG_ALPHA and (len(bands) <= PVD_ALPHA_CHANNEL or bands[PVD_ALPHA_CHANNEL] != 'A'):
+            return False
+        return self.wide or len(bands) >= 3
+
+    def view(self, pixels):
+        # pixel access returning tuples, the PIL access object itself for multi-channel images
+        return pvd_single_channel(pixels) if self.wide else pixels
+
+    def block_grid(self, img_size):
+        # (outer, inner) number of blocks in embedding order
+        img_height, img_width = img_size
+        if self.dense:
+            return img_width // 3, img_height // 3
+        return img_height // 3 - 1, img_width // 3 - 1
+
+    def block_origin(self, outer_itr, inner_itr):
+        # top left pixel of a block
+        if self.dense:
+            return inner_itr * 3, outer_itr * 3
+        return outer_itr * 3, inner_itr * 3
+
+    def block_count(self, img_size):
+        no_of_matrix_outer, no_of_matrix_inner = self.block_grid(img_size)
+        return max(0, no_of_matrix_outer) * max(0, no_of_matrix_inner)
+
+    def iter_blocks(self, img_size, start=0):
+        no_of_matrix_outer, no_of_matrix_inner = self.block_grid(img_size)
+        for block_idx in range(start, self.block_count(img_size)):
+            yield self.block_origin(*divmod(block_idx, no_of_matrix_inner))
+
+    @staticmethod
+    def for_image(img, use_alpha=False, use_16bit=False, table=None, dense=False):
+        # lanes to embed with, None if the image can not carry data with these options
+        flags = PVD_FLAG_DENSE if dense else 0
+        if use_alpha:
+            flags |= PVD_FLAG_ALPHA
+        if use_16bit and img.mode in PVD_16BIT_MODES:
+            flags |= PVD_FLAG_16BIT
+
+        lanes = pvd_lanes(flags, table)
+        if not lanes.supports(img) and flags & PVD_FLAG_ALPHA:
+            # no alpha channel in this image
+            lanes = pvd_lanes(flags & ~PVD_FLAG_ALPHA, table)
+        return lanes if lanes.supports(img) else None
+
+    @staticmethod
+    def candidates(img):
+        # lanes an embedded image may use, the legacy ones first, then every registered table
+        seen = set()
+        for flags in (0, PVD_FLAG_ALPHA, PVD_FLAG_16BIT, PVD_FLAG_16BIT | PVD_FLAG_ALPHA,
+                PVD_FLAG_DENSE, PVD_FLAG_DENSE | PVD_FLAG_ALPHA, PVD_FLAG_DENSE | PVD_FLAG_16BIT,
+                PVD_FLAG_DENSE | PVD_FLAG_16BIT | PVD_FLAG_ALPHA):
+            for table in [None] + sorted(PVD_RANGE_TABLES):
+                lanes = pvd_lanes(flags, table)
+                if lanes.key not in seen and lanes.supports(img):
+                    seen.add(lanes.key)
+                    yield lanes
+
+class pvd_capacity_cache:
+    # capacity results per (image file, lanes, range table), an entry is dropped when the file changes
+
+    def __init__(self, max_entries=PVD_CAPACITY_CACHE_SIZE):
+        self.max_entries = max_entries
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def _key(kind, image_path, lanes):
+        try:
+            st = os.stat(image_path)
+        except (OSError, TypeError, ValueError):
+            # file objects and missing files are not cached
+            return None, None
+        return (kind, os.path.abspath(image_path), lanes.key), (st.st_mtime_ns, st.st_size)
+
+    def peek(self, kind, image_path, lanes):
+        # the cached value, None when there is none
+        key, state = pvd_capacity_cache._key(kind, image_path, lanes)
+        if key is None:
+            return None
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] == state:
+                self.entries.move_to_end(key)
+                return entry[1]
+        return None
+
+    def put(self, kind, image_path, lanes, value):
+        key, state = pvd_capacity_cache._key(kind, image_path, lanes)
+        if key is None:
+            return
+        with self.lock:
+            self.entries[key] = (state, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def get(self, kind, image_path, lanes, compute):
+        value = self.peek(kind, image_path, lanes)
+        if value is None:
+            value = compute()
+            self.put(kind, image_path, lanes, value)
+        return value
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+PVD_CAPACITY_CACHE = pvd_capacity_cache()
+
+class pvd_single_channel:
+
+    def __init__(self, pixels):
+        self.pixels = pixels
+
+    def __getitem__(self, xy):
+        return (self.pixels[xy],)
+
+    def __setitem__(self, xy, value):
+        self.pixels[xy] = value[0]
+
+class pvd_header:
+
+    def __init__(self, flags=0, encoded_size=0, version=None, **fields):
+        self.flags = flags
+        self.encoded_size = encoded_size
+        self.fields = fields
+        if version is None:
+            version = PVD_VERSION if flags == 0 and not fields else PVD_VERSION_EXT
+        self.version = version
+
+    @property
+    def codec(self):
+        return self.flags & PVD_FLAG_CODEC_MASK
+
+    @property
+    def chunk_size(self):
+        if self.flags & PVD_FLAG_CHUNKED:
+            return self.fields['chunk_size']
+        return None
+
+    @property
+    def body_size(self):
+        return self.encoded_size + PVD_HEADER_SIZE - self.size
+
+    @property
+    def size(self):
+        if self.version == PVD_VERSION:
+            return PVD_HEADER_SIZE
+        return PVD_HEADER_SIZE + PVD_FLAGS_SIZE + \
+            sum(f_size for flag, _, f_size in PVD_EXT_FIELDS if self.flags & flag)
+
+    def to_bytes(self, body_size):
+        if self.version == PVD_VERSION:
+            return PVD_MAGIC + PVD_VERSION + list(body_size.to_bytes(PVD_MAX_LENGTH_FIELD, PVD_BYTE_ORDER))
+
+        ext = list(self.flags.to_bytes(PVD_FLAGS_SIZE, PVD_BYTE_ORDER))
+        for flag, name, f_size in PVD_EXT_FIELDS:
+            if self.flags & flag:
+                ext += list(self.fields[name].to_bytes(f_size, PVD_BYTE_ORDER))
+
+        length = len(ext) + body_size
+        return PVD_MAGIC + PVD_VERSION_EXT + list(length.to_bytes(PVD_MAX_LENGTH_FIELD, PVD_BYTE_ORDER)) + ext
+
+    @staticmethod
+    def required_size(data):
+        # number of header bytes needed to parse the header, given the bytes read so far
+        if len(data) < PVD_HEADER_SIZE:
+            return PVD_HEADER_SIZE
+
+        pvd_magic = list(data[:4])
+        pvd_versn = list(data[4:7])
+        if pvd_magic != PVD_MAGIC or pvd_versn not in (PVD_VERSION, PVD_VERSION_EXT):
+            raise ValueError("Invalid version or image... magic: {} versn: {}".format(pvd_magic, pvd_versn))
+
+        if pvd_versn == PVD_VERSION:
+            return PVD_HEADER_SIZE
+        if len(data) < PVD_HEADER_SIZE + PVD_FLAGS_SIZE:
+            return PVD_HEADER_SIZE + PVD_FLAGS_SIZE
+
+        flags = int.from_bytes(bytes(data[PVD_HEADER_SIZE:PVD_HEADER_SIZE + PVD_FLAGS_SIZE]), PVD_BYTE_ORDER)
+        return pvd_header(flags, version=PVD_VERSION_EXT).size
+
+    @staticmethod
+    def parse(data):
+        size = pvd_header.required_size(data)
+        if len(data) < size:
+            raise ValueError("Truncated header: {} of {} bytes".format(len(data), size))
+
+        version = list(data[4:7])
+        encoded_size = int.from_bytes(bytes(data[7:PVD_HEADER_SIZE]), PVD_BYTE_ORDER)
+        if version == PVD_VERSION:
+            return pvd_header(0, encoded_size, version=version)
+
+        pos = PVD_HEADER_SIZE
+        flags = int.from_bytes(bytes(data[pos:pos + PVD_FLAGS_SIZE]), PVD_BYTE_ORDER)
+        pos += PVD_FLAGS_SIZE
+        fields = {}
+        for flag, name, f_size in PVD_EXT_FIELDS:
+            if flags & flag:
+                fields[name] = int.from_bytes(bytes(data[pos:pos + f_size]), PVD_BYTE_ORDER)
+                pos += f_size
+        return pvd_header(flags, encoded_size, version=version, **fields)
+
 class file_bits_reader:
-    
+
     data = None
     bytes_read_so_far = 0
     total_bytes = 0
     bits_remaining_in_byte_read = 0
 
-    def __init__(self, f_path):
+    def __init__(self, f_path, compression=None, chunk_size=None, data=None, shard=None, lanes=None,
+            set_tag=None):
+        self.f_obj = None
+        pvd_lib.check_options(compression, chunk_size)
         try:
-            self.f_obj = open(f_path, "rb")
-
-            self.data = list(self.f_obj.read())
-            data_len = len(self.data)
-
-            self.data = PVD_MAGIC + PVD_VERSION + list(data_len.to_bytes(PVD_MAX_LENGTH_FIELD, PVD_BYTE_ORDER)) + self.data
-            self.total_bytes = len(self.data) 
-
-            self.byte_read = format(self.data[0], '#010b')[2:]
-            self.bits_read_in_cur_byte = 0
-            self.bytes_read_so_far += 1
-        except Exception as e:
+            if data is None and hasattr(f_path, 'read'):
+                # a stream (stdin) is read to the end and left open
+                data = f_path.read()
+            elif data is None:
+                self.f_obj = open(f_path, "rb")
+                data = self.f_obj.read()
+        except OSError as e:
+            # only a file that can not be read leaves data None, callers check it
             if self.f_obj:
                 self.f_obj.close()
             print("ERROR: Opening file: {} EXCP: {}".format(f_path, e))
+            return
+
+        flags = 0
+        fields = {}
+        if lanes is not None:
+            flags |= lanes.flags
+            if lanes.flags & PVD_FLAG_TABLE:
+                fields['table_id'] = lanes.range_table.table_id
+        if chunk_size:
+            # chunks are addressed by payload offset, so they are never compressed
+            body = pvd_chunks.encode(data, chunk_size)
+            flags |= PVD_FLAG_CHUNKED
+            fields['chunk_size'] = chunk_size
+        else:
+            codec, body = pvd_codec.choose(data, compression)
+            flags |= codec
+
+        if shard:
+            # (sequence number, total shards, sha256 of the whole payload)
+            flags |= PVD_FLAG_SHARD
+            fields['shard_seq'], fields['shard_total'], fields['payload_hash'] = shard
+        if set_tag is not None:
+            flags |= PVD_FLAG_SET_TAG
+            fields['set_tag'] = set_tag
+
+        self.header = pvd_header(flags, **fields)
+
+        self.data = self.header.to_bytes(len(body)) + list(body)
+        self.total_bytes = len(self.data)
+
+        self.byte_read = format(self.data[0], '#010b')[2:]
+        self.bits_read_in_cur_byte = 0
+        self.bytes_read_so_far += 1
 
     def get_bits(self, bits):
         if bits > 8 or bits <= 0:
@@ -66,9 +674,14 @@ class file_bits_reader:
             ret_val |= int(self.byte_read[self.bits_read_in_cur_byte:(self.bits_read_in_cur_byte+read_end)], 2)
             self.bits_read_in_cur_byte += (bits - remaining)
 
+        if op_bits != None and op_bits < bits:
+            # the extractor reads all of the slot bits, so the last bits go to the top of the slot
+            ret_val <<= (bits - op_bits)
+            op_bits = bits
+
         if op_bits == None:
             op_bits = bits
-        
+
         return (eof_status, ret_val, op_bits)
 
     def close_file(self):
@@ -77,12 +690,18 @@ class file_bits_reader:
 
 class file_bits_writer:
     def __init__(self, f_path):
+        self.f_path = f_path
+        self.f_obj = None
+        # a stream (stdout) gets the body as it is decoded and is never closed or removed
+        self.stream = hasattr(f_path, 'write')
         try:
-            self.f_obj = open(f_path, "wb")
+            self.f_obj = f_path if self.stream else open(f_path, "wb")
             self.cur_byte = 0
             self.bits_wrote_in_cur_byte = 0
             self.bytes_wrote_to_file_so_far = 0
             self.data = []
+            self.header = None
+            self.body_decoder = None
         except Exception as e:
             if self.f_obj:
                 self.f_obj.close()
@@ -96,6 +715,9 @@ class file_bits_writer:
             self.cur_byte <<= bits
             self.cur_byte |= data
             self.bits_wrote_in_cur_byte += bits
+            if self.bits_wrote_in_cur_byte == 8:
+                # counted right away, a payload may end in the last slot of the image
+                self.byte_done()
 
         else:
             remaining_reqd = 8 - self.bits_wrote_in_cur_byte
@@ -105,10 +727,7 @@ class file_bits_writer:
                 self.cur_byte |= int(bits_str[:remaining_reqd], 2)
                 self.bits_wrote_in_cur_byte += remaining_reqd
 
-            self.data.append(self.cur_byte)
-            self.cur_byte = 0
-            self.bits_wrote_in_cur_byte = 0
-            self.bytes_wrote_to_file_so_far += 1
+            self.byte_done()
             self.bits_wrote_in_cur_byte += (bits - remaining_reqd)
 
             self.cur_byte <<= (bits - remaining_reqd)
@@ -119,70 +738,282 @@ class file_bits_writer:
             self.bytes_wrote_to_file_so_far += 1
             self.close_file()
 
+    def byte_done(self):
+        self.data.append(self.cur_byte)
+        self.cur_byte = 0
+        self.bits_wrote_in_cur_byte = 0
+        self.bytes_wrote_to_file_so_far += 1
+
+        if self.header and len(self.data) - self.header.size >= PVD_WRITE_CHUNK:
+            self.flush_body()
+
+    def set_header(self, header):
+        self.header = header
+        if header.chunk_size:
+            self.body_decoder = pvd_chunk_decoder(header.chunk_size, header.body_size)
+        else:
+            self.body_decoder = pvd_codec.decompressor(header.codec)
+
+    def flush_body(self):
+        # body bytes are decoded and written as they arrive, only the header stays in self.data
+        body = bytes(self.data[self.header.size:])
+        del self.data[self.header.size:]
+        if self.body_decoder:
+            try:
+                body = self.body_decoder.decompress(body)
+            except (zlib.error, lzma.LZMAError, OSError) as e:
+                # bz2 reports a damaged stream as OSError
+                raise ValueError("Corrupted payload: {}".format(e))
+        self.f_obj.write(body)
+        if self.stream:
+            self.f_obj.flush()
+
+    def abort(self):
+        # drops the partially written output, what went to a stream stays there
+        if self.stream:
+            self.f_obj = None
+            return
+        if self.f_obj:
+            self.f_obj.close()
+            self.f_obj = None
+        if os.path.exists(self.f_path):
+            os.remove(self.f_path)
+
+    def _close(self):
+        if self.stream:
+            self.f_obj.flush()
+        else:
+            self.f_obj.close()
+
     def close_file(self):
         if self.f_obj:
             #print(self.data)
-            self.f_obj.write(bytes(self.data[PVD_HEADER_SIZE:]))
-            self.f_obj.close()
+            if self.header is None:
+                self.f_obj.write(bytes(self.data[PVD_HEADER_SIZE:]))
+                self._close()
+                return
+
+            try:
+                self.flush_body()
+                if self.body_decoder and not self.body_decoder.eof:
+                    raise ValueError("Payload is truncated")
+            finally:
+                self._close()
 
 class pvd_lib:
 
-    def __init__(self):
-        pass
+    def __init__(self, compression=PVD_COMPRESSION_AUTO, chunk_size=None, use_alpha=False, use_16bit=False,
+            table=None, dense=False):
+        pvd_lib.check_options(compression, chunk_size)
+        self.compression = compression
+        self.chunk_size = chunk_size
+        # opt-in lanes, used only when the cover has an alpha channel / 16-bit samples
+        self.use_alpha = use_alpha
+        self.use_16bit = use_16bit
+        # pvd_range_table, its id or name, None - the default table of the lanes
+        self.table = table
+        # all 8 neighbours of every block, see pvd_lanes
+        self.dense = dense
+
+    @staticmethod
+    def check_options(compression, chunk_size=None):
+        # bad options are reported as such, before any file is read
+        if compression not in (PVD_COMPRESSION_AUTO, PVD_COMPRESSION_KEEP) and compression not in PVD_CODECS:
+            raise ValueError("Unknown compression: {}".format(compression))
+        if chunk_size is not None and not 1 <= chunk_size <= PVD_MAX_CHUNK_SIZE:
+            raise ValueError("Chunk size should be between 1 and {}: {}".format(PVD_MAX_CHUNK_SIZE, chunk_size))
 
     @staticmethod
     def _pvd_table(p_diff):
-        nbits = 0
-        if p_diff < 16:
-            nbits = 2
-        elif 16 < p_diff < 32:
-            nbits = 3
-        else:
-            nbits = 4
-        return nbits
+        return PVD_TABLE_PVD.lut[p_diff]
 
     @staticmethod
-    def _embed_capacity(ref_image_path):
+    def _embed_capacity(ref_image_path, lanes=None):
+        if lanes is None:
+            lanes = pvd_lanes()
+        return PVD_CAPACITY_CACHE.get('capacity', ref_image_path, lanes,
+            lambda: pvd_lib._compute_capacity(ref_image_path, lanes))
+
+    @staticmethod
+    def _compute_capacity(ref_image_path, lanes):
 
         embed_capacity = 0
         
         with Image.open(ref_image_path) as img_obj:
-            pixels = img_obj.load()
-            img_height, img_width = img_obj.size
-            #print(img_height, img_width)
-            
-            no_of_matrix_h = img_height // 3 - 1
-            no_of_matrix_w = img_width // 3 - 1
+            pixels = lanes.view(img_obj.load())
+            #print(img_obj.size)
 
-            if no_of_matrix_h < 1 or no_of_matrix_w < 1 or len(pixels[0, 0]) < 3:
+            no_of_matrix_outer, no_of_matrix_inner = lanes.block_grid(img_obj.size)
+
+            if no_of_matrix_outer < 1 or no_of_matrix_inner < 1 or not lanes.supports(img_obj):
                 return embed_capacity;
 
-            for height_itr in range(0, no_of_matrix_h * 3, 3):
-                for width_itr in range(0, no_of_matrix_w * 3, 3):
+            for outer_itr in range(no_of_matrix_outer):
+                for inner_itr in range(no_of_matrix_inner):
+                    height_itr, width_itr = lanes.block_origin(outer_itr, inner_itr)
 
                     #print(pixels[width_itr + 1, height_itr + 1])
                     ref_rgb = pixels[height_itr + 1, width_itr + 1]
 
-                    """
-                    [1 2 3]
-                    [4 - 5]
-                    [6 7 8]
-                    """
-                    for h_j in range(height_itr, height_itr + 3):
-                        for w_i in range(width_itr, width_itr + 3):
-
-                            if w_i == width_itr + 1 or h_j == height_itr + 1:
-                                continue
+                    for d_h, d_w in lanes.offsets:
+                        c_rgb = pixels[height_itr + d_h, width_itr + d_w]
 
-                            c_rgb = pixels[h_j, w_i]
-
-                            embed_capacity += pvd_lib._pvd_table(abs(c_rgb[0] - ref_rgb[0])) + \
-                                pvd_lib._pvd_table(abs(c_rgb[1] - ref_rgb[1])) + \
-                                    pvd_lib._pvd_table(abs(c_rgb[2] - ref_rgb[2]))
+                        for rgb in range(lanes.channels):
+                            embed_capacity += lanes.table(abs(c_rgb[rgb] - ref_rgb[rgb]))
             
         #print(embed_capacity // 8)
         return embed_capacity // 8
 
+    @staticmethod
+    def _estimate_capacity(ref_image_path, lanes=None, fraction=PVD_ESTIMATE_FRACTION,
+            confidence=PVD_ESTIMATE_CONFIDENCE, max_blocks=PVD_ESTIMATE_MAX_BLOCKS, seed=None):
+        # stratified sample of blocks instead of the full scan of _embed_capacity
+        if lanes is None:
+            lanes = pvd_lanes()
+
+        with Image.open(ref_image_path) as img_obj:
+            no_of_matrix_outer, no_of_matrix_inner = lanes.block_grid(img_obj.size)
+            if no_of_matrix_outer < 1 or no_of_matrix_inner < 1 or not lanes.supports(img_obj):
+                return pvd_capacity_estimate(0, 0, 0, 0, 0, True)
+
+            blocks_total = no_of_matrix_outer * no_of_matrix_inner
+            fraction = min(fraction, max_blocks / blocks_total)
+            pixels = lanes.view(img_obj.load())
+            rng = random.Random(seed)
+
+            strata_outer = min(PVD_ESTIMATE_STRATA, no_of_matrix_outer)
+            strata_inner = min(PVD_ESTIMATE_STRATA, no_of_matrix_inner)
+            total_bits = 0.0
+            variance = 0.0
+            df_sum = 0.0
+            blocks_sampled = 0
+            for s_outer in range(strata_outer):
+                outer_lo = s_outer * no_of_matrix_outer // strata_outer
+                outer_hi = (s_outer + 1) * no_of_matrix_outer // strata_outer
+                for s_inner in range(strata_inner):
+                    inner_lo = s_inner * no_of_matrix_inner // strata_inner
+                    inner_hi = (s_inner + 1) * no_of_matrix_inner // strata_inner
+
+                    stratum_width = inner_hi - inner_lo
+                    stratum_size = (outer_hi - outer_lo) * stratum_width
+                    n = min(stratum_size, max(PVD_ESTIMATE_MIN_PER_STRATUM, round(stratum_size * fraction)))
+
+                    bits = []
+                    for k in rng.sample(range(stratum_size), n):
+                        height_itr, width_itr = lanes.block_origin(outer_lo + k // stratum_width,
+                            inner_lo + k % stratum_width)
+                        bits.append(sum(slot[3] for slot in pvd_lib._block_slots(pixels, height_itr, width_itr, lanes)))
+
+                    mean = sum(bits) / n
+                    total_bits += stratum_size * mean
+                    blocks_sampled += n
+                    if 1 < n < stratum_size:
+                        s2 = sum((b - mean) ** 2 for b in bits) / (n - 1)
+                        stratum_variance = stratum_size * stratum_size * (1 - n / stratum_size) * s2 / n
+                        variance += stratum_variance
+                        df_sum += stratum_variance * stratum_variance / (n - 1)
+
+        # the variance comes from a few blocks per stratum, so the quantile is Student's t with the
+        # Satterthwaite degrees of freedom instead of the normal one
+        margin = pvd_lib._t_quantile(0.5 + confidence / 2, variance * variance / df_sum if df_sum else 1) * \
+            math.sqrt(variance)
+        return pvd_capacity_estimate(int(total_bits) // 8, max(0, int(total_bits - margin)) // 8,
+            int(total_bits + margin) // 8, blocks_sampled, blocks_total, blocks_sampled == blocks_total)
+
+    @staticmethod
+    def _t_quantile(p, df):
+        # quantile of Student's t, Cornish-Fisher expansion around the normal quantile
+        z = statistics.NormalDist().inv_cdf(p)
+        return z + (z ** 3 + z) / (4 * df) + (5 * z ** 5 + 16 * z ** 3 + 3 * z) / (96 * df * df) + \
+            (3 * z ** 7 + 19 * z ** 5 + 17 * z ** 3 - 15 * z) / (384 * df ** 3)
+
+    @staticmethod
+    def _block_slots(ref_pixels, height_itr, width_itr, lanes):
+        # (h_j, w_i, rgb, bits) in the same order as embed_data visits them
+        ref_rgb = ref_pixels[height_itr + 1, width_itr + 1]
+        slots = []
+        for d_h, d_w in lanes.offsets:
+            h_j = height_itr + d_h
+            w_i = width_itr + d_w
+            c_rgb = ref_pixels[h_j, w_i]
+            for rgb in range(lanes.channels):
+                slots.append((h_j, w_i, rgb, lanes.table(abs(c_rgb[rgb] - ref_rgb[rgb]))))
+        return slots
+
+    @staticmethod
+    def _block_capacity_prefix(ref_image_path, lanes=None):
+        # prefix[k] - number of bits embedded before block k, in embed_data order
+        if lanes is None:
+            lanes = pvd_lanes()
+        return PVD_CAPACITY_CACHE.get('prefix', ref_image_path, lanes,
+            lambda: pvd_lib._compute_capacity_prefix(ref_image_path, lanes))
+
+    @staticmethod
+    def _compute_capacity_prefix(ref_image_path, lanes):
+        with Image.open(ref_image_path) as img_obj:
+            if not lanes.supports(img_obj):
+                return [0]
+            pixels = lanes.view(img_obj.load())
+
+            block_bits = (sum(slot[3] for slot in pvd_lib._block_slots(pixels, height_itr, width_itr, lanes))
+                for height_itr, width_itr in lanes.iter_blocks(img_obj.size))
+            return list(itertools.accumulate(block_bits, initial=0))
+
+    @staticmethod
+    def _read_bytes(ref_pixels, pvd_pixels, img_size, lanes, block_prefix, start, length):
+        # decodes bytes [start, start + length) of the embedded stream, visiting only the blocks holding them
+        # without block_prefix the walk starts from the first block
+        out = bytearray()
+        if length <= 0:
+            return bytes(out)
+
+        ref_pixels = lanes.view(ref_pixels)
+        pvd_pixels = lanes.view(pvd_pixels)
+
+        start_bit = start * PVD_BYTES_TO_BITS
+        if block_prefix is None:
+            block_idx = 0
+            bit_pos = 0
+        else:
+            block_idx = bisect.bisect_right(block_prefix, start_bit) - 1
+            if block_idx >= lanes.block_count(img_size):
+                raise ValueError("Offset {} is beyond the embedding capacity".format(start))
+            bit_pos = block_prefix[block_idx]
+        acc = 0
+        acc_bits = 0
+        for height_itr, width_itr in lanes.iter_blocks(img_size, block_idx):
+            for h_j, w_i, rgb, bits_reqd in pvd_lib._block_slots(ref_pixels, height_itr, width_itr, lanes):
+                data = pvd_lib.get_lsbs(pvd_pixels[h_j, w_i][rgb], bits_reqd)
+                if bit_pos < start_bit:
+                    skip = min(bits_reqd, start_bit - bit_pos)
+                    bit_pos += skip
+                    bits_reqd -= skip
+                    data = pvd_lib.get_lsbs(data, bits_reqd)
+                    if bits_reqd == 0:
+                        continue
+
+                acc = (acc << bits_reqd) | data
+                acc_bits += bits_reqd
+                bit_pos += bits_reqd
+                while acc_bits >= PVD_BYTES_TO_BITS:
+                    acc_bits -= PVD_BYTES_TO_BITS
+                    out.append(acc >> acc_bits)
+                    acc &= (1 << acc_bits) - 1
+
+                if len(out) >= length:
+                    return bytes(out[:length])
+
+        raise pvd_stream_ended("Embedded stream ends before byte {}".format(start + length))
+
+    @staticmethod
+    def _save_image(img, op_img_path):
+        # a stream (stdout) has no extension to take the format from, it gets PNG
+        if hasattr(op_img_path, 'write'):
+            img.save(op_img_path, format='PNG')
+            op_img_path.flush()
+        else:
+            img.save(op_img_path)
+
     @staticmethod
     def replace_lsbs(pixel, bits, value):
         mask = (1 << bits) - 1
@@ -195,65 +1026,101 @@ class pvd_lib:
         pixel &= (mask)
         return (pixel)
 
-    def embed_data(self, ref_image_path, s_file_path, op_img_path):
+    def embed_data(self, ref_image_path, s_file_path, op_img_path, bits_reader=None, progress=None, cancel=None):
+        # progress(pvd_progress_info) is called once per block row, cancel is a pvd_cancel_token
+        # op_img_path is written only when the whole payload is embedded
+
+        if bits_reader is None:
+            bits_reader = file_bits_reader(s_file_path, self.compression, self.chunk_size,
+                lanes=self._lanes(ref_image_path))
+        if bits_reader.data is None:
+            bits_reader.close_file()
+            raise ValueError("Can not read the secret file: {}".format(s_file_path))
+        try:
+            return self._embed_data(ref_image_path, op_img_path, bits_reader, progress, cancel)
+        finally:
+            bits_reader.close_file()
+
+    def _embed_data(self, ref_image_path, op_img_path, bits_reader, progress, cancel):
     
         embedded_ds = 0
+        # the lanes are recorded in the header, so the reader decides them
+        lanes = pvd_lanes.from_header(bits_reader.header)
         
-        bits_reader = file_bits_reader(s_file_path)
         with Image.open(ref_image_path) as img_obj:
-            pixels = img_obj.load()
-            img_height, img_width = img_obj.size
-            #print(img_height, img_width)
-            
-            no_of_matrix_h = img_height // 3 - 1
-            no_of_matrix_w = img_width // 3 - 1
+            pixels = lanes.view(img_obj.load())
+            #print(img_obj.size)
+
+            no_of_matrix_outer, no_of_matrix_inner = lanes.block_grid(img_obj.size)
 
-            if no_of_matrix_h < 1 or no_of_matrix_w < 1 or len(pixels[0, 0]) < 3:
+            if no_of_matrix_outer < 1 or no_of_matrix_inner < 1 or not lanes.supports(img_obj):
                 return embedded_ds;
 
-            for height_itr in range(0, no_of_matrix_h * 3, 3):
-                for width_itr in range(0, no_of_matrix_w * 3, 3):
+            tracker = pvd_progress(progress, cancel, no_of_matrix_outer * no_of_matrix_inner,
+                bits_reader.total_bytes * PVD_BYTES_TO_BITS)
+
+            for outer_itr in range(no_of_matrix_outer):
+                tracker.step(outer_itr * no_of_matrix_inner, embedded_ds)
+                for inner_itr in range(no_of_matrix_inner):
+                    height_itr, width_itr = lanes.block_origin(outer_itr, inner_itr)
 
                     #print(pixels[width_itr + 1, height_itr + 1])
                     ref_rgb = pixels[height_itr + 1, width_itr + 1]
 
-                    for h_j in range(height_itr, height_itr + 3):
-                        for w_i in range(width_itr, width_itr + 3):
+                    for d_h, d_w in lanes.offsets:
+                        h_j = height_itr + d_h
+                        w_i = width_itr + d_w
 
-                            if w_i == width_itr + 1 or h_j == height_itr + 1:
-                                continue
+                        c_rgb = pixels[h_j, w_i]
+                        c_rgb_list = list(c_rgb)
 
-                            c_rgb = pixels[h_j, w_i]
-                            c_rgb_list = list(c_rgb)
+                        # embedded_ds += pvd_lib._pvd_table(abs(c_rgb[0] - ref_rgb[0])) + \
+                        #     pvd_lib._pvd_table(abs(c_rgb[1] - ref_rgb[1])) + \
+                        #         pvd_lib._pvd_table(abs(c_rgb[2] - ref_rgb[2]))
+                        done_embedding = False
+                        for rgb in range(lanes.channels):
+                            bits_reqd = lanes.table(abs(c_rgb[rgb] - ref_rgb[rgb]))
+                            embedded_ds += bits_reqd
 
-                            # embedded_ds += pvd_lib._pvd_table(abs(c_rgb[0] - ref_rgb[0])) + \
-                            #     pvd_lib._pvd_table(abs(c_rgb[1] - ref_rgb[1])) + \
-                            #         pvd_lib._pvd_table(abs(c_rgb[2] - ref_rgb[2]))
-                            done_embedding = False
-                            for rgb in range(3):
-                                bits_reqd = pvd_lib._pvd_table(abs(c_rgb[rgb] - ref_rgb[rgb]))
-                                embedded_ds += bits_reqd
+                            ret_val = bits_reader.get_bits(bits_reqd)
 
-                                ret_val = bits_reader.get_bits(bits_reqd)
+                            c_rgb_list[rgb] = pvd_lib.replace_lsbs(c_rgb[rgb], ret_val[2], ret_val[1])
+                            if ret_val[0] == True:
+                                done_embedding = True
+                                break
 
-                                c_rgb_list[rgb] = pvd_lib.replace_lsbs(c_rgb[rgb], ret_val[2], ret_val[1])
-                                if ret_val[0] == True:
-                                    done_embedding = True
-                                    break
+                        pixels[h_j, w_i] = tuple(c_rgb_list)
 
-                            pixels[h_j, w_i] = tuple(c_rgb_list)
-
-                            if done_embedding:
-                                img_obj.save(op_img_path)
-                                bits_reader.close_file()
-                                return embedded_ds
+                        if done_embedding:
+                            tracker.step(outer_itr * no_of_matrix_inner + inner_itr + 1, embedded_ds)
+                            pvd_lib._save_image(img_obj, op_img_path)
+                            return embedded_ds
 
+            # the payload did not fit: every block was used, so embedded_ds is the capacity
+            PVD_CAPACITY_CACHE.put('capacity', ref_image_path, lanes, embedded_ds // PVD_BYTES_TO_BITS)
         return 
 
-    def extract_data(self, ref_image_path, s_file_path, pvd_img_path):
+    def extract_data(self, ref_image_path, s_file_path, pvd_img_path, progress=None, cancel=None):
+        # progress(pvd_progress_info) is called once per block row, cancel is a pvd_cancel_token
+        # s_file_path is removed if the extraction fails or is cancelled
+
+        bits_writer = file_bits_writer(s_file_path)
+        if bits_writer.f_obj is None:
+            raise ValueError("Can not open the output file: {}".format(s_file_path))
+        try:
+            embedded_ds = self._extract_data(ref_image_path, bits_writer, pvd_img_path, progress, cancel)
+        except BaseException:
+            bits_writer.abort()
+            raise
+
+        if embedded_ds <= 0:
+            # image too small or the payload never ended
+            bits_writer.abort()
+        return embedded_ds
+
+    def _extract_data(self, ref_image_path, bits_writer, pvd_img_path, progress, cancel):
         embedded_ds = 0
         
-        bits_writer = file_bits_writer(s_file_path)
         with Image.open(ref_image_path) as ref_img, Image.open(pvd_img_path) as pvd_img:
             ref_pixels = ref_img.load()
             ref_img_height, ref_img_width = pvd_img.size
@@ -263,70 +1130,292 @@ class pvd_lib:
             if ref_img_height != pvd_img_height or ref_img_width != pvd_img_width:
                 raise ValueError("Ref vs embedded image not matching")
 
-            no_of_matrix_h = ref_img_height // 3 - 1
-            no_of_matrix_w = ref_img_width // 3 - 1
+            lanes = pvd_lib._probe_lanes(ref_img, pvd_pixels)
+            if lanes is None:
+                return embedded_ds;
+            ref_pixels = lanes.view(ref_pixels)
+            pvd_pixels = lanes.view(pvd_pixels)
+
+            no_of_matrix_outer, no_of_matrix_inner = lanes.block_grid(ref_img.size)
 
-            if no_of_matrix_h < 1 or no_of_matrix_w < 1 or len(ref_pixels[0, 0]) < 3:
+            if no_of_matrix_outer < 1 or no_of_matrix_inner < 1:
                 return embedded_ds;
 
             magic_extracted = False
             eof_reached = False
             encoded_size = 0
+            header_size = PVD_HEADER_SIZE
 
-            for height_itr in range(0, no_of_matrix_h * 3, 3):
-                for width_itr in range(0, no_of_matrix_w * 3, 3):
+            tracker = pvd_progress(progress, cancel, no_of_matrix_outer * no_of_matrix_inner)
+
+            for outer_itr in range(no_of_matrix_outer):
+                tracker.step(outer_itr * no_of_matrix_inner, embedded_ds)
+                for inner_itr in range(no_of_matrix_inner):
+                    height_itr, width_itr = lanes.block_origin(outer_itr, inner_itr)
 
                     #print(pixels[width_itr + 1, height_itr + 1])
                     ref_rgb = ref_pixels[height_itr + 1, width_itr + 1]
 
-                    for h_j in range(height_itr, height_itr + 3):
-                        for w_i in range(width_itr, width_itr + 3):
-
-                            if w_i == width_itr + 1 or h_j == height_itr + 1:
-                                continue
+                    for d_h, d_w in lanes.offsets:
+                        h_j = height_itr + d_h
+                        w_i = width_itr + d_w
 
-                            c_rgb = ref_pixels[h_j, w_i]
-                            pvd_c_rgb = pvd_pixels[h_j, w_i]
-                            #c_rgb_list = list(c_rgb)
+                        c_rgb = ref_pixels[h_j, w_i]
+                        pvd_c_rgb = pvd_pixels[h_j, w_i]
+                        #c_rgb_list = list(c_rgb)
 
-                            for rgb in range(3):
-                                bits_reqd = pvd_lib._pvd_table(abs(c_rgb[rgb] - ref_rgb[rgb]))
-                                embedded_ds += bits_reqd
-                                data = pvd_lib.get_lsbs(pvd_c_rgb[rgb], bits_reqd)
-                                ret_val = bits_writer.set_bits(eof_reached, bits_reqd, data)
-                                if magic_extracted and (encoded_size + PVD_HEADER_SIZE) == bits_writer.bytes_wrote_to_file_so_far:
-                                    eof_reached = True
+                        for rgb in range(lanes.channels):
+                            bits_reqd = lanes.table(abs(c_rgb[rgb] - ref_rgb[rgb]))
+                            embedded_ds += bits_reqd
+                            data = pvd_lib.get_lsbs(pvd_c_rgb[rgb], bits_reqd)
+                            ret_val = bits_writer.set_bits(eof_reached, bits_reqd, data)
 
-                                if (bits_writer.bytes_wrote_to_file_so_far >= (PVD_HEADER_SIZE)) and magic_extracted == False:
+                            if (bits_writer.bytes_wrote_to_file_so_far >= header_size) and magic_extracted == False:
+                                header_size = pvd_header.required_size(bits_writer.data)
+                                if bits_writer.bytes_wrote_to_file_so_far >= header_size:
                                     magic_extracted = True
-                                    magic = bits_writer.data[:PVD_HEADER_SIZE]
-                                    pvd_magic = magic[:4]
-                                    pvd_versn = magic[4:7]
-                                    if pvd_magic != PVD_MAGIC or pvd_versn != PVD_VERSION:
-                                        raise ValueError("Invalid version or image... magic: {} versn: {}".format(pvd_magic, pvd_versn))
-                                    size_arr = magic[-4:]
-                                    encoded_size = (size_arr[0] << 24) + (size_arr[1] << 16) + (size_arr[2] << 8) + (size_arr[3] << 0)
-                                
-                                if eof_reached:
-
-                                    bits_writer.close_file()
-                                    return embedded_ds
+                                    header = pvd_header.parse(bits_writer.data)
+                                    encoded_size = header.encoded_size
+                                    bits_writer.set_header(header)
+                                    tracker.bits_total = (encoded_size + PVD_HEADER_SIZE) * PVD_BYTES_TO_BITS
+
+                            # after the header: an empty payload ends with it
+                            if magic_extracted and (encoded_size + PVD_HEADER_SIZE) == bits_writer.bytes_wrote_to_file_so_far:
+                                eof_reached = True
+                            
+                            if eof_reached:
+
+                                bits_writer.close_file()
+                                tracker.step(outer_itr * no_of_matrix_inner + inner_itr + 1, embedded_ds)
+                                return embedded_ds
 
             return -1
 
 
 
-    def pvd_embed(self, ref_image_path, secret_file_path, op_img_path):
+    def pvd_embed(self, ref_image_path, secret_file_path, op_img_path, progress=None, cancel=None):
         
-        embed_cap = pvd_lib._embed_capacity(ref_image_path)
-        s_f_size = os.path.getsize(secret_file_path)
+        lanes = self._lanes(ref_image_path)
+        bits_reader = file_bits_reader(secret_file_path, self.compression, self.chunk_size, lanes=lanes)
+        if bits_reader.data is None:
+            bits_reader.close_file()
+            raise ValueError("Can not read the secret file: {}".format(secret_file_path))
+        # size after compression, without the header
+        s_f_size = bits_reader.total_bytes - PVD_HEADER_SIZE
+
+        # a capacity scan takes as long as the embedding and is not cancellable, so only a cached
+        # capacity is checked up front; otherwise the embedding itself finds out that it ran out of blocks
+        embed_cap = PVD_CAPACITY_CACHE.peek('capacity', ref_image_path, lanes) if lanes else 0
+        if embed_cap is None or embed_cap >= bits_reader.total_bytes:
+            embedded_ds = self.embed_data(ref_image_path, secret_file_path, op_img_path, bits_reader,
+                progress, cancel)
+            if embedded_ds:
+                return embedded_ds
+            # cached by the embedding above for a file, computed for a stream
+            embed_cap = pvd_lib._embed_capacity(ref_image_path, lanes) if lanes else 0
+
+        print("ERROR: Secret file size is more than embedding capacity of image - " \
+            "Embedding capacity: {} bytes, Secret file size: {} bytes".format(embed_cap, s_f_size))
+        bits_reader.close_file()
+        return None
+
+    def pvd_extract(self, ref_image_path, secret_op_file, pvd_img_path, progress=None, cancel=None):
+
+        return self.extract_data(ref_image_path, secret_op_file, pvd_img_path, progress, cancel)
+
+    def _lanes(self, ref_image_path):
+        with Image.open(ref_image_path) as img_obj:
+            return pvd_lanes.for_image(img_obj, self.use_alpha, self.use_16bit, self.table, self.dense)
 
-        if embed_cap < s_f_size:
-            print("ERROR: Secret file size is more than embedding capacity of image - " \
-                "Embedding capacity: {} bytes, Secret file size: {} bytes".format(embed_cap, s_f_size))
+    @staticmethod
+    def _read_header(ref_pixels, pvd_pixels, img_size, lanes):
+        header_data = pvd_lib._read_bytes(ref_pixels, pvd_pixels, img_size, lanes, None, 0, PVD_HEADER_SIZE)
+        header_size = pvd_header.required_size(header_data)
+        while len(header_data) < header_size:
+            header_data = pvd_lib._read_bytes(ref_pixels, pvd_pixels, img_size, lanes, None, 0, header_size)
+            header_size = pvd_header.required_size(header_data)
+
+        header = pvd_header.parse(header_data)
+        if header.flags & PVD_LANE_FLAGS != lanes.flags or \
+                header.fields.get('table_id', lanes.range_table.table_id) != lanes.range_table.table_id:
+            raise ValueError("Header lanes do not match: {:#x}".format(header.flags & PVD_LANE_FLAGS))
+        return header
 
-        return self.embed_data(ref_image_path, secret_file_path, op_img_path)
+    @staticmethod
+    def _probe_lanes(ref_img, pvd_pixels, with_header=False):
+        # the header is embedded with the lanes it records, so every lane the image allows is tried
+        ref_pixels = ref_img.load()
+        error = None
+        for lanes in pvd_lanes.candidates(ref_img):
+            try:
+                header = pvd_lib._read_header(ref_pixels, pvd_pixels, ref_img.size, lanes)
+            except pvd_stream_ended:
+                # too small for a header with these lanes
+                continue
+            except ValueError as e:
+                error = error or e
+                continue
+            return (lanes, header) if with_header else lanes
+
+        if error is None:
+            return (None, None) if with_header else None
+        raise error
+
+    def read_header(self, ref_image_path, pvd_img_path):
+        # decodes only the first blocks of the image
+        with Image.open(ref_image_path) as ref_img, Image.open(pvd_img_path) as pvd_img:
+            if ref_img.size != pvd_img.size:
+                raise ValueError("Ref vs embedded image not matching")
+
+            lanes, header = pvd_lib._probe_lanes(ref_img, pvd_img.load(), with_header=True)
+            if lanes is None:
+                raise ValueError("Image has no channels to carry data: {}".format(ref_img.mode))
+            return header
+
+    def extract_range(self, ref_image_path, pvd_img_path, offset, length, block_prefix=None):
+        # bytes [offset, offset + length) of the payload, only the chunks holding them are decoded and checked
+        if offset < 0 or length < 0:
+            raise ValueError("Offset and length should not be negative")
 
-    def pvd_extract(self, ref_image_path, secret_op_file, pvd_img_path):
+        with Image.open(ref_image_path) as ref_img, Image.open(pvd_img_path) as pvd_img:
+            if ref_img.size != pvd_img.size:
+                raise ValueError("Ref vs embedded image not matching")
+
+            ref_pixels = ref_img.load()
+            pvd_pixels = pvd_img.load()
+
+            lanes, header = pvd_lib._probe_lanes(ref_img, pvd_pixels, with_header=True)
+            if lanes is None:
+                raise ValueError("Image has no channels to carry data: {}".format(ref_img.mode))
+
+            if block_prefix is None:
+                block_prefix = pvd_lib._block_capacity_prefix(ref_image_path, lanes)
+
+            if header.codec != PVD_CODEC_NONE:
+                raise ValueError("Range extraction is not possible from a compressed payload")
+
+            chunk_size = header.chunk_size
+            if chunk_size:
+                payload_size = pvd_chunks.payload_size(header.body_size, chunk_size)
+            else:
+                payload_size = header.body_size
+
+            length = min(length, payload_size - offset)
+            if length <= 0:
+                return b''
+
+            if not chunk_size:
+                return pvd_lib._read_bytes(ref_pixels, pvd_pixels, ref_img.size, lanes, block_prefix,
+                    header.size + offset, length)
+
+            first_chunk, start, end = pvd_chunks.body_range(offset, length, payload_size, chunk_size)
+            body = pvd_lib._read_bytes(ref_pixels, pvd_pixels, ref_img.size, lanes, block_prefix,
+                header.size + start, end - start)
+            data = pvd_chunks.verify(body, chunk_size, first_chunk)
+
+            skip = offset - first_chunk * chunk_size
+            return data[skip:skip + length]
+
+    @staticmethod
+    def _stream_bits(stream, bit_pos, bits):
+        # bits [bit_pos, bit_pos + bits) of the stream, zeros past its end (as get_bits pads the last slot)
+        byte_idx = bit_pos >> 3
+        window = stream[byte_idx] << 8
+        if byte_idx + 1 < len(stream):
+            window |= stream[byte_idx + 1]
+        return (window >> (16 - (bit_pos & 7) - bits)) & ((1 << bits) - 1)
+
+    @staticmethod
+    def _changed_ranges(old_stream, new_stream, step=4096):
+        # [(start, end)] byte ranges where the streams differ, a length change counts from the shorter end
+        ranges = []
+        common = min(len(old_stream), len(new_stream))
+        for base in range(0, common, step):
+            if old_stream[base:base + step] == new_stream[base:base + step]:
+                continue
+            for byte_idx in range(base, min(base + step, common)):
+                if old_stream[byte_idx] != new_stream[byte_idx]:
+                    if ranges and ranges[-1][1] == byte_idx:
+                        ranges[-1][1] = byte_idx + 1
+                    else:
+                        ranges.append([byte_idx, byte_idx + 1])
+        if len(old_stream) != len(new_stream):
+            ranges.append([common, max(len(old_stream), len(new_stream))])
+        return ranges
+
+    def update_payload(self, ref_image_path, pvd_img_path, secret_file_path, op_img_path):
+        # replaces the payload of a stego image, rewriting only the blocks that hold changed stream bits;
+        # the result is the image embed_data would give for the new payload.
+        # The lanes and the chunk size of the existing payload are kept, its codec too with PVD_COMPRESSION_KEEP.
+        with Image.open(ref_image_path) as ref_img, Image.open(pvd_img_path) as pvd_img:
+            if ref_img.size != pvd_img.size:
+                raise ValueError("Ref vs embedded image not matching")
+
+            ref_pixels = ref_img.load()
+            pvd_pixels = pvd_img.load()
 
-        return self.extract_data(ref_image_path, secret_op_file, pvd_img_path)
+            lanes, header = pvd_lib._probe_lanes(ref_img, pvd_pixels, with_header=True)
+            if lanes is None:
+                raise ValueError("Image has no channels to carry data: {}".format(ref_img.mode))
+
+            compression = self.compression
+            if compression == PVD_COMPRESSION_KEEP:
+                compression = PVD_CODEC_NAMES[header.codec]
+            bits_reader = file_bits_reader(secret_file_path, compression, header.chunk_size, lanes=lanes)
+            bits_reader.close_file()
+            if bits_reader.data is None:
+                raise ValueError("Can not read the secret file: {}".format(secret_file_path))
+            new_stream = bytes(bits_reader.data)
+
+            ref_view = lanes.view(ref_pixels)
+            pvd_view = lanes.view(pvd_pixels)
+            old_size = header.encoded_size + PVD_HEADER_SIZE
+            stream_bits = len(new_stream) * PVD_BYTES_TO_BITS
+
+            # prefix sums only over the blocks the old or the new stream reaches
+            needed_bits = max(old_size * PVD_BYTES_TO_BITS, stream_bits)
+            block_prefix = [0]
+            for height_itr, width_itr in lanes.iter_blocks(ref_img.size):
+                if block_prefix[-1] >= needed_bits:
+                    break
+                block_prefix.append(block_prefix[-1] +
+                    sum(slot[3] for slot in pvd_lib._block_slots(ref_view, height_itr, width_itr, lanes)))
+            if stream_bits > block_prefix[-1]:
+                raise ValueError("Secret file size is more than embedding capacity of image - " \
+                    "Embedding capacity: {} bytes, Secret file size: {} bytes".format(
+                        block_prefix[-1] // PVD_BYTES_TO_BITS, len(new_stream)))
+
+            old_stream = pvd_lib._read_bytes(ref_pixels, pvd_pixels, ref_img.size, lanes, None, 0, old_size)
+
+            ranges = pvd_lib._changed_ranges(old_stream, new_stream)
+            blocks = set()
+            for start, end in ranges:
+                first = bisect.bisect_right(block_prefix, start * PVD_BYTES_TO_BITS) - 1
+                last = bisect.bisect_right(block_prefix, end * PVD_BYTES_TO_BITS - 1) - 1
+                blocks.update(range(first, last + 1))
+
+            no_of_matrix_inner = lanes.block_grid(ref_img.size)[1]
+            blocks_touched = 0
+            for block_idx in sorted(blocks):
+                height_itr, width_itr = lanes.block_origin(*divmod(block_idx, no_of_matrix_inner))
+                bit_pos = block_prefix[block_idx]
+                touched = False
+                for h_j, w_i, rgb, bits_reqd in pvd_lib._block_slots(ref_view, height_itr, width_itr, lanes):
+                    value = ref_view[h_j, w_i][rgb]
+                    if bit_pos < stream_bits:
+                        value = pvd_lib.replace_lsbs(value, bits_reqd,
+                            pvd_lib._stream_bits(new_stream, bit_pos, bits_reqd))
+                    bit_pos += bits_reqd
+
+                    c_rgb = pvd_view[h_j, w_i]
+                    if c_rgb[rgb] != value:
+                        c_rgb_list = list(c_rgb)
+                        c_rgb_list[rgb] = value
+                        pvd_view[h_j, w_i] = tuple(c_rgb_list)
+                        touched = True
+                blocks_touched += touched
+
+            pvd_lib._save_image(pvd_img, op_img_path)
+
+        return pvd_update_result(blocks_touched, bisect.bisect_right(block_prefix, stream_bits - 1),
+            sum(end - start for start, end in ranges))
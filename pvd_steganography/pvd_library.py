@@ -0,0 +1,226 @@
+import array
+import bisect
+import collections
+import concurrent.futures
+import hashlib
+import os
+import sqlite3
+from PIL import Image
+from pvd_lib import pvd_lib, pvd_lanes, pvd_header, PVD_BYTES_TO_BITS, PVD_FLAG_TABLE
+
+"""
+Cover library: the covers of a directory with their content hash, size, mode, exact capacity and
+capacity per block row, kept in a SQLite file. A scan recomputes only new and changed files, so
+picking a cover for a payload is a query instead of a pass over the images.
+"""
+
+PVD_LIBRARY_DB = '.pvd_library.sqlite'
+PVD_LIBRARY_EXTENSIONS = ('.png', '.bmp', '.tif', '.tiff')
+PVD_LIBRARY_ORDERS = ('smallest', 'distortion')
+
+PVD_LIBRARY_SCHEMA = """
+CREATE TABLE IF NOT EXISTS covers (
+    path TEXT PRIMARY KEY,
+    mtime_ns INTEGER NOT NULL,
+    file_size INTEGER NOT NULL,
+    sha256 TEXT NOT NULL,
+    width INTEGER NOT NULL,
+    height INTEGER NOT NULL,
+    mode TEXT NOT NULL,
+    lanes_flags INTEGER,
+    table_id INTEGER,
+    header_size INTEGER NOT NULL,
+    capacity INTEGER NOT NULL,
+    row_bits BLOB NOT NULL,
+    row_sq_error BLOB NOT NULL
+);
+CREATE INDEX IF NOT EXISTS covers_capacity ON covers (capacity - header_size);
+CREATE INDEX IF NOT EXISTS covers_sha256 ON covers (sha256);
+CREATE TABLE IF NOT EXISTS settings (name TEXT PRIMARY KEY, value TEXT NOT NULL);
+"""
+
+PVD_LIBRARY_COLUMNS = ('sha256', 'width', 'height', 'mode', 'lanes_flags', 'table_id', 'header_size',
+    'capacity', 'row_bits', 'row_sq_error')
+
+pvd_cover = collections.namedtuple('pvd_cover',
+    ['path', 'width', 'height', 'mode', 'capacity', 'payload_capacity', 'expected_mse'])
+
+pvd_scan_result = collections.namedtuple('pvd_scan_result', ['added', 'updated', 'unchanged', 'removed'])
+
+
+def _file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _index_cover(path, options):
+    # runs in a worker process: one pass over the blocks gives the bits and the expected
+    # squared error of every block row (k random bits in place of k LSBs: (4^k - 1) / 6 per sample)
+    with Image.open(path) as img_obj:
+        width, height = img_obj.size
+        mode = img_obj.mode
+        lanes = pvd_lanes.for_image(img_obj, **options)
+
+        row_bits = array.array('Q', [0])
+        row_sq_error = array.array('d', [0.0])
+        if lanes is not None:
+            pixels = lanes.view(img_obj.load())
+            no_of_matrix_outer, no_of_matrix_inner = lanes.block_grid(img_obj.size)
+            for outer_itr in range(max(0, no_of_matrix_outer)):
+                bits = 0
+                sq_error = 0.0
+                for inner_itr in range(no_of_matrix_inner):
+                    height_itr, width_itr = lanes.block_origin(outer_itr, inner_itr)
+                    for slot in pvd_lib._block_slots(pixels, height_itr, width_itr, lanes):
+                        bits += slot[3]
+                        sq_error += ((1 << (2 * slot[3])) - 1) / 6
+                row_bits.append(row_bits[-1] + bits)
+                row_sq_error.append(row_sq_error[-1] + sq_error)
+
+    if lanes is None:
+        lanes_flags = table_id = None
+        header_size = pvd_header().size
+    else:
+        lanes_flags, table_id = lanes.key
+        fields = {'table_id': table_id} if lanes.flags & PVD_FLAG_TABLE else {}
+        header_size = pvd_header(lanes.flags, **fields).size
+
+    return (_file_sha256(path), width, height, mode, lanes_flags, table_id, header_size,
+        row_bits[-1] // PVD_BYTES_TO_BITS, row_bits.tobytes(), row_sq_error.tobytes())
+
+
+class pvd_library:
+
+    def __init__(self, directory, db_path=None, max_workers=None, use_alpha=False, use_16bit=False,
+            table=None, dense=False):
+        self.directory = directory
+        self.db_path = db_path or os.path.join(directory, PVD_LIBRARY_DB)
+        self.max_workers = max_workers
+        self.options = {'use_alpha': use_alpha, 'use_16bit': use_16bit, 'table': table, 'dense': dense}
+
+        self.db = sqlite3.connect(self.db_path)
+        self.db.executescript(PVD_LIBRARY_SCHEMA)
+
+        # capacities depend on the lane options, an index built with other options is dropped
+        options = repr(sorted(self.options.items()))
+        row = self.db.execute("SELECT value FROM settings WHERE name = 'options'").fetchone()
+        if row is None or row[0] != options:
+            self.db.execute("DELETE FROM covers")
+            self.db.execute("INSERT OR REPLACE INTO settings VALUES ('options', ?)", (options,))
+            self.db.commit()
+
+    def close(self):
+        self.db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _cover_files(self):
+        db_name = os.path.abspath(self.db_path)
+        for root, dirs, files in os.walk(self.directory):
+            dirs.sort()
+            for name in sorted(files):
+                path = os.path.join(root, name)
+                if name.lower().endswith(PVD_LIBRARY_EXTENSIONS) and os.path.abspath(path) != db_name:
+                    yield os.path.relpath(path, self.directory)
+
+    def scan(self, progress=None):
+        # new and changed files are indexed (in parallel), removed ones are dropped;
+        # a copy or a move of an indexed file is recognised by its hash and not recomputed
+        known = {row[0]: row[1:] for row in self.db.execute("SELECT path, mtime_ns, file_size FROM covers")}
+
+        present = set()
+        stale = []
+        for rel_path in self._cover_files():
+            present.add(rel_path)
+            st = os.stat(os.path.join(self.directory, rel_path))
+            if known.get(rel_path) != (st.st_mtime_ns, st.st_size):
+                stale.append((rel_path, st.st_mtime_ns, st.st_size))
+
+        to_index = []
+        rows = []
+        for rel_path, mtime_ns, file_size in stale:
+            sha256 = _file_sha256(os.path.join(self.directory, rel_path))
+            same = self.db.execute("SELECT {} FROM covers WHERE sha256 = ? AND path != ? LIMIT 1".format(
+                ', '.join(PVD_LIBRARY_COLUMNS)), (sha256, rel_path)).fetchone()
+            if same is not None:
+                rows.append((rel_path, mtime_ns, file_size) + tuple(same))
+            else:
+                to_index.append((rel_path, mtime_ns, file_size))
+
+        if to_index:
+            with concurrent.futures.ProcessPoolExecutor(self.max_workers) as executor:
+                futures = {executor.submit(_index_cover, os.path.join(self.directory, rel_path), self.options):
+                    (rel_path, mtime_ns, file_size) for rel_path, mtime_ns, file_size in to_index}
+                for done, future in enumerate(concurrent.futures.as_completed(futures), 1):
+                    try:
+                        rows.append(futures[future] + future.result())
+                    except (OSError, ValueError) as e:
+                        # not an image Pillow can read, it stays out of the library
+                        print("ERROR: Indexing cover: {} EXCP: {}".format(futures[future][0], e))
+                    if progress:
+                        progress(done, len(futures))
+
+        self.db.executemany("INSERT OR REPLACE INTO covers (path, mtime_ns, file_size, {}) VALUES ({})".format(
+            ', '.join(PVD_LIBRARY_COLUMNS), ', '.join('?' * (len(PVD_LIBRARY_COLUMNS) + 3))), rows)
+        # the rows of removed files go last, a moved file reuses its row above
+        removed = [path for path in known if path not in present]
+        self.db.executemany("DELETE FROM covers WHERE path = ?", [(path,) for path in removed])
+        self.db.commit()
+
+        updated = sum(1 for row in rows if row[0] in known)
+        return pvd_scan_result(len(rows) - updated, updated, len(present) - len(stale), len(removed))
+
+    @staticmethod
+    def _expected_mse(row_bits_blob, row_sq_error_blob, payload_bits, samples):
+        # squared error of the block rows the payload covers, the last one in proportion
+        row_bits = array.array('Q', row_bits_blob)
+        row_sq_error = array.array('d', row_sq_error_blob)
+        row = min(bisect.bisect_right(row_bits, payload_bits) - 1, len(row_bits) - 2)
+        if row < 0:
+            return 0.0
+        span = row_bits[row + 1] - row_bits[row]
+        part = (payload_bits - row_bits[row]) / span if span else 0.0
+        sq_error = row_sq_error[row] + part * (row_sq_error[row + 1] - row_sq_error[row])
+        return sq_error / samples
+
+    def best(self, payload_size, order='smallest', limit=5):
+        # covers a payload of payload_size bytes fits into (uncompressed, with its header):
+        # 'smallest' - the least spare capacity first, 'distortion' - the lowest expected MSE first
+        if order not in PVD_LIBRARY_ORDERS:
+            raise ValueError("Unknown order: {}".format(order))
+
+        query = "SELECT path, width, height, mode, capacity, header_size, row_bits, row_sq_error FROM covers " \
+            "WHERE capacity - header_size >= ? ORDER BY capacity - header_size, path"
+        if order == 'smallest':
+            query += " LIMIT {:d}".format(limit)
+
+        covers = []
+        for path, width, height, mode, capacity, header_size, row_bits, row_sq_error in \
+                self.db.execute(query, (payload_size,)):
+            samples = width * height * Image.getmodebands(mode)
+            mse = pvd_library._expected_mse(row_bits, row_sq_error,
+                (payload_size + header_size) * PVD_BYTES_TO_BITS, samples)
+            covers.append(pvd_cover(os.path.join(self.directory, path), width, height, mode,
+                capacity, capacity - header_size, mse))
+
+        if order == 'distortion':
+            covers.sort(key=lambda cover: cover.expected_mse)
+        return covers[:limit]
+
+    def row_prefix(self, path):
+        # bits embedded before every block row of the cover (capacity prefix sums)
+        row = self.db.execute("SELECT row_bits FROM covers WHERE path = ?",
+            (os.path.relpath(path, self.directory),)).fetchone()
+        if row is None:
+            raise ValueError("Cover is not in the library: {}".format(path))
+        return array.array('Q', row[0]).tolist()
+
+    def __len__(self):
+        return self.db.execute("SELECT COUNT(*) FROM covers").fetchone()[0]
@@ -0,0 +1,98 @@
+import argparse
+import collections
+import concurrent.futures
+import http.client
+import io
+import json
+import os
+import time
+from PIL import Image
+
+
+def make_cover(width, height):
+    buf = io.BytesIO()
+    Image.frombytes('RGB', (width, height), os.urandom(width * height * 3)).save(buf, format='PNG')
+    return buf.getvalue()
+
+
+def post(host, port, path, body, headers):
+    conn = http.client.HTTPConnection(host, port, timeout=300)
+    started = time.perf_counter()
+    try:
+        conn.request('POST', path, body=body, headers=headers)
+        response = conn.getresponse()
+        data = response.read()
+        return response.status, data, time.perf_counter() - started
+    except (ConnectionError, http.client.HTTPException):
+        # the service closes the connection right after a 429 without reading the upload
+        return 'closed', b'', time.perf_counter() - started
+    finally:
+        conn.close()
+
+
+def get_json(host, port, path):
+    conn = http.client.HTTPConnection(host, port, timeout=30)
+    try:
+        conn.request('GET', path)
+        return json.loads(conn.getresponse().read())
+    finally:
+        conn.close()
+
+
+def run_embed_extract(host, port, cover, secret, retries):
+    for _ in range(retries + 1):
+        status, stego, embed_s = post(host, port, '/embed', cover + secret, {'X-Cover-Length': str(len(cover))})
+        if status not in (429, 503):
+            break
+        # Retry-After of the service is 1 s
+        time.sleep(1)
+    if status != 200:
+        return status, embed_s, None
+
+    status, extracted, extract_s = post(host, port, '/extract', cover + stego, {'X-Ref-Length': str(len(cover))})
+    if status != 200:
+        return status, embed_s + extract_s, None
+    return status, embed_s + extract_s, extracted == secret
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(p * len(values)))] if values else float('nan')
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Load test for pvd_server.py on localhost")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--requests', type=int, default=50, help="embed + extract round trips")
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--size', type=int, default=300, help="cover width and height in pixels")
+    parser.add_argument('--secret', type=int, default=2000, help="secret size in bytes")
+    parser.add_argument('--retries', type=int, default=0, help="retries of an embed rejected with 429/503")
+    args = parser.parse_args()
+
+    cover = make_cover(args.size, args.size)
+    secret = os.urandom(args.secret)
+
+    statuses = collections.Counter()
+    latencies = []
+    mismatches = 0
+    started = time.perf_counter()
+    with concurrent.futures.ThreadPoolExecutor(args.concurrency) as executor:
+        futures = [executor.submit(run_embed_extract, args.host, args.port, cover, secret, args.retries)
+            for _ in range(args.requests)]
+        for future in concurrent.futures.as_completed(futures):
+            status, seconds, matched = future.result()
+            statuses[status] += 1
+            if status == 200:
+                latencies.append(seconds)
+                mismatches += matched is False
+    elapsed = time.perf_counter() - started
+
+    print("round trips: {} in {:.2f} s ({:.2f}/s), concurrency {}".format(args.requests, elapsed,
+        args.requests / elapsed, args.concurrency))
+    print("statuses: {}".format(dict(statuses)))
+    print("latency s: p50 {:.3f} p95 {:.3f} p99 {:.3f} max {:.3f}".format(percentile(latencies, 0.50),
+        percentile(latencies, 0.95), percentile(latencies, 0.99), max(latencies, default=float('nan'))))
+    print("payload mismatches: {}".format(mismatches))
+    print("server metrics: {}".format(json.dumps(get_json(args.host, args.port, '/metrics'), indent=2)))
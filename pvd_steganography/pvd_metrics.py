@@ -1,17 +1,20 @@
 import math
 import os
-import numpy as np
 from PIL import Image
-from skimage.metrics import structural_similarity as ssim
-import matplotlib.pyplot as plt
 from pvd_lib import pvd_lib
 
+# numpy, skimage and matplotlib are imported inside the methods that need them,
+# so importing this module for a capacity query stays cheap
+
 
 class PVDSteganographyAnalyzer:
     def __init__(self):
         self.pvd = pvd_lib()
 
     def calculate_quality_metrics(self, original_path, stego_path):
+        import numpy as np
+        from skimage.metrics import structural_similarity as ssim
+
         original = Image.open(original_path)
         stego = Image.open(stego_path)
 
@@ -57,6 +60,9 @@ class PVDSteganographyAnalyzer:
         }
 
     def analyze_histograms(self, original_path, stego_path):
+        import numpy as np
+        import matplotlib.pyplot as plt
+
         original = Image.open(original_path).convert('RGB')
         stego = Image.open(stego_path).convert('RGB')
 
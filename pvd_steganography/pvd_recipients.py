@@ -0,0 +1,180 @@
+import hashlib
+import heapq
+import random
+from PIL import Image
+from pvd_lib import pvd_lib, pvd_lanes, pvd_header, file_bits_reader, file_bits_writer, \
+    PVD_COMPRESSION_AUTO, PVD_BYTES_TO_BITS, PVD_HEADER_SIZE, PVD_LANE_FLAGS, PVD_FLAG_SET_TAG, PVD_BYTE_ORDER
+
+"""
+Several payloads in one cover: the blocks are split into disjoint sets, one per recipient, and
+every payload (with its own header) goes into its set in block order. The split comes from a key:
+the blocks are shuffled with it and dealt one by one to the set with the least capacity so far,
+so the sets get about the same capacity. A recipient needs the reference image, the key, the
+number of sets and its own index, and decodes only the blocks of its set. The header of every
+payload holds a tag of (key, number of sets, index), so a wrong key or index is an error, not the
+header of another set read as its own.
+The payloads are not encrypted: whoever has the key can read every set.
+"""
+
+
+class pvd_recipients:
+
+    def __init__(self, compression=PVD_COMPRESSION_AUTO, chunk_size=None, use_alpha=False, use_16bit=False,
+            table=None, dense=False):
+        pvd_lib.check_options(compression, chunk_size)
+        self.compression = compression
+        self.chunk_size = chunk_size
+        self.options = {'use_alpha': use_alpha, 'use_16bit': use_16bit, 'table': table, 'dense': dense}
+
+    @staticmethod
+    def layout(block_bits, key, count):
+        # owner[k] - the set block k belongs to
+        if count < 1:
+            raise ValueError("Number of recipients should be positive: {}".format(count))
+        if isinstance(key, str):
+            key = key.encode()
+
+        order = list(range(len(block_bits)))
+        random.Random(hashlib.sha256(key).digest()).shuffle(order)
+
+        owner = [0] * len(block_bits)
+        sets = [(0, set_idx) for set_idx in range(count)]
+        for block_idx in order:
+            set_bits, set_idx = heapq.heappop(sets)
+            owner[block_idx] = set_idx
+            heapq.heappush(sets, (set_bits + block_bits[block_idx], set_idx))
+        return owner
+
+    @staticmethod
+    def set_tag(key, count, index):
+        if isinstance(key, str):
+            key = key.encode()
+        digest = hashlib.sha256(b'pvd set tag' + key + count.to_bytes(4, PVD_BYTE_ORDER) +
+            index.to_bytes(4, PVD_BYTE_ORDER)).digest()
+        return int.from_bytes(digest[:8], PVD_BYTE_ORDER)
+
+    def _layout(self, ref_image_path, img_obj, key, count):
+        lanes = pvd_lanes.for_image(img_obj, **self.options)
+        if lanes is None:
+            raise ValueError("Image has no channels to carry data: {}".format(img_obj.mode))
+
+        block_prefix = pvd_lib._block_capacity_prefix(ref_image_path, lanes)
+        block_bits = [block_prefix[k + 1] - block_prefix[k] for k in range(len(block_prefix) - 1)]
+        owner = pvd_recipients.layout(block_bits, key, count)
+
+        capacities = [0] * count
+        for block_idx, bits in enumerate(block_bits):
+            capacities[owner[block_idx]] += bits
+        return lanes, owner, capacities
+
+    def capacity(self, ref_image_path, key, count):
+        # embedding capacity of every set in bytes
+        with Image.open(ref_image_path) as img_obj:
+            _, _, capacities = self._layout(ref_image_path, img_obj, key, count)
+        return [bits // PVD_BYTES_TO_BITS for bits in capacities]
+
+    def embed(self, ref_image_path, secret_file_paths, op_img_path, key):
+        # one pass over the blocks for all payloads, [embedded bits] per recipient
+        count = len(secret_file_paths)
+        with Image.open(ref_image_path) as img_obj:
+            lanes, owner, capacities = self._layout(ref_image_path, img_obj, key, count)
+
+            bits_readers = [file_bits_reader(path, self.compression, self.chunk_size, lanes=lanes,
+                set_tag=pvd_recipients.set_tag(key, count, set_idx))
+                for set_idx, path in enumerate(secret_file_paths)]
+            for set_idx, bits_reader in enumerate(bits_readers):
+                bits_reader.close_file()
+                if bits_reader.data is None:
+                    raise ValueError("Can not read the secret file of recipient {}".format(set_idx))
+                if bits_reader.total_bytes * PVD_BYTES_TO_BITS > capacities[set_idx]:
+                    raise ValueError("Secret file size of recipient {} is more than the capacity of its blocks - " \
+                        "Embedding capacity: {} bytes, Secret file size: {} bytes".format(
+                            set_idx, capacities[set_idx] // PVD_BYTES_TO_BITS, bits_reader.total_bytes))
+
+            pixels = lanes.view(img_obj.load())
+            embedded_ds = [0] * count
+            done = [False] * count
+            remaining = count
+            for block_idx, (height_itr, width_itr) in enumerate(lanes.iter_blocks(img_obj.size)):
+                set_idx = owner[block_idx]
+                if done[set_idx]:
+                    continue
+
+                bits_reader = bits_readers[set_idx]
+                ref_rgb = pixels[height_itr + 1, width_itr + 1]
+                for d_h, d_w in lanes.offsets:
+                    h_j = height_itr + d_h
+                    w_i = width_itr + d_w
+
+                    c_rgb = pixels[h_j, w_i]
+                    c_rgb_list = list(c_rgb)
+                    for rgb in range(lanes.channels):
+                        bits_reqd = lanes.table(abs(c_rgb[rgb] - ref_rgb[rgb]))
+                        embedded_ds[set_idx] += bits_reqd
+
+                        ret_val = bits_reader.get_bits(bits_reqd)
+                        c_rgb_list[rgb] = pvd_lib.replace_lsbs(c_rgb[rgb], ret_val[2], ret_val[1])
+                        if ret_val[0] == True:
+                            done[set_idx] = True
+                            break
+
+                    pixels[h_j, w_i] = tuple(c_rgb_list)
+                    if done[set_idx]:
+                        remaining -= 1
+                        break
+
+                if remaining == 0:
+                    break
+
+            pvd_lib._save_image(img_obj, op_img_path)
+        return embedded_ds
+
+    def extract(self, ref_image_path, pvd_img_path, secret_op_file, key, count, index):
+        # payload of recipient index (of count), only the blocks of its set are decoded
+        if not 0 <= index < count:
+            raise ValueError("Recipient {} is not one of {}".format(index, count))
+
+        with Image.open(ref_image_path) as ref_img, Image.open(pvd_img_path) as pvd_img:
+            if ref_img.size != pvd_img.size:
+                raise ValueError("Ref vs embedded image not matching")
+
+            lanes, owner, _ = self._layout(ref_image_path, ref_img, key, count)
+            set_tag = pvd_recipients.set_tag(key, count, index)
+            ref_pixels = lanes.view(ref_img.load())
+            pvd_pixels = lanes.view(pvd_img.load())
+
+            bits_writer = file_bits_writer(secret_op_file)
+            if bits_writer.f_obj is None:
+                raise ValueError("Can not open the output file: {}".format(secret_op_file))
+            try:
+                embedded_ds = 0
+                header_size = PVD_HEADER_SIZE
+                stream_size = None
+                for block_idx, (height_itr, width_itr) in enumerate(lanes.iter_blocks(ref_img.size)):
+                    if owner[block_idx] != index:
+                        continue
+
+                    for h_j, w_i, rgb, bits_reqd in pvd_lib._block_slots(ref_pixels, height_itr, width_itr, lanes):
+                        embedded_ds += bits_reqd
+                        bits_writer.set_bits(False, bits_reqd, pvd_lib.get_lsbs(pvd_pixels[h_j, w_i][rgb], bits_reqd))
+
+                        if stream_size is None and bits_writer.bytes_wrote_to_file_so_far >= header_size:
+                            header_size = pvd_header.required_size(bits_writer.data)
+                            if bits_writer.bytes_wrote_to_file_so_far >= header_size:
+                                header = pvd_header.parse(bits_writer.data)
+                                if header.flags & PVD_LANE_FLAGS != lanes.flags:
+                                    raise ValueError("Header lanes do not match: {:#x}".format(
+                                        header.flags & PVD_LANE_FLAGS))
+                                if not header.flags & PVD_FLAG_SET_TAG or header.fields['set_tag'] != set_tag:
+                                    raise ValueError("No payload of recipient {} for this key".format(index))
+                                bits_writer.set_header(header)
+                                stream_size = header.encoded_size + PVD_HEADER_SIZE
+
+                        if stream_size is not None and bits_writer.bytes_wrote_to_file_so_far == stream_size:
+                            bits_writer.close_file()
+                            return embedded_ds
+
+                raise ValueError("Payload of recipient {} is truncated".format(index))
+            except BaseException:
+                bits_writer.abort()
+                raise
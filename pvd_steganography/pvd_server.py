@@ -0,0 +1,371 @@
+import argparse
+import asyncio
+import collections
+import concurrent.futures
+import json
+import os
+import shutil
+import tempfile
+import time
+import urllib.parse
+from pvd_lib import pvd_lib, PVD_COMPRESSION_AUTO
+from pvd_signature import SimpleECDSA, signature_record
+
+"""
+POST /embed      body: [cover image][secret]     X-Cover-Length: cover size    -> image/png
+POST /extract    body: [reference image][stego]  X-Ref-Length: reference size  -> application/octet-stream
+POST /capacity   body: [image]                                                 -> json
+POST /verify?e=..&n=..   body: [reference image][stego]  X-Ref-Length          -> json
+GET  /metrics                                                                  -> json
+"""
+
+HTTP_READ_CHUNK = 1 << 16
+HTTP_MAX_HEADER = 1 << 14
+HTTP_LATENCY_WINDOW = 1000
+
+HTTP_REASONS = {
+    200: 'OK',
+    400: 'Bad Request',
+    404: 'Not Found',
+    405: 'Method Not Allowed',
+    411: 'Length Required',
+    413: 'Payload Too Large',
+    429: 'Too Many Requests',
+    500: 'Internal Server Error',
+    503: 'Service Unavailable',
+}
+
+
+class http_error(Exception):
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+def _job_embed(cover_path, secret_path, op_img_path, compression, chunk_size):
+    result = pvd_lib(compression, chunk_size).pvd_embed(cover_path, secret_path, op_img_path)
+    if not result:
+        raise ValueError("Secret file size is more than embedding capacity of image")
+    return result
+
+
+def _job_extract(ref_image_path, secret_op_file, pvd_img_path):
+    return pvd_lib().pvd_extract(ref_image_path, secret_op_file, pvd_img_path)
+
+
+def _job_capacity(image_path):
+    return pvd_lib._embed_capacity(image_path)
+
+
+def _job_verify(ref_image_path, pvd_img_path, public_key):
+    with tempfile.NamedTemporaryFile(delete=False) as tmp_sig:
+        sig_path = tmp_sig.name
+    try:
+        embedded_ds = pvd_lib().pvd_extract(ref_image_path, sig_path, pvd_img_path)
+        if not embedded_ds or embedded_ds < 0:
+            raise ValueError("No embedded signature found")
+        with open(sig_path, "rb") as f:
+            key_id, sig_bytes, message = signature_record.unpack(f.read())
+    finally:
+        # a failed extraction removes the output itself
+        if os.path.exists(sig_path):
+            os.unlink(sig_path)
+
+    message = message.decode('utf-8')
+    signature = signature_record.signature_from_bytes(sig_bytes)
+    return {
+        'valid': SimpleECDSA.verify_signature(message, signature, public_key),
+        'key_match': key_id == signature_record.key_id(public_key),
+        'key_id': key_id.hex(),
+        'message': message,
+    }
+
+
+class pvd_metrics:
+
+    def __init__(self):
+        self.started = time.time()
+        self.requests = collections.Counter()
+        self.statuses = collections.Counter()
+        self.latency = collections.defaultdict(lambda: collections.deque(maxlen=HTTP_LATENCY_WINDOW))
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    def observe(self, endpoint, status, seconds):
+        self.requests[endpoint] += 1
+        self.statuses[status] += 1
+        self.latency[endpoint].append(seconds)
+
+    @staticmethod
+    def _percentile(values, p):
+        if not values:
+            return None
+        values = sorted(values)
+        return values[min(len(values) - 1, int(p * len(values)))]
+
+    def snapshot(self, workers):
+        return {
+            'uptime_s': time.time() - self.started,
+            'in_flight': self.in_flight,
+            'queue_depth': max(0, self.in_flight - workers),
+            'max_in_flight': self.max_in_flight,
+            'requests': dict(self.requests),
+            'statuses': {str(k): v for k, v in self.statuses.items()},
+            'latency_s': {endpoint: {
+                'p50': pvd_metrics._percentile(values, 0.50),
+                'p95': pvd_metrics._percentile(values, 0.95),
+                'p99': pvd_metrics._percentile(values, 0.99),
+                'max': max(values) if values else None,
+            } for endpoint, values in self.latency.items()},
+        }
+
+
+class pvd_http_server:
+
+    def __init__(self, host='127.0.0.1', port=8080, workers=None, max_queue=None, max_body=64 << 20):
+        self.host = host
+        self.port = port
+        self.workers = workers or os.cpu_count() or 1
+        # jobs allowed to wait for a free worker, the rest is rejected with 429
+        self.max_queue = self.workers * 2 if max_queue is None else max_queue
+        self.max_body = max_body
+        self.executor = None
+        self.metrics = pvd_metrics()
+
+    async def serve(self):
+        self.executor = concurrent.futures.ProcessPoolExecutor(self.workers)
+        try:
+            server = await asyncio.start_server(self.handle, self.host, self.port, limit=HTTP_MAX_HEADER)
+            print("PVD service on http://{}:{} workers: {} queue: {}".format(self.host, self.port,
+                self.workers, self.max_queue))
+            async with server:
+                await server.serve_forever()
+        finally:
+            self.executor.shutdown(cancel_futures=True)
+
+    async def handle(self, reader, writer):
+        started = time.perf_counter()
+        endpoint = None
+        status = 500
+        work_dir = None
+        admitted = False
+        try:
+            method, path, query, headers = await self.read_head(reader)
+            endpoint = path
+
+            if path == '/metrics':
+                if method != 'GET':
+                    raise http_error(405, "Use GET")
+                status = 200
+                await self.send_json(writer, status, self.metrics.snapshot(self.workers))
+                return
+
+            handler = {
+                '/embed': self.do_embed,
+                '/extract': self.do_extract,
+                '/capacity': self.do_capacity,
+                '/verify': self.do_verify,
+            }.get(path)
+            if handler is None:
+                raise http_error(404, "Unknown endpoint: {}".format(path))
+            if method != 'POST':
+                raise http_error(405, "Use POST")
+
+            # admission before the body is read, so a saturated service does not buffer uploads
+            if self.metrics.in_flight >= self.workers + self.max_queue:
+                raise http_error(429, "Too many requests in flight: {}".format(self.metrics.in_flight))
+            admitted = True
+            self.metrics.in_flight += 1
+            self.metrics.max_in_flight = max(self.metrics.max_in_flight, self.metrics.in_flight)
+
+            work_dir = tempfile.mkdtemp(prefix='pvd_http_')
+            status = await handler(reader, writer, query, headers, work_dir)
+
+        except http_error as e:
+            status = e.status
+            retry = {'Retry-After': 1} if status in (429, 503) else None
+            await self.send_json(writer, status, {'error': str(e)}, retry)
+        except concurrent.futures.process.BrokenProcessPool as e:
+            status = 503
+            await self.send_json(writer, status, {'error': "Worker pool is unavailable: {}".format(e)}, {'Retry-After': 1})
+        except (ValueError, OSError) as e:
+            status = 400
+            await self.send_json(writer, status, {'error': str(e)})
+        except Exception as e:
+            status = 500
+            await self.send_json(writer, status, {'error': str(e)})
+        finally:
+            if admitted:
+                self.metrics.in_flight -= 1
+            if work_dir:
+                shutil.rmtree(work_dir, ignore_errors=True)
+            if endpoint:
+                self.metrics.observe(endpoint, status, time.perf_counter() - started)
+            writer.close()
+
+    async def read_head(self, reader):
+        try:
+            head = await reader.readuntil(b'\r\n\r\n')
+        except asyncio.LimitOverrunError:
+            raise http_error(413, "Request header is too large")
+        except asyncio.IncompleteReadError:
+            raise http_error(400, "Incomplete request")
+
+        lines = head.decode('latin-1').split('\r\n')
+        try:
+            method, target, _ = lines[0].split(' ', 2)
+        except ValueError:
+            raise http_error(400, "Malformed request line")
+
+        headers = {}
+        for line in lines[1:]:
+            if ':' in line:
+                name, value = line.split(':', 1)
+                headers[name.strip().lower()] = value.strip()
+
+        url = urllib.parse.urlsplit(target)
+        query = {k: v[-1] for k, v in urllib.parse.parse_qs(url.query).items()}
+        return method.upper(), url.path, query, headers
+
+    def body_length(self, headers):
+        if 'transfer-encoding' in headers:
+            raise http_error(411, "Chunked request bodies are not supported, send Content-Length")
+        if 'content-length' not in headers:
+            raise http_error(411, "Content-Length is required")
+
+        length = int(headers['content-length'])
+        if length > self.max_body:
+            raise http_error(413, "Request body is larger than {} bytes".format(self.max_body))
+        return length
+
+    @staticmethod
+    def split_length(headers, name, total):
+        if name not in headers:
+            raise http_error(400, "{} header is required".format(name))
+        first = int(headers[name])
+        if first < 0 or first > total:
+            raise http_error(400, "{} is out of range".format(name))
+        return first
+
+    @staticmethod
+    async def read_to_files(reader, parts):
+        # streams the body into files chunk by chunk - parts: [(path, size)]
+        for path, size in parts:
+            with open(path, "wb") as f:
+                while size > 0:
+                    chunk = await reader.read(min(size, HTTP_READ_CHUNK))
+                    if not chunk:
+                        raise http_error(400, "Request body is shorter than Content-Length")
+                    f.write(chunk)
+                    size -= len(chunk)
+
+    async def run_job(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.executor, func, *args)
+
+    async def do_embed(self, reader, writer, query, headers, work_dir):
+        compression = query.get('compression', PVD_COMPRESSION_AUTO)
+        try:
+            chunk_size = int(query['chunk_size']) if 'chunk_size' in query else None
+            pvd_lib.check_options(compression, chunk_size)
+        except ValueError as e:
+            raise http_error(400, str(e))
+
+        total = self.body_length(headers)
+        cover_size = pvd_http_server.split_length(headers, 'x-cover-length', total)
+
+        cover_path = os.path.join(work_dir, 'cover')
+        secret_path = os.path.join(work_dir, 'secret')
+        op_img_path = os.path.join(work_dir, 'stego.png')
+        await pvd_http_server.read_to_files(reader, [(cover_path, cover_size), (secret_path, total - cover_size)])
+
+        embedded_ds = await self.run_job(_job_embed, cover_path, secret_path, op_img_path, compression, chunk_size)
+
+        await self.send_file(writer, 200, op_img_path, 'image/png', {'X-Embedded-Bits': embedded_ds})
+        return 200
+
+    async def do_extract(self, reader, writer, query, headers, work_dir):
+        total = self.body_length(headers)
+        ref_size = pvd_http_server.split_length(headers, 'x-ref-length', total)
+
+        ref_path = os.path.join(work_dir, 'ref')
+        pvd_path = os.path.join(work_dir, 'stego')
+        secret_path = os.path.join(work_dir, 'secret')
+        await pvd_http_server.read_to_files(reader, [(ref_path, ref_size), (pvd_path, total - ref_size)])
+
+        embedded_ds = await self.run_job(_job_extract, ref_path, secret_path, pvd_path)
+        if not embedded_ds or embedded_ds < 0:
+            raise http_error(400, "No embedded data found")
+
+        await self.send_file(writer, 200, secret_path, 'application/octet-stream', {'X-Embedded-Bits': embedded_ds})
+        return 200
+
+    async def do_capacity(self, reader, writer, query, headers, work_dir):
+        image_path = os.path.join(work_dir, 'image')
+        await pvd_http_server.read_to_files(reader, [(image_path, self.body_length(headers))])
+
+        capacity = await self.run_job(_job_capacity, image_path)
+        await self.send_json(writer, 200, {'capacity': capacity})
+        return 200
+
+    async def do_verify(self, reader, writer, query, headers, work_dir):
+        try:
+            public_key = (int(query['e']), int(query['n']))
+        except (KeyError, ValueError):
+            raise http_error(400, "Public key is required: ?e=...&n=...")
+
+        total = self.body_length(headers)
+        ref_size = pvd_http_server.split_length(headers, 'x-ref-length', total)
+
+        ref_path = os.path.join(work_dir, 'ref')
+        pvd_path = os.path.join(work_dir, 'stego')
+        await pvd_http_server.read_to_files(reader, [(ref_path, ref_size), (pvd_path, total - ref_size)])
+
+        result = await self.run_job(_job_verify, ref_path, pvd_path, public_key)
+        await self.send_json(writer, 200, result)
+        return 200
+
+    @staticmethod
+    def send_head(writer, status, content_type, length, extra_headers=None):
+        head = ["HTTP/1.1 {} {}".format(status, HTTP_REASONS.get(status, '')),
+                "Content-Type: {}".format(content_type),
+                "Content-Length: {}".format(length),
+                "Connection: close"]
+        for name, value in (extra_headers or {}).items():
+            head.append("{}: {}".format(name, value))
+        writer.write(("\r\n".join(head) + "\r\n\r\n").encode('latin-1'))
+
+    @staticmethod
+    async def send_json(writer, status, obj, extra_headers=None):
+        body = json.dumps(obj).encode('utf-8')
+        try:
+            pvd_http_server.send_head(writer, status, 'application/json', len(body), extra_headers)
+            writer.write(body)
+            await writer.drain()
+        except ConnectionError:
+            pass
+
+    @staticmethod
+    async def send_file(writer, status, path, content_type, extra_headers=None):
+        pvd_http_server.send_head(writer, status, content_type, os.path.getsize(path), extra_headers)
+        with open(path, "rb") as f:
+            while True:
+                chunk = f.read(HTTP_READ_CHUNK)
+                if not chunk:
+                    break
+                writer.write(chunk)
+                await writer.drain()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="PVD embed/extract HTTP service")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--workers', type=int, default=None, help="worker processes, CPU count by default")
+    parser.add_argument('--queue', type=int, default=None, help="jobs waiting for a worker before 429, 2x workers by default")
+    parser.add_argument('--max-body', type=int, default=64 << 20, help="request body limit in bytes")
+    args = parser.parse_args()
+
+    try:
+        asyncio.run(pvd_http_server(args.host, args.port, args.workers, args.queue, args.max_body).serve())
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,133 @@
+import concurrent.futures
+import hashlib
+import os
+import tempfile
+from pvd_lib import pvd_lib, pvd_header, file_bits_reader, \
+    PVD_COMPRESSION_AUTO, PVD_FLAG_SHARD, PVD_BYTE_ORDER
+
+# header of a shard: [header 11][flags 2][seq 2][total 2][sha256 32]
+PVD_SHARD_HEADER_SIZE = pvd_header(PVD_FLAG_SHARD, shard_seq=0, shard_total=0, payload_hash=0).size
+
+
+def _embed_shard(cover_path, op_img_path, data, shard, compression):
+    bits_reader = file_bits_reader(None, compression, data=data, shard=shard)
+    return pvd_lib(compression).embed_data(cover_path, None, op_img_path, bits_reader)
+
+
+def _extract_shard(ref_image_path, pvd_img_path, header=None):
+    # header - the header of the image when the caller has read it already
+    pvd = pvd_lib()
+    if header is None:
+        header = pvd.read_header(ref_image_path, pvd_img_path)
+    if not header.flags & PVD_FLAG_SHARD:
+        raise ValueError("Image is not a shard: {}".format(pvd_img_path))
+
+    with tempfile.NamedTemporaryFile(delete=False) as tmp_shard:
+        shard_path = tmp_shard.name
+    try:
+        if pvd.extract_data(ref_image_path, shard_path, pvd_img_path) <= 0:
+            raise ValueError("Shard payload is truncated: {}".format(pvd_img_path))
+        with open(shard_path, "rb") as f:
+            data = f.read()
+    finally:
+        if os.path.exists(shard_path):
+            os.unlink(shard_path)
+
+    return header.fields['shard_seq'], header.fields['shard_total'], header.fields['payload_hash'], data
+
+
+class pvd_shard:
+
+    def __init__(self, max_workers=None, compression=PVD_COMPRESSION_AUTO):
+        pvd_lib.check_options(compression)
+        self.max_workers = max_workers
+        self.compression = compression
+
+    @staticmethod
+    def plan(capacities, payload_size):
+        # [(cover index, start, end)] - payload byte ranges in proportion to the capacity of the covers
+        usable = [max(0, cap - PVD_SHARD_HEADER_SIZE) for cap in capacities]
+        total_usable = sum(usable)
+        if not usable or total_usable < payload_size:
+            raise ValueError("Secret file size is more than embedding capacity of all images - " \
+                "Embedding capacity: {} bytes, Secret file size: {} bytes".format(total_usable, payload_size))
+
+        sizes = [payload_size * cap // total_usable for cap in usable]
+        rest = payload_size - sum(sizes)
+        for cover_idx in sorted(range(len(usable)), key=lambda i: usable[i] - sizes[i], reverse=True):
+            if rest == 0:
+                break
+            extra = min(rest, usable[cover_idx] - sizes[cover_idx])
+            sizes[cover_idx] += extra
+            rest -= extra
+
+        if payload_size == 0:
+            return [(usable.index(max(usable)), 0, 0)]
+
+        shards = []
+        start = 0
+        for cover_idx, size in enumerate(sizes):
+            if size > 0:
+                shards.append((cover_idx, start, start + size))
+                start += size
+        return shards
+
+    def embed(self, cover_paths, secret_file_path, op_img_paths):
+        if len(cover_paths) != len(op_img_paths):
+            raise ValueError("Number of covers and output images should match")
+
+        with open(secret_file_path, "rb") as f:
+            data = f.read()
+        payload_hash = int.from_bytes(hashlib.sha256(data).digest(), PVD_BYTE_ORDER)
+
+        with concurrent.futures.ProcessPoolExecutor(self.max_workers) as executor:
+            capacities = list(executor.map(pvd_lib._embed_capacity, cover_paths))
+            shards = pvd_shard.plan(capacities, len(data))
+
+            futures = []
+            for seq, (cover_idx, start, end) in enumerate(shards):
+                futures.append(executor.submit(_embed_shard, cover_paths[cover_idx], op_img_paths[cover_idx],
+                    data[start:end], (seq, len(shards), payload_hash), self.compression))
+
+            embedded_ds = []
+            for (cover_idx, _, _), future in zip(shards, futures):
+                bits = future.result()
+                if not bits:
+                    raise ValueError("Embedding into cover {} failed".format(cover_idx))
+                embedded_ds.append((op_img_paths[cover_idx], bits))
+
+        # [(output image, embedded bits)] in shard order, covers left unused are not written
+        return embedded_ds
+
+    def extract(self, ref_image_paths, secret_op_file, pvd_img_paths):
+        # ref_image_paths[i] is the cover of pvd_img_paths[i], the pairs may come in any order
+        if len(ref_image_paths) != len(pvd_img_paths):
+            raise ValueError("Number of reference and embedded images should match")
+
+        shards = {}
+        shard_total = None
+        payload_hash = None
+        with concurrent.futures.ProcessPoolExecutor(self.max_workers) as executor:
+            futures = [executor.submit(_extract_shard, ref_path, pvd_path)
+                for ref_path, pvd_path in zip(ref_image_paths, pvd_img_paths)]
+
+            for future in concurrent.futures.as_completed(futures):
+                seq, total, s_hash, data = future.result()
+                if shard_total is None:
+                    shard_total, payload_hash = total, s_hash
+                if total != shard_total or s_hash != payload_hash:
+                    raise ValueError("Shard {} belongs to another payload".format(seq))
+                if seq in shards:
+                    raise ValueError("Duplicate shard: {}".format(seq))
+                shards[seq] = data
+
+        if shard_total is None or sorted(shards) != list(range(shard_total)):
+            raise ValueError("Missing shards: {}".format(sorted(set(range(shard_total or 0)) - set(shards))))
+
+        data = b''.join(shards[seq] for seq in range(shard_total))
+        if int.from_bytes(hashlib.sha256(data).digest(), PVD_BYTE_ORDER) != payload_hash:
+            raise ValueError("Payload hash mismatch")
+
+        with open(secret_op_file, "wb") as f:
+            f.write(data)
+        return len(data)
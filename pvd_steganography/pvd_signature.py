@@ -0,0 +1,130 @@
+import hashlib
+import random
+import struct
+
+SIG_RECORD_MAGIC = b'PVDS'
+SIG_RECORD_VERSION = 1
+SIG_KEY_ID_SIZE = 8
+
+# magic, version, key id length
+SIG_RECORD_HEAD = struct.Struct('>4sBB')
+SIG_LENGTH_FIELD = struct.Struct('>H')
+MSG_LENGTH_FIELD = struct.Struct('>I')
+
+SIG_BYTE_ORDER = 'big'
+
+
+class SimpleECDSA:
+    #упрощенная ЭЦП RSA для интеграции
+    @staticmethod
+    def generate_keys(key_size=512):
+        def is_prime(n, k=128):
+            if n < 2: return False
+            for _ in range(k):
+                a = random.randrange(2, n - 1)
+                if pow(a, n - 1, n) != 1:
+                    return False
+            return True
+
+        def generate_prime(bits):
+            while True:
+                p = random.getrandbits(bits)
+                p |= (1 << bits - 1) | 1
+                if is_prime(p):
+                    return p
+
+        p = generate_prime(key_size // 2)
+        q = generate_prime(key_size // 2)
+        n = p * q
+        phi = (p - 1) * (q - 1)
+        e = 65537
+        d = pow(e, -1, phi)
+
+        return (e, n), (d, n)
+
+    @staticmethod
+    def hash_message(message):
+        if isinstance(message, str):
+            message = message.encode('utf-8')
+        return int.from_bytes(hashlib.sha256(message).digest(), 'big')
+
+    @staticmethod
+    def create_signature(message, private_key):
+        d, n = private_key
+        message_hash = SimpleECDSA.hash_message(message)
+        signature = pow(message_hash, d, n)
+        return signature
+
+    @staticmethod
+    def verify_signature(message, signature, public_key):
+        #проверка эцп
+        e, n = public_key
+        message_hash = SimpleECDSA.hash_message(message)
+        decrypted_hash = pow(signature, e, n)
+        return message_hash == decrypted_hash
+
+
+class signature_record:
+    """
+    [magic][version][key id len][key id][sig len][sig][msg len][msg]
+    """
+
+    @staticmethod
+    def key_id(public_key):
+        e, n = public_key
+        key_bytes = signature_record.int_to_bytes(e) + signature_record.int_to_bytes(n)
+        return hashlib.sha256(key_bytes).digest()[:SIG_KEY_ID_SIZE]
+
+    @staticmethod
+    def int_to_bytes(value, length=None):
+        if length is None:
+            length = max(1, (value.bit_length() + 7) // 8)
+        return value.to_bytes(length, SIG_BYTE_ORDER)
+
+    @staticmethod
+    def signature_to_bytes(signature, public_key):
+        # подпись всегда занимает столько же байт, сколько модуль n
+        n = public_key[1]
+        return signature_record.int_to_bytes(signature, (n.bit_length() + 7) // 8)
+
+    @staticmethod
+    def signature_from_bytes(sig_bytes):
+        return int.from_bytes(sig_bytes, SIG_BYTE_ORDER)
+
+    @staticmethod
+    def pack(key_id, sig_bytes, message):
+        if isinstance(message, str):
+            message = message.encode('utf-8')
+
+        if len(key_id) > 0xFF or len(sig_bytes) > 0xFFFF or len(message) > 0xFFFFFFFF:
+            raise ValueError("Signature record field is too long")
+
+        return SIG_RECORD_HEAD.pack(SIG_RECORD_MAGIC, SIG_RECORD_VERSION, len(key_id)) + key_id + \
+            SIG_LENGTH_FIELD.pack(len(sig_bytes)) + sig_bytes + \
+                MSG_LENGTH_FIELD.pack(len(message)) + message
+
+    @staticmethod
+    def unpack(data):
+        data = bytes(data)
+        offset = 0
+
+        def take(n):
+            nonlocal offset
+            if offset + n > len(data):
+                raise ValueError("Truncated signature record")
+            chunk = data[offset:offset + n]
+            offset += n
+            return chunk
+
+        magic, version, key_id_len = SIG_RECORD_HEAD.unpack(take(SIG_RECORD_HEAD.size))
+        if magic != SIG_RECORD_MAGIC or version != SIG_RECORD_VERSION:
+            raise ValueError("Invalid signature record... magic: {} versn: {}".format(magic, version))
+
+        key_id = take(key_id_len)
+        sig_bytes = take(SIG_LENGTH_FIELD.unpack(take(SIG_LENGTH_FIELD.size))[0])
+        message = take(MSG_LENGTH_FIELD.unpack(take(MSG_LENGTH_FIELD.size))[0])
+
+        if offset != len(data):
+            raise ValueError("Trailing data after signature record: {} bytes".format(len(data) - offset))
+
+        return key_id, sig_bytes, message
@@ -0,0 +1,68 @@
+import asyncio
+import os
+import time
+import unittest
+from pvd_async import pvd_async
+from pvd_load_test import make_cover
+
+
+async def chunks(data, size=1000):
+    for start in range(0, len(data), size):
+        yield data[start:start + size]
+
+
+class test_async(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        self.cover = make_cover(90, 90)
+        self.pvd = pvd_async(processes=False, max_workers=1)
+
+    async def asyncTearDown(self):
+        self.pvd.close()
+
+    async def test_embed_extract(self):
+        payload = os.urandom(1500)
+        reader = asyncio.StreamReader()
+        reader.feed_data(payload)
+        reader.feed_eof()
+
+        stego = await self.pvd.embed(self.cover, reader)
+        self.assertEqual(await self.pvd.embed(self.cover, chunks(payload)), stego)
+        self.assertEqual(await self.pvd.extract(self.cover, stego), payload)
+        self.assertGreater(await self.pvd.capacity(self.cover), len(payload))
+
+        with self.assertRaises(ValueError):
+            await self.pvd.embed(self.cover, os.urandom(100000))
+        with self.assertRaises(ValueError):
+            await self.pvd.extract(self.cover, self.cover)
+
+    async def test_batch_limit(self):
+        running = 0
+        most = 0
+
+        async def job(value):
+            nonlocal running, most
+            running += 1
+            most = max(most, running)
+            await asyncio.sleep(0.01)
+            running -= 1
+            return value
+
+        self.assertEqual(await self.pvd.batch([job(k) for k in range(10)], limit=3), list(range(10)))
+        self.assertEqual(most, 3)
+
+    async def test_cancel(self):
+        # a cancelled embed gives the only worker back within a few block rows
+        task = asyncio.create_task(self.pvd.embed(make_cover(600, 600), os.urandom(100000)))
+        await asyncio.sleep(0.3)
+        task.cancel()
+        with self.assertRaises(asyncio.CancelledError):
+            await task
+
+        started = time.perf_counter()
+        await self.pvd.capacity(self.cover)
+        self.assertLess(time.perf_counter() - started, 1.0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,252 @@
+import contextlib
+import importlib.util
+import io
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+from PIL import Image
+import pvd_cli
+
+MODULE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# whole "pvd capacity" process: interpreter start, imports and a small image
+PVD_STARTUP_BUDGET = 1.0
+PVD_HEAVY_MODULES = ('numpy', 'skimage', 'matplotlib', 'streamlit')
+
+
+def run_python(code):
+    return subprocess.run([sys.executable, '-c', code], cwd=MODULE_DIR, capture_output=True, text=True, check=True)
+
+
+class test_cli(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.cover = os.path.join(self.tmp_dir.name, 'cover.png')
+        Image.frombytes('RGB', (60, 60), os.urandom(60 * 60 * 3)).save(self.cover)
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_startup_budget(self):
+        best = None
+        for _ in range(3):
+            started = time.perf_counter()
+            subprocess.run([sys.executable, os.path.join(MODULE_DIR, 'pvd_cli.py'), 'capacity', self.cover],
+                capture_output=True, check=True)
+            elapsed = time.perf_counter() - started
+            best = elapsed if best is None else min(best, elapsed)
+        self.assertLess(best, PVD_STARTUP_BUDGET)
+
+    def test_no_heavy_imports(self):
+        out = run_python("import sys, pvd_cli\n"
+            "pvd_cli.main(['capacity', {!r}])\n"
+            "print(sorted(m for m in {!r} if m in sys.modules))".format(self.cover, PVD_HEAVY_MODULES))
+        self.assertEqual(out.stdout.splitlines()[-1], '[]')
+
+    def test_embed_extract(self):
+        secret = os.path.join(self.tmp_dir.name, 'secret.bin')
+        stego = os.path.join(self.tmp_dir.name, 'stego.png')
+        extracted = os.path.join(self.tmp_dir.name, 'extracted.bin')
+        with open(secret, 'wb') as f:
+            f.write(os.urandom(200))
+
+        self.assertEqual(pvd_cli.main(['embed', self.cover, secret, stego, '--dense']), 0)
+        self.assertEqual(pvd_cli.main(['extract', self.cover, stego, extracted]), 0)
+        with open(secret, 'rb') as f1, open(extracted, 'rb') as f2:
+            self.assertEqual(f1.read(), f2.read())
+
+    def test_extract_without_payload(self):
+        extracted = os.path.join(self.tmp_dir.name, 'extracted.bin')
+        self.assertEqual(pvd_cli.main(['extract', self.cover, self.cover, extracted]), 1)
+        self.assertFalse(os.path.exists(extracted))
+
+    def test_update_keeps_codec(self):
+        # update keeps the codec of the replaced payload unless --compression is given
+        from pvd_lib import pvd_lib, PVD_CODECS
+
+        secret = os.path.join(self.tmp_dir.name, 'secret.bin')
+        stego = os.path.join(self.tmp_dir.name, 'stego.png')
+        updated = os.path.join(self.tmp_dir.name, 'updated.png')
+        extracted = os.path.join(self.tmp_dir.name, 'extracted.bin')
+        payload = bytearray(b'pvd ' * 100)
+        for compression in ('none', 'zlib', 'bz2'):
+            with self.subTest(compression=compression):
+                with open(secret, 'wb') as f:
+                    f.write(payload)
+                self.assertEqual(pvd_cli.main(['embed', self.cover, secret, stego, '--compression', compression]), 0)
+                payload[200] ^= 1
+                with open(secret, 'wb') as f:
+                    f.write(payload)
+
+                out = io.StringIO()
+                with contextlib.redirect_stdout(out):
+                    self.assertEqual(pvd_cli.main(['update', self.cover, stego, secret, updated, '-v']), 0)
+                self.assertEqual(pvd_lib().read_header(self.cover, updated).codec, PVD_CODECS[compression])
+                self.assertEqual(pvd_cli.main(['extract', self.cover, updated, extracted]), 0)
+                with open(extracted, 'rb') as f:
+                    self.assertEqual(f.read(), payload)
+                if compression == 'none':
+                    # one changed byte is at most two blocks
+                    blocks_touched = int(out.getvalue().split()[2])
+                    self.assertLessEqual(blocks_touched, 2)
+
+        self.assertEqual(pvd_cli.main(['update', self.cover, stego, secret, updated, '--compression', 'lzma']), 0)
+        self.assertEqual(pvd_lib().read_header(self.cover, updated).codec, PVD_CODECS['lzma'])
+
+    def test_bad_paths(self):
+        # an unreadable secret or an unwritable output is an error message and exit code 1
+        cli = [sys.executable, os.path.join(MODULE_DIR, 'pvd_cli.py')]
+        stego = os.path.join(self.tmp_dir.name, 'stego.png')
+        missing = os.path.join(self.tmp_dir.name, 'missing.bin')
+        secret = os.path.join(self.tmp_dir.name, 'secret.bin')
+        with open(secret, 'wb') as f:
+            f.write(os.urandom(100))
+        self.assertEqual(pvd_cli.main(['embed', self.cover, secret, stego]), 0)
+
+        for args in (['embed', self.cover, missing, stego],
+                ['extract', self.cover, stego, os.path.join(self.tmp_dir.name, 'no', 'such', 'out.bin')]):
+            result = subprocess.run(cli + args, capture_output=True, text=True)
+            self.assertEqual(result.returncode, 1, args)
+            self.assertIn('pvd:', result.stderr)
+            self.assertNotIn('Traceback', result.stderr)
+
+    def test_bad_options(self):
+        # option errors are reported as such, not as a secret file that can not be read
+        from pvd_lib import pvd_lib, file_bits_reader
+
+        secret = os.path.join(self.tmp_dir.name, 'secret.bin')
+        stego = os.path.join(self.tmp_dir.name, 'stego.png')
+        with open(secret, 'wb') as f:
+            f.write(os.urandom(100))
+        for chunk_size in ('-5', '0', '99999999999'):
+            with self.subTest(chunk_size=chunk_size), contextlib.redirect_stderr(io.StringIO()):
+                with self.assertRaises(SystemExit) as error:
+                    pvd_cli.main(['embed', self.cover, secret, stego, '--chunk-size', chunk_size])
+                self.assertEqual(error.exception.code, 2)
+
+        with self.assertRaisesRegex(ValueError, "Unknown compression: bogus"):
+            pvd_lib('bogus')
+        with self.assertRaisesRegex(ValueError, "Chunk size should be between"):
+            pvd_lib(chunk_size=1 << 32)
+        with self.assertRaisesRegex(ValueError, "Unknown compression: bogus"):
+            file_bits_reader(secret, 'bogus')
+        self.assertFalse(os.path.exists(stego))
+
+    def test_pipes(self):
+        # payload from stdin, stego image to stdout and back, nothing but data on stdout
+        cli = [sys.executable, os.path.join(MODULE_DIR, 'pvd_cli.py')]
+        payload = os.urandom(300)
+        embedded = subprocess.run(cli + ['embed', '-v', self.cover, '-', '-'], input=payload, capture_output=True)
+        self.assertEqual(embedded.returncode, 0)
+        self.assertTrue(embedded.stdout.startswith(b'\x89PNG'))
+        self.assertIn(b'embedded bits', embedded.stderr)
+
+        stego = os.path.join(self.tmp_dir.name, 'stego.png')
+        with open(stego, 'wb') as f:
+            f.write(embedded.stdout)
+        extracted = subprocess.run(cli + ['extract', self.cover, stego, '-'], capture_output=True)
+        self.assertEqual(extracted.returncode, 0)
+        self.assertEqual(extracted.stdout, payload)
+
+        missing = subprocess.run(cli + ['extract', self.cover, self.cover, '-'], capture_output=True)
+        self.assertEqual(missing.returncode, 1)
+        self.assertEqual(missing.stdout, b'')
+        self.assertIn(b'pvd:', missing.stderr)
+
+    def test_recipients(self):
+        stego = os.path.join(self.tmp_dir.name, 'stego.png')
+        extracted = os.path.join(self.tmp_dir.name, 'extracted.bin')
+        # seeded covers and payloads: a wrong key or index has to fail on every one of them
+        for seed in range(10):
+            rng = random.Random(seed)
+            Image.frombytes('RGB', (60, 60), rng.randbytes(60 * 60 * 3)).save(self.cover)
+            secrets = []
+            for idx in range(3):
+                secrets.append(os.path.join(self.tmp_dir.name, 'secret_{}.bin'.format(idx)))
+                with open(secrets[-1], 'wb') as f:
+                    f.write(rng.randbytes(100 + idx * 50))
+
+            self.assertEqual(pvd_cli.main(['recipients', 'embed', self.cover, stego] + secrets + ['--key', 'k']), 0)
+            for idx, secret in enumerate(secrets):
+                self.assertEqual(pvd_cli.main(['recipients', 'extract', self.cover, stego, extracted,
+                    '--key', 'k', '--count', '3', '--index', str(idx)]), 0)
+                with open(secret, 'rb') as f1, open(extracted, 'rb') as f2:
+                    self.assertEqual(f1.read(), f2.read())
+
+            # another key or number of sets gives other sets, no payload in them
+            for key, count, idx in (('other', 3, 0), ('other', 3, 2), ('k', 2, 0), ('k', 4, 1)):
+                with self.subTest(seed=seed, key=key, count=count, index=idx):
+                    self.assertEqual(pvd_cli.main(['recipients', 'extract', self.cover, stego, extracted,
+                        '--key', key, '--count', str(count), '--index', str(idx)]), 1)
+                    self.assertFalse(os.path.exists(extracted))
+
+    def test_frames_corrupted(self):
+        # a frame holding a shard header reports its own error, not "Missing frames"
+        from pvd_frames import pvd_frames
+        from pvd_lib import pvd_lib, pvd_lanes
+
+        container = os.path.join(self.tmp_dir.name, 'anim.png')
+        stego = os.path.join(self.tmp_dir.name, 'anim_stego.png')
+        secret = os.path.join(self.tmp_dir.name, 'secret.bin')
+        extracted = os.path.join(self.tmp_dir.name, 'extracted.bin')
+        frames = [Image.frombytes('RGB', (60, 60), os.urandom(60 * 60 * 3)) for _ in range(2)]
+        frames[0].save(container, save_all=True, append_images=frames[1:], duration=100)
+        with open(secret, 'wb') as f:
+            f.write(os.urandom(300))
+
+        pvd = pvd_frames(max_workers=1, compression=None)
+        pvd.embed(container, secret, stego)
+        with Image.open(stego) as img:
+            stego_frames = [img.copy().convert('RGB')]
+            img.seek(1)
+            stego_frames.append(img.copy().convert('RGB'))
+
+        # flip the lowest bit of the slot holding header bit 60: a bit of the two high bytes of the
+        # length field, the header still parses but the payload runs past the image
+        with Image.open(container) as img:
+            ref_pixels = img.convert('RGB').load()
+        bits_done = 0
+        for h_j, w_i, rgb, bits_reqd in pvd_lib._block_slots(ref_pixels, 0, 0, pvd_lanes()) + \
+                pvd_lib._block_slots(ref_pixels, 0, 3, pvd_lanes()):
+            bits_done += bits_reqd
+            if bits_done > 60:
+                break
+        pixel = list(stego_frames[0].getpixel((h_j, w_i)))
+        pixel[rgb] ^= 1
+        stego_frames[0].putpixel((h_j, w_i), tuple(pixel))
+        pvd_frames._save_container(stego_frames, stego, 'PNG', [100, 100], {})
+
+        with self.assertRaises(ValueError) as error:
+            pvd.extract(container, stego, extracted)
+        self.assertIn("truncated", str(error.exception))
+        self.assertFalse(os.path.exists(extracted))
+
+    @unittest.skipUnless(importlib.util.find_spec('numpy'), "needs numpy")
+    def test_heatmap(self):
+        from pvd_lib import pvd_lib, pvd_lanes
+
+        out = io.StringIO()
+        with contextlib.redirect_stdout(out):
+            self.assertEqual(pvd_cli.main(['heatmap', self.cover, '--region', '0', '0', '60', '60',
+                '--region', '3', '6', '30', '31', '--png', os.path.join(self.tmp_dir.name, 'heat.png')]), 0)
+        lines = out.getvalue().splitlines()
+
+        with Image.open(self.cover) as img:
+            lanes = pvd_lanes.for_image(img)
+        prefix = pvd_lib._block_capacity_prefix(self.cover, lanes)
+        self.assertEqual(int(lines[0]), pvd_lib._embed_capacity(self.cover, lanes))
+        self.assertEqual(lines[1], "0 0 60 60 {}".format(lines[0]))
+
+        # legacy order is column by column, 19 blocks per column: columns 1..9, rows 2..9
+        region_bits = sum(prefix[c * 19 + 10] - prefix[c * 19 + 2] for c in range(1, 10))
+        self.assertEqual(lines[2], "3 6 30 31 {}".format(region_bits // 8))
+        self.assertTrue(os.path.exists(os.path.join(self.tmp_dir.name, 'heat.png')))
+
+
+if __name__ == "__main__":
+    unittest.main()
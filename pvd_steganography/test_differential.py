@@ -0,0 +1,379 @@
+import bisect
+import collections
+import os
+import random
+import sys
+import tempfile
+import time
+import unittest
+from unittest import mock
+from PIL import Image
+from pvd_lib import pvd_lib, file_bits_reader, pvd_cancel_token, pvd_cancelled, PVD_CAPACITY_CACHE
+
+"""
+Differential tests: every engine in PVD_ENGINES has to give the same stego pixels, bit counts
+and extracted bytes as the scalar embed_data / extract_data of pvd_lib, on random covers and
+payloads. A faster engine is adopted by adding it to PVD_ENGINES and passing these tests.
+
+PVD_FUZZ_CASES - number of random cases, PVD_FUZZ_SEED - seed of the case generator,
+PVD_FUZZ_REPORT - file the speedup of every engine is written to (printed to stderr otherwise)
+"""
+
+PVD_FUZZ_CASES = int(os.environ.get('PVD_FUZZ_CASES', 40))
+PVD_FUZZ_SEED = int(os.environ.get('PVD_FUZZ_SEED', 20240601))
+PVD_FUZZ_REPORT = os.environ.get('PVD_FUZZ_REPORT')
+
+# (width, height), most of them not divisible by 3
+PVD_FUZZ_SIZES = [(3, 3), (4, 5), (8, 7), (17, 31), (31, 17), (40, 40), (64, 49), (100, 73)]
+
+# (mode, pvd_lib options)
+PVD_FUZZ_MODES = [
+    ('RGB', {}),
+    ('RGB', {'compression': 'auto'}),
+    ('RGB', {'chunk_size': 64}),
+    ('RGB', {'dense': True}),
+    ('RGB', {'table': 'wu_tsai'}),
+    ('RGBA', {}),
+    ('RGBA', {'use_alpha': True}),
+    ('I;16', {'use_16bit': True}),
+    ('L', {}),
+]
+
+PVD_FUZZ_TEXTURES = ['noise', 'flat', 'gradient', 'checker', 'smooth']
+
+PVD_FUZZ_PAYLOADS = ['empty', 'one', 'random', 'edge', 'over']
+
+pvd_engine = collections.namedtuple('pvd_engine', ['name', 'embed', 'extract'])
+
+PVD_ENGINES = [
+    pvd_engine('reference',
+        lambda lib, cover, secret, output: lib.embed_data(cover, secret, output),
+        lambda lib, ref, stego, output: lib.extract_data(ref, output, stego)),
+    # capacity check in front of the same loops
+    pvd_engine('checked',
+        lambda lib, cover, secret, output: lib.pvd_embed(cover, secret, output),
+        lambda lib, ref, stego, output: lib.pvd_extract(ref, output, stego)),
+]
+
+
+def make_cover(rng, mode, size, texture):
+    width, height = size
+    bands = 1 if mode in ('L', 'I;16') else len(mode)
+    sample_bytes = 2 if mode == 'I;16' else 1
+    top = (1 << (8 * sample_bytes)) - 1
+
+    if texture == 'noise':
+        return Image.frombytes(mode, size, rng.randbytes(width * height * bands * sample_bytes))
+    if texture == 'smooth':
+        small = Image.frombytes(mode, (max(1, width // 4), max(1, height // 4)),
+            rng.randbytes(max(1, width // 4) * max(1, height // 4) * bands * sample_bytes))
+        return small.resize(size, Image.BILINEAR if mode != 'I;16' else Image.NEAREST)
+
+    level = rng.randrange(top + 1)
+    img = Image.new(mode, size, level if bands == 1 else (level,) * bands)
+    if texture == 'flat':
+        return img
+
+    pixels = img.load()
+    for x in range(width):
+        for y in range(height):
+            if texture == 'gradient':
+                v = (x + y) * top // max(1, width + height - 2)
+            else:
+                v = top if (x // 2 + y // 2) % 2 else 0
+            pixels[x, y] = v if bands == 1 else (v,) * bands
+    return img
+
+
+def payload_length(rng, kind, lib, cover):
+    if kind == 'empty':
+        return 0
+    if kind == 'one':
+        return 1
+    lanes = lib._lanes(cover)
+    capacity = pvd_lib._embed_capacity(cover, lanes) if lanes else 0
+    # random payloads are stored uncompressed, so the header is the whole overhead
+    overhead = file_bits_reader(None, lib.compression, lib.chunk_size, data=b'', lanes=lanes).total_bytes
+    room = max(0, capacity - overhead)
+    if lib.chunk_size:
+        # every chunk carries its CRC
+        room = room * lib.chunk_size // (lib.chunk_size + 4)
+    if kind == 'edge':
+        return room
+    if kind == 'over':
+        return room + 1
+    return rng.randrange(room + 1)
+
+
+def outcome(func, *args):
+    # return value, or the error it raised
+    try:
+        return ('ok', func(*args))
+    except Exception as e:
+        return ('error', type(e).__name__, str(e))
+
+
+def read_output(path, image):
+    if not os.path.exists(path):
+        return None
+    if image:
+        with Image.open(path) as img:
+            return img.mode, img.size, img.tobytes()
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+class test_differential(unittest.TestCase):
+
+    timings = collections.defaultdict(float)
+
+    @classmethod
+    def tearDownClass(cls):
+        reference = cls.timings.get('reference')
+        if not reference:
+            return
+        lines = ["{}: {:.3f} s, speedup {:.2f}x".format(name, spent, reference / spent if spent else float('inf'))
+            for name, spent in cls.timings.items()]
+        if PVD_FUZZ_REPORT:
+            with open(PVD_FUZZ_REPORT, 'w') as f:
+                f.write('\n'.join(lines) + '\n')
+        else:
+            print('\n' + '\n'.join(lines), file=sys.stderr)
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def path(self, name):
+        return os.path.join(self.tmp_dir.name, name)
+
+    def run_engine(self, engine, lib_options, cover, secret):
+        stego = self.path(engine.name + '_stego.png')
+        extracted = self.path(engine.name + '_extracted.bin')
+        for path in (stego, extracted):
+            if os.path.exists(path):
+                os.unlink(path)
+        lib = pvd_lib(**lib_options)
+
+        started = time.perf_counter()
+        # "nothing embedded" is None, whichever false value the engine returns for it
+        embedded = outcome(lambda *args: engine.embed(*args) or None, lib, cover, secret, stego)
+        stego_pixels = read_output(stego, True)
+        # without a stego image the cover itself is searched for a payload
+        extracted_bits = outcome(engine.extract, lib, cover, stego if stego_pixels else cover, extracted)
+        self.timings[engine.name] += time.perf_counter() - started
+
+        return embedded, stego_pixels, extracted_bits, read_output(extracted, False)
+
+    def test_engines_match_reference(self):
+        rng = random.Random(PVD_FUZZ_SEED)
+        for case in range(PVD_FUZZ_CASES):
+            mode, options = rng.choice(PVD_FUZZ_MODES)
+            size = rng.choice(PVD_FUZZ_SIZES)
+            texture = rng.choice(PVD_FUZZ_TEXTURES)
+            payload_kind = rng.choice(PVD_FUZZ_PAYLOADS)
+            options = dict({'compression': None}, **options)
+
+            cover = self.path('cover.png')
+            secret = self.path('secret.bin')
+            make_cover(rng, mode, size, texture).save(cover)
+            payload = rng.randbytes(payload_length(rng, payload_kind, pvd_lib(**options), cover))
+            with open(secret, 'wb') as f:
+                f.write(payload)
+
+            with self.subTest(case=case, mode=mode, options=options, size=size, texture=texture,
+                    payload=payload_kind, length=len(payload)):
+                expected = self.run_engine(PVD_ENGINES[0], options, cover, secret)
+                if expected[1] is not None:
+                    # the reference itself has to give the payload back
+                    self.assertEqual(expected[3], payload)
+
+                for engine in PVD_ENGINES[1:]:
+                    self.assertEqual(self.run_engine(engine, options, cover, secret), expected, engine.name)
+
+    def test_extract_range(self):
+        # random range reads of a chunked payload, then one corrupted chunk
+        rng = random.Random(PVD_FUZZ_SEED)
+        cover = self.path('cover.png')
+        secret = self.path('secret.bin')
+        stego = self.path('stego.png')
+        extracted = self.path('extracted.bin')
+        make_cover(rng, 'RGB', (64, 49), 'noise').save(cover)
+        chunk_size = 64
+        # 15 full chunks and a short last one
+        payload = rng.randbytes(15 * chunk_size + 40)
+        with open(secret, 'wb') as f:
+            f.write(payload)
+
+        lib = pvd_lib(None, chunk_size)
+        self.assertTrue(lib.pvd_embed(cover, secret, stego))
+        block_prefix = pvd_lib._block_capacity_prefix(cover, lib._lanes(cover))
+
+        ranges = [(0, 1), (0, len(payload)), (len(payload) - 1, 1), (15 * chunk_size, 40), (15 * chunk_size - 3, 10),
+            (len(payload) - 5, 100), (len(payload), 10), (len(payload) + 7, 3), (chunk_size, 0)]
+        ranges += [(rng.randrange(len(payload)), rng.randrange(1, 300)) for _ in range(20)]
+        for offset, length in ranges:
+            with self.subTest(offset=offset, length=length):
+                self.assertEqual(lib.extract_range(cover, stego, offset, length, block_prefix),
+                    payload[offset:offset + length])
+
+        # flip the lowest bit of the slot holding a byte in the middle of chunk 5
+        corrupt_chunk = 5
+        with Image.open(cover) as ref_img:
+            lanes = lib._lanes(cover)
+            header_size = file_bits_reader(None, None, chunk_size, data=b'', lanes=lanes).total_bytes
+            bit_pos = (header_size + corrupt_chunk * (chunk_size + 4) + chunk_size // 2) * 8
+            block_idx = bisect.bisect_right(block_prefix, bit_pos) - 1
+            height_itr, width_itr = list(lanes.iter_blocks(ref_img.size, block_idx))[0]
+            bits_done = block_prefix[block_idx]
+            for h_j, w_i, rgb, bits_reqd in pvd_lib._block_slots(ref_img.load(), height_itr, width_itr, lanes):
+                bits_done += bits_reqd
+                if bits_done > bit_pos:
+                    break
+        with Image.open(stego) as stego_img:
+            stego_img.load()
+            pixel = list(stego_img.getpixel((h_j, w_i)))
+            pixel[rgb] ^= 1
+            stego_img.putpixel((h_j, w_i), tuple(pixel))
+            stego_img.save(stego)
+
+        self.assertEqual(lib.extract_range(cover, stego, 0, chunk_size, block_prefix), payload[:chunk_size])
+        with self.assertRaisesRegex(ValueError, "Corrupted chunk: {}$".format(corrupt_chunk)):
+            lib.extract_range(cover, stego, corrupt_chunk * chunk_size + 10, 5, block_prefix)
+        with self.assertRaisesRegex(ValueError, "Corrupted chunk: {}$".format(corrupt_chunk)):
+            lib.pvd_extract(cover, extracted, stego)
+        self.assertFalse(os.path.exists(extracted))
+
+    def test_corrupted_body(self):
+        # a damaged compressed body is a ValueError of the extraction, not an error of the codec
+        rng = random.Random(PVD_FUZZ_SEED)
+        cover = self.path('cover.png')
+        secret = self.path('secret.bin')
+        stego = self.path('stego.png')
+        extracted = self.path('extracted.bin')
+        make_cover(rng, 'RGB', (64, 49), 'noise').save(cover)
+        with open(secret, 'wb') as f:
+            f.write(bytes(rng.choice(b'pvd ') for _ in range(3000)))
+
+        for compression in ('zlib', 'bz2'):
+            with self.subTest(compression=compression):
+                lib = pvd_lib(compression)
+                self.assertTrue(lib.pvd_embed(cover, secret, stego))
+                lanes = lib._lanes(cover)
+                reader = file_bits_reader(secret, compression, lanes=lanes)
+                reader.close_file()
+                # flip the lowest bit of the slot holding a byte in the middle of the body
+                bit_pos = (reader.total_bytes // 2) * 8
+                block_prefix = pvd_lib._block_capacity_prefix(cover, lanes)
+                with Image.open(cover) as ref_img:
+                    block_idx = bisect.bisect_right(block_prefix, bit_pos) - 1
+                    height_itr, width_itr = list(lanes.iter_blocks(ref_img.size, block_idx))[0]
+                    bits_done = block_prefix[block_idx]
+                    for h_j, w_i, rgb, bits_reqd in pvd_lib._block_slots(ref_img.load(), height_itr, width_itr,
+                            lanes):
+                        bits_done += bits_reqd
+                        if bits_done > bit_pos:
+                            break
+                with Image.open(stego) as stego_img:
+                    stego_img.load()
+                    pixel = list(stego_img.getpixel((h_j, w_i)))
+                    pixel[rgb] ^= 1
+                    stego_img.putpixel((h_j, w_i), tuple(pixel))
+                    stego_img.save(stego)
+
+                with self.assertRaisesRegex(ValueError, "Corrupted payload"):
+                    lib.pvd_extract(cover, extracted, stego)
+                self.assertFalse(os.path.exists(extracted))
+
+    def test_estimate_coverage(self):
+        # the interval of _estimate_capacity holds the exact capacity about as often as its confidence says,
+        # not much less (a too small variance) and, for a 50% interval, not much more (a too large one)
+        rng = random.Random(PVD_FUZZ_SEED)
+        covers = []
+        for idx in range(30):
+            cover = self.path('cover_{}.png'.format(idx))
+            make_cover(rng, 'RGB', (rng.randrange(100, 200), rng.randrange(100, 200)),
+                rng.choice(['noise', 'smooth'])).save(cover)
+            covers.append((cover, pvd_lib._embed_capacity(cover)))
+
+        for confidence, low, high in ((0.95, 0.90, 1.0), (0.5, 0.35, 0.65)):
+            hits = 0
+            for cover, capacity in covers:
+                for seed in range(4):
+                    estimate = pvd_lib._estimate_capacity(cover, confidence=confidence, seed=seed)
+                    hits += estimate.low <= capacity <= estimate.high
+            with self.subTest(confidence=confidence):
+                self.assertGreaterEqual(hits / (len(covers) * 4), low)
+                self.assertLessEqual(hits / (len(covers) * 4), high)
+
+    def test_embed_without_capacity_scan(self):
+        # the fit check of pvd_embed uses a cached capacity only, progress and cancel work from the first row
+        rng = random.Random(PVD_FUZZ_SEED)
+        cover = self.path('cover.png')
+        secret = self.path('secret.bin')
+        big_secret = self.path('big_secret.bin')
+        stego = self.path('stego.png')
+        make_cover(rng, 'RGB', (64, 49), 'noise').save(cover)
+        with open(secret, 'wb') as f:
+            f.write(rng.randbytes(200))
+        with open(big_secret, 'wb') as f:
+            f.write(rng.randbytes(64 * 49 * 3))
+        lib = pvd_lib(None)
+        lanes = lib._lanes(cover)
+        capacity = pvd_lib._compute_capacity(cover, lanes)
+
+        PVD_CAPACITY_CACHE.clear()
+        rows = []
+        with mock.patch.object(pvd_lib, '_compute_capacity', side_effect=AssertionError("capacity scan")):
+            self.assertTrue(lib.pvd_embed(cover, secret, stego, progress=rows.append))
+            self.assertEqual(rows[0].blocks_done, 0)
+
+            cancel = pvd_cancel_token()
+            cancel.cancel()
+            with self.assertRaises(pvd_cancelled):
+                lib.pvd_embed(cover, secret, self.path('cancelled.png'), cancel=cancel)
+
+            # the embedding that ran out of blocks leaves the capacity in the cache
+            self.assertIsNone(lib.pvd_embed(cover, big_secret, self.path('big.png')))
+            self.assertEqual(PVD_CAPACITY_CACHE.peek('capacity', cover, lanes), capacity)
+            self.assertIsNone(lib.pvd_embed(cover, big_secret, self.path('big.png')))
+        self.assertFalse(os.path.exists(self.path('cancelled.png')))
+        self.assertFalse(os.path.exists(self.path('big.png')))
+
+    def test_update_matches_fresh_embed(self):
+        # update_payload rewrites only the changed blocks, the result has to be the image a fresh
+        # pvd_embed of the new payload gives
+        rng = random.Random(PVD_FUZZ_SEED)
+        cover = self.path('cover.png')
+        make_cover(rng, 'RGB', (64, 49), 'noise').save(cover)
+        old_payload = rng.randbytes(300)
+
+        for options in ({'compression': None}, {'compression': None, 'dense': True},
+                {'compression': None, 'chunk_size': 64}, {'compression': 'auto'}):
+            lib = pvd_lib(**options)
+            changed = bytearray(old_payload)
+            changed[rng.randrange(len(changed))] ^= 0xff
+            for kind, new_payload in (('same', bytes(changed)), ('longer', old_payload + rng.randbytes(200)),
+                    ('shorter', old_payload[:120]), ('empty', b'')):
+                with self.subTest(options=options, payload=kind):
+                    paths = {name: self.path(name) for name in ('old.bin', 'new.bin', 'old.png', 'fresh.png',
+                        'updated.png', 'extracted.bin')}
+                    with open(paths['old.bin'], 'wb') as f:
+                        f.write(old_payload)
+                    with open(paths['new.bin'], 'wb') as f:
+                        f.write(new_payload)
+
+                    self.assertTrue(lib.pvd_embed(cover, paths['old.bin'], paths['old.png']))
+                    self.assertTrue(lib.pvd_embed(cover, paths['new.bin'], paths['fresh.png']))
+                    pvd_lib(options['compression']).update_payload(cover, paths['old.png'], paths['new.bin'],
+                        paths['updated.png'])
+
+                    self.assertEqual(read_output(paths['updated.png'], True), read_output(paths['fresh.png'], True))
+                    self.assertGreater(lib.pvd_extract(cover, paths['extracted.bin'], paths['updated.png']), 0)
+                    self.assertEqual(read_output(paths['extracted.bin'], False), new_payload)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,96 @@
+import concurrent.futures
+import os
+import random
+import tempfile
+import threading
+import unittest
+from PIL import Image
+from pvd_executor import fair_executor, executor_full
+
+
+class done_pool:
+    # runs a job at submit, so the executor gets futures that are already done
+
+    def submit(self, fn, *args):
+        future = concurrent.futures.Future()
+        try:
+            future.set_result(fn(*args))
+        except Exception as e:
+            future.set_exception(e)
+        return future
+
+    def shutdown(self, cancel_futures=False):
+        pass
+
+
+class test_executor(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.tmp_dir = tempfile.TemporaryDirectory()
+        rng = random.Random(1)
+        cls.cover = os.path.join(cls.tmp_dir.name, 'cover.png')
+        Image.frombytes('RGB', (60, 60), rng.randbytes(60 * 60 * 3)).save(cls.cover)
+        # a job that keeps the only worker busy for a while
+        cls.big_cover = os.path.join(cls.tmp_dir.name, 'big_cover.png')
+        Image.frombytes('RGB', (900, 900), rng.randbytes(900 * 900 * 3)).save(cls.big_cover)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.tmp_dir.cleanup()
+
+    def setUp(self):
+        self.executor = fair_executor(workers=1, max_pending=3, max_pending_per_user=2)
+
+    def tearDown(self):
+        self.executor.shutdown()
+
+    def test_limits(self):
+        busy = self.executor.submit('a', 'capacity', self.big_cover)
+        queued = self.executor.submit('a', 'capacity', self.cover)
+        with self.assertRaisesRegex(executor_full, "of this user"):
+            self.executor.submit('a', 'capacity', self.cover)
+        other = self.executor.submit('b', 'capacity', self.cover)
+        with self.assertRaisesRegex(executor_full, "Too many jobs"):
+            self.executor.submit('c', 'capacity', self.cover)
+        self.assertEqual(self.executor.stats(), {'workers': 1, 'running': 1, 'pending': 3, 'users': 2})
+
+        for job in (busy, queued, other):
+            self.assertGreater(job.result(timeout=60), 0)
+        self.assertEqual(self.executor.stats(), {'workers': 1, 'running': 0, 'pending': 0, 'users': 0})
+
+    def test_cancel_queued(self):
+        busy = self.executor.submit('a', 'capacity', self.big_cover)
+        queued = self.executor.submit('b', 'capacity', self.cover)
+        queued.cancel()
+        with self.assertRaises(concurrent.futures.CancelledError):
+            queued.result(timeout=60)
+
+        self.assertGreater(busy.result(timeout=60), 0)
+        # the cancelled job is dropped when its turn comes, it frees its place in the queue
+        self.assertEqual(self.executor.stats()['pending'], 0)
+        self.assertGreater(self.executor.submit('b', 'capacity', self.cover).result(timeout=60), 0)
+
+    def test_done_callbacks(self):
+        # a job that is done before its callback is added completes, the lock is not held then
+        self.executor.pool.shutdown()
+        self.executor.pool = done_pool()
+        jobs = []
+        submitter = threading.Thread(target=lambda: jobs.extend(
+            self.executor.submit(user, 'capacity', self.cover) for user in ('a', 'b', 'a')), daemon=True)
+        submitter.start()
+        submitter.join(timeout=10)
+        self.assertFalse(submitter.is_alive(), "submit deadlocked")
+
+        capacities = [job.result(timeout=0) for job in jobs]
+        self.assertEqual(len(set(capacities)), 1)
+        self.assertEqual(self.executor.stats(), {'workers': 1, 'running': 0, 'pending': 0, 'users': 0})
+
+        # a callback added to a finished job runs at once
+        called = []
+        jobs[0].future.add_done_callback(lambda future: called.append(future.result()))
+        self.assertEqual(called, capacities[:1])
+
+
+if __name__ == "__main__":
+    unittest.main()
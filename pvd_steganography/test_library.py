@@ -0,0 +1,70 @@
+import os
+import random
+import tempfile
+import unittest
+from PIL import Image
+from pvd_lib import pvd_lib
+from pvd_library import pvd_library
+
+
+class test_library(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.rng = random.Random(20240601)
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def path(self, name):
+        return os.path.join(self.tmp_dir.name, name)
+
+    def save_cover(self, name, size):
+        Image.frombytes('RGB', (size, size), self.rng.randbytes(size * size * 3)).save(self.path(name))
+
+    def scan(self, library):
+        # scan result and the files that were indexed again
+        indexed = []
+        result = library.scan(progress=lambda done, total: indexed.append(done))
+        return result, len(indexed)
+
+    def test_scan_best(self):
+        for name, size in (('small.png', 30), ('medium.png', 45), ('large.png', 60)):
+            self.save_cover(name, size)
+
+        with pvd_library(self.tmp_dir.name, max_workers=1) as library:
+            self.assertEqual(self.scan(library), ((3, 0, 0, 0), 3))
+            self.assertEqual(len(library), 3)
+
+            # nothing changed, nothing is indexed
+            self.assertEqual(self.scan(library), ((0, 0, 3, 0), 0))
+
+            # a modified file is indexed again
+            self.save_cover('medium.png', 51)
+            st = os.stat(self.path('medium.png'))
+            os.utime(self.path('medium.png'), ns=(st.st_atime_ns, st.st_mtime_ns + 1000000000))
+            self.assertEqual(self.scan(library), ((0, 1, 2, 0), 1))
+
+            # a moved file keeps its index, found by the hash of its content
+            large_prefix = library.row_prefix(self.path('large.png'))
+            os.rename(self.path('large.png'), self.path('moved.png'))
+            self.assertEqual(self.scan(library), ((1, 0, 2, 1), 0))
+            self.assertEqual(library.row_prefix(self.path('moved.png')), large_prefix)
+            with self.assertRaises(ValueError):
+                library.row_prefix(self.path('large.png'))
+
+            capacities = {name: pvd_lib._embed_capacity(self.path(name))
+                for name in ('small.png', 'medium.png', 'moved.png')}
+            covers = library.best(0, limit=10)
+            self.assertEqual([os.path.basename(cover.path) for cover in covers],
+                sorted(capacities, key=capacities.get))
+            self.assertEqual({os.path.basename(cover.path): cover.capacity for cover in covers}, capacities)
+
+            payload_size = covers[1].payload_capacity
+            fits = library.best(payload_size, limit=10)
+            self.assertEqual([cover.path for cover in fits], [cover.path for cover in covers[1:]])
+            self.assertEqual(library.best(covers[-1].payload_capacity + 1), [])
+
+
+if __name__ == "__main__":
+    unittest.main()
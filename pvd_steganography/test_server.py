@@ -0,0 +1,45 @@
+import os
+import random
+import tempfile
+import unittest
+from PIL import Image
+from pvd_lib import pvd_lib
+from pvd_server import _job_verify
+from pvd_signature import SimpleECDSA, signature_record
+
+
+class test_server(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.cover = self.path('cover.png')
+        Image.frombytes('RGB', (60, 60), random.Random(1).randbytes(60 * 60 * 3)).save(self.cover)
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def path(self, name):
+        return os.path.join(self.tmp_dir.name, name)
+
+    def test_verify(self):
+        public_key, private_key = SimpleECDSA.generate_keys()
+        message = "подписанное сообщение"
+        record = signature_record.pack(signature_record.key_id(public_key), signature_record.signature_to_bytes(
+            SimpleECDSA.create_signature(message, private_key), public_key), message)
+        with open(self.path('record.bin'), 'wb') as f:
+            f.write(record)
+        stego = self.path('stego.png')
+        self.assertTrue(pvd_lib().pvd_embed(self.cover, self.path('record.bin'), stego))
+
+        result = _job_verify(self.cover, stego, public_key)
+        self.assertEqual(result, {'valid': True, 'key_match': True,
+            'key_id': signature_record.key_id(public_key).hex(), 'message': message})
+
+    def test_verify_without_payload(self):
+        # the error of the extraction, not of the removal of its output
+        with self.assertRaises(ValueError):
+            _job_verify(self.cover, self.cover, (65537, 3233))
+
+
+if __name__ == "__main__":
+    unittest.main()
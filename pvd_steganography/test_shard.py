@@ -0,0 +1,79 @@
+import os
+import random
+import tempfile
+import unittest
+from unittest import mock
+from PIL import Image
+from pvd_lib import pvd_lib
+from pvd_shard import pvd_shard, _embed_shard
+
+
+class test_shard(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.rng = random.Random(20240601)
+        self.covers = []
+        for idx, size in enumerate((45, 60, 75)):
+            self.covers.append(self.path('cover_{}.png'.format(idx)))
+            Image.frombytes('RGB', (size, size), self.rng.randbytes(size * size * 3)).save(self.covers[-1])
+        self.stegos = [self.path('stego_{}.png'.format(idx)) for idx in range(len(self.covers))]
+
+        capacity = sum(pvd_lib._embed_capacity(cover) for cover in self.covers)
+        self.payload = self.rng.randbytes(capacity * 3 // 4)
+        self.secret = self.path('secret.bin')
+        with open(self.secret, 'wb') as f:
+            f.write(self.payload)
+        self.extracted = self.path('extracted.bin')
+        self.pvd = pvd_shard(max_workers=2, compression=None)
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def path(self, name):
+        return os.path.join(self.tmp_dir.name, name)
+
+    def test_round_trip(self):
+        embedded = self.pvd.embed(self.covers, self.secret, self.stegos)
+        self.assertEqual([path for path, _ in embedded], self.stegos)
+
+        # the pairs may come in any order
+        pairs = list(zip(self.covers, self.stegos))
+        self.rng.shuffle(pairs)
+        refs, stegos = zip(*pairs)
+        self.assertEqual(self.pvd.extract(list(refs), self.extracted, list(stegos)), len(self.payload))
+        with open(self.extracted, 'rb') as f:
+            self.assertEqual(f.read(), self.payload)
+
+    def test_missing_shard(self):
+        self.pvd.embed(self.covers, self.secret, self.stegos)
+        with self.assertRaisesRegex(ValueError, r"Missing shards: \[1\]"):
+            self.pvd.extract([self.covers[0], self.covers[2]], self.extracted, [self.stegos[0], self.stegos[2]])
+        self.assertFalse(os.path.exists(self.extracted))
+
+    def test_hash_mismatch(self):
+        embedded = self.pvd.embed(self.covers, self.secret, self.stegos)
+        shard_total = len(embedded)
+
+        # a shard with the header of this payload and other data
+        payload_hash = pvd_lib().read_header(self.covers[1], self.stegos[1]).fields['payload_hash']
+        _embed_shard(self.covers[1], self.stegos[1], self.rng.randbytes(10), (1, shard_total, payload_hash), None)
+        with self.assertRaisesRegex(ValueError, "Payload hash mismatch"):
+            self.pvd.extract(self.covers, self.extracted, self.stegos)
+        self.assertFalse(os.path.exists(self.extracted))
+
+        # a shard of another payload
+        _embed_shard(self.covers[1], self.stegos[1], self.rng.randbytes(10), (1, shard_total, payload_hash ^ 1), None)
+        with self.assertRaisesRegex(ValueError, "belongs to another payload"):
+            self.pvd.extract(self.covers, self.extracted, self.stegos)
+        self.assertFalse(os.path.exists(self.extracted))
+
+    def test_shard_does_not_fit(self):
+        # the whole payload planned into the smallest cover
+        with mock.patch.object(pvd_shard, 'plan', return_value=[(0, 0, len(self.payload))]):
+            with self.assertRaisesRegex(ValueError, "Embedding into cover 0 failed"):
+                self.pvd.embed(self.covers, self.secret, self.stegos)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,71 @@
+import unittest
+from pvd_signature import SimpleECDSA, signature_record, SIG_RECORD_HEAD, SIG_KEY_ID_SIZE
+
+
+class test_signature(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.public_key, cls.private_key = SimpleECDSA.generate_keys()
+
+    def record(self, message="сообщение: с двоеточием"):
+        signature = SimpleECDSA.create_signature(message, self.private_key)
+        return signature, signature_record.pack(signature_record.key_id(self.public_key),
+            signature_record.signature_to_bytes(signature, self.public_key), message)
+
+    def test_round_trip(self):
+        message = "сообщение: с двоеточием"
+        signature, record = self.record(message)
+        key_id, sig_bytes, message_bytes = signature_record.unpack(record)
+
+        self.assertEqual(key_id, signature_record.key_id(self.public_key))
+        self.assertEqual(len(key_id), SIG_KEY_ID_SIZE)
+        # the signature always takes as many bytes as the modulus
+        self.assertEqual(len(sig_bytes), (self.public_key[1].bit_length() + 7) // 8)
+        self.assertEqual(signature_record.signature_from_bytes(sig_bytes), signature)
+        self.assertEqual(message_bytes.decode('utf-8'), message)
+        self.assertTrue(SimpleECDSA.verify_signature(message, signature, self.public_key))
+
+        # empty message, small signature with leading zero bytes
+        small_sig = signature_record.signature_to_bytes(1, self.public_key)
+        self.assertEqual(len(small_sig), len(sig_bytes))
+        record = signature_record.pack(key_id, small_sig, b'')
+        self.assertEqual(signature_record.unpack(record), (key_id, small_sig, b''))
+        self.assertEqual(signature_record.signature_from_bytes(small_sig), 1)
+
+    def test_key_id(self):
+        # depends on both parts of the key and on nothing else
+        e, n = self.public_key
+        key_id = signature_record.key_id(self.public_key)
+        self.assertEqual(signature_record.key_id((e, n)), key_id)
+        self.assertNotEqual(signature_record.key_id((e + 2, n)), key_id)
+        self.assertNotEqual(signature_record.key_id((e, n + 2)), key_id)
+        self.assertNotEqual(signature_record.key_id(SimpleECDSA.generate_keys()[0]), key_id)
+
+    def test_truncated(self):
+        _, record = self.record()
+        for size in (0, 3, SIG_RECORD_HEAD.size, SIG_RECORD_HEAD.size + 4, len(record) - 1):
+            with self.subTest(size=size):
+                with self.assertRaises(ValueError):
+                    signature_record.unpack(record[:size])
+
+    def test_bad_length_prefix(self):
+        _, record = self.record()
+        sig_length_pos = SIG_RECORD_HEAD.size + SIG_KEY_ID_SIZE
+        for pos, value in ((SIG_RECORD_HEAD.size - 1, 0xFF), (sig_length_pos, 0xFF), (sig_length_pos + 1, 0x00),
+                (len(record) - 1 - len("сообщение: с двоеточием".encode()), 0x7F)):
+            with self.subTest(pos=pos):
+                bad = bytearray(record)
+                bad[pos] = value
+                with self.assertRaises(ValueError):
+                    signature_record.unpack(bytes(bad))
+
+        # bytes after the record and a wrong magic
+        with self.assertRaisesRegex(ValueError, "Trailing data"):
+            signature_record.unpack(record + b'\0')
+        with self.assertRaisesRegex(ValueError, "Invalid signature record"):
+            signature_record.unpack(b'XXXX' + record[4:])
+
+
+if __name__ == "__main__":
+    unittest.main()